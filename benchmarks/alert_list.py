@@ -0,0 +1,72 @@
+# Measure redis round trips and latency of the alert/server list endpoints
+# as the number of historical alerts grows.
+#
+#   python -m benchmarks.alert_list --redis redis://localhost:6379/15
+#
+# The target database is flushed before every run.
+
+import argparse
+import time
+import uuid
+import ujson
+from falcon import Request, Response
+from falcon.testing import create_environ
+
+from healthapp.constants import key_map
+from healthapp.server import AlertList, ServerList, ResponseCache
+from common import CountingRedis, get_redis, timed
+
+
+def populate(r, server_count, alert_count):
+    now = time.time()
+    pipe = r.pipeline(transaction=False)
+    for i in xrange(server_count):
+        server_name = 'server%s.example.com' % i
+        pipe.set(key_map['server_info'].format(server_name=server_name), ujson.dumps({'OS': 'Linux', 'Kernel': '4.4.0'}))
+        pipe.zadd(key_map['server_last_posts'], int(now), server_name)
+
+    for i in xrange(alert_count):
+        server_name = 'server%s.example.com' % (i % server_count)
+        state_name = 'stale_%s' % server_name
+        alert_id = '%s_%s' % (state_name, uuid.uuid4())
+        start_time = now - (alert_count - i) * 60
+        pipe.hmset(key_map['alert_info'].format(alert_id=alert_id), {
+            'state_name': state_name,
+            'server_name': server_name,
+            'start_time': start_time,
+            'end_time': start_time + 30,
+            'duration': 30,
+            'info': 'Server %s last reported on ...' % server_name
+        })
+        pipe.zadd(key_map['alerts_historical'], start_time, alert_id)
+        pipe.zadd(key_map['server_alerts'].format(server_name=server_name), start_time, alert_id)
+    pipe.execute()
+
+
+def call(resource, r):
+    counting = CountingRedis(r)
+    resource.r = counting
+    resource.cache = ResponseCache(counting, 0)
+    duration, _ = timed(resource.on_get, Request(create_environ()), Response())
+    return counting, duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--alerts', default='10,100,1000,10000')
+    args = parser.parse_args()
+
+    print '%10s %10s %12s %12s' % ('alerts', 'endpoint', 'round trips', 'ms')
+    for alert_count in [int(x) for x in args.alerts.split(',')]:
+        r = get_redis(args.redis)
+        populate(r, args.servers, alert_count)
+
+        for name, resource in (('alerts', AlertList(r, None)), ('servers', ServerList(r, 300, None))):
+            counting, duration = call(resource, r)
+            print '%10s %10s %12s %12.1f' % (alert_count, name, counting.round_trips, duration * 1000)
+
+
+if __name__ == '__main__':
+    main()
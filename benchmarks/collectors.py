@@ -0,0 +1,41 @@
+# Measure the CPU time each agent collector costs per heartbeat, and the
+# agent's resident memory once they're loaded.
+#
+#   python -m benchmarks.collectors --iterations 10000
+
+import os
+import argparse
+
+from healthapp.collectors import collector_types, load_collectors
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def rss_kb():
+    with open('/proc/self/status') as h:
+        for line in h:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    print '%10s %16s' % ('collector', 'cpu us/collect')
+    for name in sorted(collector_types):
+        collector = load_collectors([name])[0]
+        start = cpu_time()
+        for i in xrange(args.iterations):
+            collector.collect()
+        print '%10s %16.1f' % (name, (cpu_time() - start) / args.iterations * 1e6)
+
+    print 'rss with all collectors loaded: %s kB' % rss_kb()
+
+
+if __name__ == '__main__':
+    main()
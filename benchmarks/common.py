@@ -0,0 +1,71 @@
+# helpers shared between benchmark scripts
+
+import time
+import redis
+from collections import Counter
+
+
+class CountingPipeline(object):
+    '''Wraps a redis pipeline, counting each execute() as one round trip'''
+
+    def __init__(self, client, pipe):
+        self._client = client
+        self._pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def execute(self, *args, **kwargs):
+        self._client.round_trips += 1
+        self._client.commands['pipeline'] += 1
+        return self._pipe.execute(*args, **kwargs)
+
+
+class CountingRedis(object):
+    '''
+    Wraps a StrictRedis client and counts round trips: every direct command
+    is one, every pipeline is one regardless of how many commands it holds.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0
+        self.commands = Counter()
+
+    def pipeline(self, *args, **kwargs):
+        return CountingPipeline(self, self._client.pipeline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def wrapped(*args, **kwargs):
+            self.round_trips += 1
+            self.commands[name] += 1
+            return attr(*args, **kwargs)
+        return wrapped
+
+
+def get_redis(url):
+    r = redis.StrictRedis.from_url(url)
+    r.flushdb()
+    return r
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def command_calls(r):
+    '''
+    Commands redis has run so far, from INFO commandstats. Counts every
+    client's commands, including those run by scripts, so diff two calls
+    around an operation on an otherwise idle redis to see what it cost.
+    '''
+    return sum(stats['calls'] for stats in r.info('commandstats').itervalues())
@@ -0,0 +1,95 @@
+# Run several alert processors against one redis, repeatedly kill -9 the
+# leader and measure how long until a standby takes over the lease.
+#
+#   python -m benchmarks.failover --redis redis://localhost:6379/15 --alerters 3 --lease-ttl 3
+#
+# The target database is flushed first.
+
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+from healthapp.constants import key_map
+from common import get_redis
+
+
+def start_alerter(config_file):
+    env = dict(os.environ, CONFIG_FILE=config_file)
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.Popen([sys.executable, '-c', 'from healthapp.alerter import main; main()'],
+                                env=env, stdout=devnull, stderr=devnull)
+
+
+def wait_for_leader(r, previous=None, timeout=60):
+    '''Poll until the lease is held by someone other than previous. Returns its value.'''
+    until = time.time() + timeout
+    while time.time() < until:
+        value = r.get(key_map['alerter_lease'])
+        if value and value != previous:
+            return value
+        time.sleep(0.005)
+    raise RuntimeError('No alerter took over within %ss' % timeout)
+
+
+def leader_pid(value):
+    # lease values look like <hostname>:<pid>:<random> <token>
+    return int(value.split(' ')[0].split(':')[-2])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--alerters', type=int, default=3)
+    parser.add_argument('--lease-ttl', type=float, default=3)
+    parser.add_argument('--kills', type=int, default=5)
+    args = parser.parse_args()
+
+    r = get_redis(args.redis)
+
+    config_file = tempfile.mktemp(suffix='.yaml')
+    with open(config_file, 'w') as h:
+        yaml.safe_dump({'redis': args.redis, 'alerter_lease_ttl': args.lease_ttl, 'alert_process_interval': 1}, h)
+
+    alerters = {}
+    try:
+        for i in xrange(args.alerters):
+            process = start_alerter(config_file)
+            alerters[process.pid] = process
+
+        leader = wait_for_leader(r)
+        failovers = []
+
+        for i in xrange(args.kills):
+            # let the leader settle into its renewal schedule
+            time.sleep(args.lease_ttl)
+
+            pid = leader_pid(leader)
+            killed_at = time.time()
+            os.kill(pid, signal.SIGKILL)
+            alerters.pop(pid).wait()
+
+            leader = wait_for_leader(r, leader)
+            failovers.append(time.time() - killed_at)
+            print 'killed %s, new leader %s after %.2fs' % (pid, leader, failovers[-1])
+
+            process = start_alerter(config_file)
+            alerters[process.pid] = process
+
+        failovers.sort()
+        print 'lease ttl: %.2fs' % args.lease_ttl
+        print 'failover min/median/max: %.2fs / %.2fs / %.2fs' % (failovers[0], failovers[len(failovers) // 2], failovers[-1])
+    finally:
+        for process in alerters.values():
+            process.kill()
+            process.wait()
+        os.unlink(config_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# Compare agent post throughput of the API on gunicorn sync workers against
+# the gevent server (healthapp.green) as the number of agents grows. Each
+# server runs as its own process(es) on a local port and is driven over real
+# sockets by many concurrent simulated agents, each posting under its own
+# server name. Reports requests/sec and latency, plus requests per second of
+# CPU time used by the server processes, ie throughput per core, which
+# doesn't depend on how many cores the load generator leaves over.
+#
+#   python -m benchmarks.fanin --redis redis://localhost:6379/15 --agents 1000,10000,50000
+#
+# The target database is flushed before each run.
+
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import socket  # noqa: E402
+import argparse  # noqa: E402
+import tempfile  # noqa: E402
+import subprocess  # noqa: E402
+from itertools import count  # noqa: E402
+
+import yaml  # noqa: E402
+import gevent  # noqa: E402
+
+from healthapp.agent import generate_payload  # noqa: E402
+from common import get_redis  # noqa: E402
+
+api_key = 'benchmark'
+
+servers = {
+    'sync': "exec gunicorn 'healthapp.server:get_app()' -b {address} --workers {workers} --backlog 4096",
+    'green': "exec {python} -c 'from healthapp.green import main; main()'",
+}
+
+
+def start_server(kind, address, workers, config_file):
+    env = dict(os.environ, CONFIG_FILE=config_file)
+    command = servers[kind].format(address=address, workers=workers, python=sys.executable)
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, shell=True, env=env, stdout=devnull, stderr=devnull)
+
+    host, port = address.rsplit(':', 1)
+    until = time.time() + 30
+    while time.time() < until:
+        try:
+            socket.create_connection((host, int(port))).close()
+        except socket.error:
+            time.sleep(0.1)
+            continue
+        # give the workers time to boot
+        time.sleep(2)
+        return process
+
+    process.kill()
+    raise RuntimeError('%s server did not start listening on %s' % (kind, address))
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in os.listdir('/proc'):
+        if not child.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % child) as h:
+                ppid = int(h.read().rsplit(')', 1)[1].split()[1])
+        except IOError:
+            continue
+        if ppid == pid:
+            pids.extend(process_tree(int(child)))
+    return pids
+
+
+def cpu_seconds(pids):
+    '''User plus system CPU time used so far by these processes'''
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as h:
+                fields = h.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return float(total) / os.sysconf('SC_CLK_TCK')
+
+
+def read_response(sock, buffered):
+    '''Read one HTTP response. Returns (status, keep alive, leftover bytes).'''
+    while '\r\n\r\n' not in buffered:
+        data = sock.recv(65536)
+        if not data:
+            raise socket.error('Connection closed mid response')
+        buffered += data
+
+    head, buffered = buffered.split('\r\n\r\n', 1)
+    lines = head.split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = dict((name.strip().lower(), value.strip()) for name, value in (line.split(':', 1) for line in lines[1:]))
+
+    length = int(headers.get('content-length', 0))
+    while len(buffered) < length:
+        data = sock.recv(65536)
+        if not data:
+            raise socket.error('Connection closed mid response')
+        buffered += data
+
+    return status, headers.get('connection', '').lower() != 'close', buffered[length:]
+
+
+def agent_client(address, request_for, next_request, total, latencies, errors):
+    '''
+    Post requests until total have been sent by all clients, reusing the
+    connection when the server keeps it alive, the way agents' requests
+    sessions do.
+    '''
+    host, port = address.rsplit(':', 1)
+    sock = None
+    buffered = ''
+
+    while True:
+        i = next(next_request)
+        if i >= total:
+            break
+
+        start = time.time()
+        try:
+            if sock is None:
+                sock = socket.create_connection((host, int(port)))
+                buffered = ''
+            sock.sendall(request_for(i))
+            status, keep_alive, buffered = read_response(sock, buffered)
+        except socket.error:
+            errors.append(i)
+            sock = None
+            continue
+        latencies.append(time.time() - start)
+
+        if status != 200:
+            errors.append(i)
+        if not keep_alive:
+            sock.close()
+            sock = None
+
+    if sock:
+        sock.close()
+
+
+def drive(address, agents, total, concurrency):
+    payload = generate_payload({'OS': 'Linux', 'Kernel': '4.4.0-97-generic'}, api_key)
+    headers = ''.join('%s: %s\r\n' % item for item in payload['headers'].items())
+
+    def request_for(i):
+        return ('POST /api/v0/status/server%s.example.com HTTP/1.1\r\nHost: %s\r\nContent-Length: %s\r\n%s\r\n%s'
+                % (i % agents, address, len(payload['body']), headers, payload['body']))
+
+    latencies = []
+    errors = []
+    next_request = count()
+    clients = [gevent.spawn(agent_client, address, request_for, next_request, total, latencies, errors)
+               for i in xrange(min(agents, concurrency))]
+    gevent.joinall(clients)
+    return sorted(latencies), errors
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--agents', default='1000,10000,50000')
+    parser.add_argument('--requests', type=int, default=20000, help='requests per run, at least one per agent')
+    parser.add_argument('--concurrency', type=int, default=1000, help='most connections open at once')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes per server')
+    parser.add_argument('--address', default='127.0.0.1:8231')
+    args = parser.parse_args()
+
+    config_file = tempfile.mktemp(suffix='.yaml')
+    with open(config_file, 'w') as h:
+        yaml.safe_dump({'redis': args.redis, 'api_key': api_key, 'green_api_address': args.address,
+                        'green_api_workers': args.workers, 'green_api_max_clients': args.concurrency}, h)
+
+    print '%6s %8s %8s %8s %8s %8s %14s' % ('server', 'agents', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'req/cpu sec')
+    try:
+        for agents in [int(agents) for agents in args.agents.split(',')]:
+            for kind in ('sync', 'green'):
+                get_redis(args.redis)
+                server = start_server(kind, args.address, args.workers, config_file)
+                try:
+                    pids = process_tree(server.pid)
+                    total = max(args.requests, agents)
+                    cpu_start = cpu_seconds(pids)
+                    start = time.time()
+                    latencies, errors = drive(args.address, agents, total, args.concurrency)
+                    duration = time.time() - start
+                    cpu = cpu_seconds(pids) - cpu_start
+                finally:
+                    server.terminate()
+                    server.wait()
+
+                print '%6s %8d %8d %8.0f %8.1f %8.1f %14.0f' % (
+                    kind, agents, len(errors), len(latencies) / duration,
+                    percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, len(latencies) / cpu)
+    finally:
+        os.unlink(config_file)
+
+
+if __name__ == '__main__':
+    main()
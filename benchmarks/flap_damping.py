@@ -0,0 +1,103 @@
+# Measure the churn of servers whose posts straddle server_staleness_duration,
+# with the alerter as configured by default and with hysteresis and flap
+# merging turned on: alerts created, notifications sent, redis commands,
+# memory and alert loop time over a number of runs.
+#
+#   python -m benchmarks.flap_damping --redis redis://localhost:6379/15 --agents 2000 --flap 0.05
+#
+# The target database is flushed before each configuration.
+
+import time
+import logging
+import argparse
+
+import healthapp.alerter as alerter
+from healthapp.constants import key_map
+from healthapp.alerter import AlertProcessor
+from common import get_redis, command_calls
+from fleet import Fleet
+
+staleness = 300
+
+configs = [
+    ('default', {}),
+    ('damped', {'alert_open_ticks': 2, 'alert_close_ticks': 2, 'alert_close_staleness': staleness // 2, 'alert_flap_window': 3600}),
+]
+
+
+def flap(fleet, fraction, down_ticks, up_ticks):
+    '''A fraction of the fleet is silent for down_ticks, then posts for up_ticks, over and over'''
+    flapping = set(fleet.sample(fraction))
+    steady = [name for name in fleet.names if name not in flapping]
+    tick = 0
+    while True:
+        if tick % (down_ticks + up_ticks) < down_ticks:
+            yield flapping, steady
+        else:
+            yield set(), steady + list(flapping)
+        tick += 1
+
+
+def count_notifications(counts):
+    # the alerter's notify functions, counting instead of sending
+    alerter.notify_alert_new = lambda *args: counts.__setitem__('new', counts['new'] + 1)
+    alerter.notify_alert_closed = lambda *args: counts.__setitem__('closed', counts['closed'] + 1)
+    alerter.notify_ongoing_alert = lambda *args: None
+
+
+def run(redis_url, agents, fraction, down_ticks, up_ticks, ticks, extra_configs):
+    r = get_redis(redis_url)
+    fleet = Fleet(agents)
+    processor = AlertProcessor(r, dict({'server_staleness_duration': staleness}, **extra_configs))
+    fleet.set_last_posts(r, fleet.names, int(time.time()))
+
+    counts = {'new': 0, 'closed': 0}
+    count_notifications(counts)
+
+    memory = r.info('memory')['used_memory']
+    commands = command_calls(r)
+    duration = 0
+    scenario = flap(fleet, fraction, down_ticks, up_ticks)
+    for tick in xrange(ticks):
+        down, up = next(scenario)
+        now = int(time.time())
+        # flapping servers miss the cutoff by a little, rather than being long gone
+        fleet.set_last_posts(r, down, now - staleness - 10)
+        fleet.set_last_posts(r, up, now)
+        start = time.time()
+        processor.run_once()
+        duration += time.time() - start
+
+    return {
+        'alerts': r.zcard(key_map['alerts_historical']),
+        'emails': counts['new'] + counts['closed'],
+        'commands': command_calls(r) - commands - ticks,
+        'memory_kb': (r.info('memory')['used_memory'] - memory) / 1024,
+        'ms_per_run': duration * 1000 / ticks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--agents', type=int, default=2000)
+    parser.add_argument('--flap', type=float, default=0.05, help='fraction of the fleet which flaps')
+    parser.add_argument('--ticks', type=int, default=24, help='alert loop runs')
+    parser.add_argument('--patterns', default='1:1,2:2,3:1', help='runs silent:runs posting of the flapping servers')
+    args = parser.parse_args()
+
+    # the alerter logs a line per alert
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print '%d of %d servers flapping, %d runs' % (int(args.agents * args.flap), args.agents, args.ticks)
+    print '%8s %10s %10s %10s %10s %10s %12s' % ('pattern', 'config', 'alerts', 'emails', 'commands', 'memory_kb', 'ms_per_run')
+    for pattern in args.patterns.split(','):
+        down_ticks, up_ticks = [int(x) for x in pattern.split(':')]
+        for name, extra_configs in configs:
+            result = run(args.redis, args.agents, args.flap, down_ticks, up_ticks, args.ticks, extra_configs)
+            print '%8s %10s %10d %10d %10d %10d %12.2f' % (pattern, name, result['alerts'], result['emails'], result['commands'],
+                                                           result['memory_kb'], result['ms_per_run'])
+
+
+if __name__ == '__main__':
+    main()
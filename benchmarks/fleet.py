@@ -0,0 +1,75 @@
+# Simulated fleet of agents for benchmarks: stable server names, signed
+# payloads made with the agent's own generate_payload, and scenarios which
+# decide who posts on each tick. Seeded, so the same arguments always give
+# the same fleet and the same sequence of posts.
+
+import random
+
+from healthapp.agent import generate_payload
+from healthapp.shards import server_shard_key
+
+api_key = 'benchmark'
+
+
+class Fleet(object):
+    '''
+    agents servers, each with a base payload. changed is the fraction of
+    posts whose stats differ from the previous one, which costs the API an
+    info rewrite.
+    '''
+
+    def __init__(self, agents, changed=0.01, seed=0, shards=1):
+        self.random = random.Random(seed)
+        self.names = ['server%s.example.com' % i for i in xrange(agents)]
+        self.changed = changed
+        self.shards = shards
+        stats = {'OS': 'Linux', 'Kernel': '4.4.0-97-generic'}
+        self.payload = generate_payload(stats, api_key)
+        self.changed_payloads = [generate_payload(dict(stats, Kernel=str(i)), api_key) for i in xrange(100)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def next_payload(self):
+        if self.random.random() < self.changed:
+            return self.random.choice(self.changed_payloads)
+        return self.payload
+
+    def post(self, client, server_name):
+        '''Post one server's status through a falcon TestClient. Returns the result.'''
+        payload = self.next_payload()
+        return client.simulate_post('/api/v0/status/' + server_name, body=payload['body'], headers=payload['headers'])
+
+    def sample(self, fraction):
+        '''The first fraction of the fleet, so repeated calls pick the same servers'''
+        return self.names[:int(len(self.names) * fraction)]
+
+    def set_last_posts(self, r, server_names, when):
+        '''
+        Pretend these servers last posted at when, eg in the past to make
+        them stale without waiting out server_staleness_duration.
+        '''
+        pipe = r.pipeline(transaction=False)
+        for server_name in server_names:
+            pipe.zadd(server_shard_key('server_last_posts', server_name, self.shards), when, server_name)
+        pipe.execute()
+
+
+def outage(fleet, fraction):
+    '''A fraction of the fleet goes silent and stays down: (down, up) for each tick'''
+    down = set(fleet.sample(fraction))
+    while True:
+        yield down, [name for name in fleet.names if name not in down]
+
+
+def flap(fleet, fraction):
+    '''A fraction of the fleet alternates between silent and posting every tick'''
+    flapping = set(fleet.sample(fraction))
+    steady = [name for name in fleet.names if name not in flapping]
+    tick = 0
+    while True:
+        if tick % 2:
+            yield set(), steady + list(flapping)
+        else:
+            yield flapping, steady
+        tick += 1
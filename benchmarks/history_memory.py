@@ -0,0 +1,68 @@
+# Measure the redis memory a day of heartbeat history costs per server, for
+# the packed per day strings plus hourly rollups versus storing each
+# heartbeat as a JSON member of a sorted set.
+#
+#   python -m benchmarks.history_memory --redis redis://localhost:6379/15 --servers 100
+#
+# The target database is flushed first.
+
+import argparse
+import time
+import ujson
+
+from healthapp.constants import key_map
+from healthapp.history import HeartbeatHistory, day_seconds
+from common import get_redis, timed
+
+
+def write_compact(r, history, server_count, day_start, interval):
+    for i in xrange(server_count):
+        server_name = 'server%s.example.com' % i
+        pipe = r.pipeline(transaction=False)
+        for now in xrange(day_start, day_start + day_seconds, interval):
+            history.write(pipe, server_name, now)
+        pipe.execute()
+
+
+def write_naive(r, server_count, day_start, interval):
+    for i in xrange(server_count):
+        key = 'naive:heartbeats:server%s.example.com' % i
+        pipe = r.pipeline(transaction=False)
+        for now in xrange(day_start, day_start + day_seconds, interval):
+            pipe.zadd(key, now, ujson.dumps({'server': 'server%s.example.com' % i, 'time': now}))
+        pipe.execute()
+
+
+def memory_usage(r, pattern):
+    return sum(r.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0) for key in r.scan_iter(pattern))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--interval', type=int, default=60, help='seconds between heartbeats')
+    args = parser.parse_args()
+
+    r = get_redis(args.redis)
+    history = HeartbeatHistory(7, 90)
+    day = int(time.time()) // day_seconds
+    day_start = day * day_seconds
+
+    duration = timed(write_compact, r, history, args.servers, day_start, args.interval)[0]
+    print 'wrote compact history in %.2fs' % duration
+    write_naive(r, args.servers, day_start, args.interval)
+
+    heartbeats = memory_usage(r, key_map['heartbeats'].format(server_name='*', day=day))
+    rollups = memory_usage(r, key_map['heartbeat_rollup'].format(server_name='*', day=day))
+    naive = memory_usage(r, 'naive:heartbeats:*')
+
+    print '%d heartbeats per server per day' % (day_seconds // args.interval)
+    print '%20s %20s' % ('storage', 'bytes/server/day')
+    print '%20s %20d' % ('heartbeats', heartbeats // args.servers)
+    print '%20s %20d' % ('hourly rollup', rollups // args.servers)
+    print '%20s %20d' % ('json sorted set', naive // args.servers)
+
+
+if __name__ == '__main__':
+    main()
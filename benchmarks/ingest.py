@@ -0,0 +1,81 @@
+# Load test the agent ingest path: a WSGI app with just the status route,
+# driven in-process by simulated agents, against a local redis. Reports
+# requests/sec and latency percentiles for a single worker.
+#
+#   python -m benchmarks.ingest --redis redis://localhost:6379/15 --agents 20000 --requests 50000
+#
+# The target database is flushed first.
+
+import argparse
+import random
+import time
+import falcon
+from falcon.testing import TestClient
+
+from healthapp.agent import generate_payload
+from healthapp.server import ServerStatus
+from healthapp.ingest import StatusRecorder, HeartbeatBuffer
+from healthapp.history import HeartbeatHistory
+from healthapp.metrics import InstrumentedRedis, RequestMetrics
+from common import get_redis
+
+api_key = 'benchmark'
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--agents', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--changed', type=float, default=0.01, help='fraction of posts whose stats changed')
+    parser.add_argument('--history-days', type=int, default=7, help='0 to not record heartbeat history')
+    parser.add_argument('--batch', type=float, help='buffer posts and flush them every this many seconds')
+    parser.add_argument('--no-metrics', action='store_true', help='leave out request and redis metrics')
+    args = parser.parse_args()
+
+    r = get_redis(args.redis)
+    middleware = []
+    if not args.no_metrics:
+        r = InstrumentedRedis.from_url(args.redis)
+        middleware.append(RequestMetrics())
+
+    recorder = StatusRecorder(r, 300, HeartbeatHistory(args.history_days, 90))
+    buffer = HeartbeatBuffer(recorder, args.batch, 1000) if args.batch else None
+
+    app = falcon.API(middleware=middleware)
+    app.add_route('/api/v0/status/{server_name}', ServerStatus(r, api_key, recorder, buffer))
+    client = TestClient(app)
+
+    stats = {'OS': 'Linux', 'Kernel': '4.4.0-97-generic'}
+    names = ['server%s.example.com' % i for i in xrange(args.agents)]
+    payload = generate_payload(stats, api_key)
+    changed_payloads = [generate_payload(dict(stats, Kernel=str(i)), api_key) for i in xrange(100)]
+
+    latencies = []
+    start = time.time()
+    for i in xrange(args.requests):
+        name = names[i % args.agents]
+        body = random.choice(changed_payloads) if random.random() < args.changed else payload
+
+        request_start = time.time()
+        result = client.simulate_post('/api/v0/status/' + name, body=body['body'], headers=body['headers'])
+        latencies.append(time.time() - request_start)
+
+        assert result.status_code == 200, result.status
+    if buffer:
+        buffer.flush()
+    duration = time.time() - start
+
+    latencies.sort()
+    print 'requests: %s' % args.requests
+    print 'req/s: %.0f' % (args.requests / duration)
+    print 'p50: %.2f ms' % (percentile(latencies, 50) * 1000)
+    print 'p99: %.2f ms' % (percentile(latencies, 99) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Measure alerter run time and redis round trips when a large part of the
+# fleet goes stale at once, stays down, then comes back.
+#
+#   python -m benchmarks.mass_outage --redis redis://localhost:6379/15 --servers 5000
+#
+# The target database is flushed first.
+
+import argparse
+import logging
+import time
+import ujson
+
+from healthapp.constants import key_map
+from healthapp.alerter import AlertProcessor
+from common import CountingRedis, get_redis, timed
+
+
+def populate(r, server_count, last_post):
+    pipe = r.pipeline(transaction=False)
+    for i in xrange(server_count):
+        server_name = 'server%s.example.com' % i
+        pipe.set(key_map['server_info'].format(server_name=server_name), ujson.dumps({'OS': 'Linux', 'Kernel': '4.4.0'}))
+        pipe.zadd(key_map['server_last_posts'], last_post, server_name)
+    pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--servers', type=int, default=5000)
+    args = parser.parse_args()
+
+    # the alerter logs a line per alert
+    logging.getLogger().setLevel(logging.WARNING)
+
+    r = get_redis(args.redis)
+    counting = CountingRedis(r)
+    processor = AlertProcessor(counting, {'server_staleness_duration': 300})
+
+    populate(r, args.servers, int(time.time()) - 600)
+
+    print '%10s %12s %12s' % ('run', 'round trips', 'ms')
+    for phase in ('outage', 'ongoing', 'recovery'):
+        if phase == 'recovery':
+            populate(r, args.servers, int(time.time()))
+        counting.reset()
+        duration, _ = timed(processor.run_once)
+        print '%10s %12s %12.1f' % (phase, counting.round_trips, duration * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Measure the redis memory each server's info and each alert costs, stored
+# a key each as before, moved into compact storage by migrate-storage, and
+# written to compact storage from the start.
+#
+#   python -m benchmarks.schema_memory --redis redis://localhost:6379/15 --servers 100000
+#
+# Memory is redis' used_memory before and after, so includes its per key
+# overhead. Alerts are created and closed through the alerter's own code
+# and include their entries in the alert histories. The target database is
+# flushed between runs.
+
+import time
+import argparse
+from collections import Counter
+
+from healthapp.constants import key_map
+from healthapp.alerter import AlertTransitions
+from healthapp.storage import StorageMigration, write_server_infos
+from common import get_redis, timed
+
+info = '{"Kernel":"4.4.0-97-generic","OS":"Linux"}'
+
+
+def used_memory(r):
+    return r.info('memory')['used_memory']
+
+
+def write_servers(r, server_names, compact):
+    for start in xrange(0, len(server_names), 1000):
+        pipe = r.pipeline(transaction=False)
+        write_server_infos(pipe, dict((server_name, info) for server_name in server_names[start:start + 1000]), compact)
+        pipe.execute()
+
+
+def write_alerts(r, server_names, alert_count, compact):
+    '''alert_count alerts, opened and closed a batch of servers at a time'''
+    now = int(time.time())
+    written = 0
+    while written < alert_count:
+        batch = server_names[:min(1000, alert_count - written)]
+        transitions = AlertTransitions(r, compact=compact)
+        created = []
+        for server_name in batch:
+            state_name = 'stale_%s' % server_name
+            created.append((state_name, transitions.create(state_name, {
+                'info': 'Server %s last reported on 2017-10-18 12:00:00' % server_name,
+                'server_name': server_name,
+                'last_post': now - 600,
+            })))
+        transitions.flush()
+        for state_name, alert_id in created:
+            transitions.close(state_name, alert_id)
+        transitions.flush()
+        written += len(batch)
+
+
+def encodings(r):
+    counts = Counter()
+    for pattern in (key_map['server_info_bucket'], key_map['alert_info_bucket']):
+        for key in r.scan_iter(pattern.format(bucket='*'), count=1000):
+            counts[r.object('encoding', key)] += 1
+    return ', '.join('%s %s' % (count, encoding) for encoding, count in counts.most_common()) or '-'
+
+
+def measure(r, server_names, alert_count, compact):
+    '''bytes per server and per alert'''
+    start = used_memory(r)
+    write_servers(r, server_names, compact)
+    servers = used_memory(r)
+    write_alerts(r, server_names, alert_count, compact)
+    alerts = used_memory(r)
+    return float(servers - start) / len(server_names), float(alerts - servers) / alert_count
+
+
+def migrate(r, batch_size):
+    '''used_memory before, once the servers were moved, and after'''
+    migration = StorageMigration(r, batch_size=batch_size)
+    memory = [used_memory(r)]
+    while True:
+        before = used_memory(r)
+        result = migration.step()
+        if not result:
+            return memory + [before]
+        if result[0] == 'alerts' and len(memory) == 1:
+            memory.append(before)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--servers', type=int, default=20000)
+    parser.add_argument('--alerts', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000, help='keys per migration batch')
+    args = parser.parse_args()
+
+    server_names = ['server%s.example.com' % i for i in xrange(args.servers)]
+    results = []
+
+    r = get_redis(args.redis)
+    results.append(('key per entity',) + measure(r, server_names, args.alerts, False))
+
+    duration, (start, servers, end) = timed(migrate, r, args.batch_size)
+    results.append(('migrated', results[0][1] - float(start - servers) / args.servers, results[0][2] - float(servers - end) / args.alerts))
+    print 'migrated %s servers and %s alerts in %.1fs, saving %.1fMB' % (args.servers, args.alerts, duration, (start - end) / 1024.0 / 1024)
+    print 'buckets: %s' % encodings(r)
+
+    r = get_redis(args.redis)
+    results.append(('compact',) + measure(r, server_names, args.alerts, True))
+    print 'buckets: %s' % encodings(r)
+
+    print '%20s %16s %16s' % ('storage', 'bytes/server', 'bytes/alert')
+    for name, per_server, per_alert in results:
+        print '%20s %16d %16d' % (name, per_server, per_alert)
+
+
+if __name__ == '__main__':
+    main()
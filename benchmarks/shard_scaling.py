@@ -0,0 +1,66 @@
+# Measure how alerter tick latency scales with the number of workers when
+# servers are split into shards. Each worker count gets a fresh fleet of
+# stale servers; the shards are dealt out to workers as AlertWorker would,
+# and a worker's tick is the time to run all of its shards once. Workers
+# are simulated one after another in this process, so the numbers show the
+# split of work rather than contention on redis.
+#
+#   python -m benchmarks.shard_scaling --redis redis://localhost:6379/15 --servers 20000 --shards 16
+#
+# The target database is flushed first.
+
+import argparse
+import logging
+import time
+import ujson
+
+from healthapp.constants import key_map
+from healthapp.alerter import AlertProcessor
+from healthapp.shards import server_shard_key
+from common import get_redis
+
+
+def populate(r, server_count, shards, last_post):
+    pipe = r.pipeline(transaction=False)
+    for i in xrange(server_count):
+        server_name = 'server%s.example.com' % i
+        pipe.set(key_map['server_info'].format(server_name=server_name), ujson.dumps({'OS': 'Linux', 'Kernel': '4.4.0'}))
+        pipe.zadd(server_shard_key('server_last_posts', server_name, shards), last_post, server_name)
+    pipe.execute()
+
+
+def tick(processors):
+    start = time.time()
+    for processor in processors:
+        processor.run_once()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--servers', type=int, default=20000)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    args = parser.parse_args()
+
+    # the alerter logs a line per alert
+    logging.getLogger().setLevel(logging.WARNING)
+
+    configs = {'server_staleness_duration': 300}
+
+    print '%8s %16s %16s' % ('workers', 'outage tick ms', 'ongoing tick ms')
+    for workers in [int(count) for count in args.workers.split(',')]:
+        r = get_redis(args.redis)
+        populate(r, args.servers, args.shards, int(time.time()) - 600)
+
+        processors = [AlertProcessor(r, configs, shard=shard, shards=args.shards) for shard in xrange(args.shards)]
+        assigned = [processors[worker::workers] for worker in xrange(workers)]
+
+        outage = max(tick(worker_processors) for worker_processors in assigned)
+        ongoing = max(tick(worker_processors) for worker_processors in assigned)
+        print '%8d %16.1f %16.1f' % (workers, outage * 1000, ongoing * 1000)
+
+
+if __name__ == '__main__':
+    main()
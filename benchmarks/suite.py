@@ -0,0 +1,254 @@
+# Benchmark suite: the main hot paths against a simulated fleet, in one run,
+# written out as JSON so runs before and after a change can be compared.
+#
+#   - ingest: agent posts through the falcon app in-process. req/s, p50/p99
+#     latency and redis commands per post
+#   - alerter: alert loop runs while part of the fleet has an outage, stays
+#     down, recovers, and flaps. time per phase and redis commands per run
+#   - lists: alert and server list endpoints as alert history grows.
+#     latency, round trips and redis commands
+#
+#   python -m benchmarks.suite --redis redis://localhost:6379/15 --output before.json
+#   python -m benchmarks.suite --redis redis://localhost:6379/15 --baseline before.json
+#
+# With --baseline, prints how each number changed and exits 1 if any got
+# worse by more than --tolerance. Timings are noisy, so compare runs from
+# the same machine. Needs a real redis, as the ingest scripts are Lua. The
+# target database is flushed between sections.
+
+import sys
+import time
+import argparse
+import logging
+import platform
+import subprocess
+
+import ujson
+import falcon
+from falcon.testing import TestClient
+
+from healthapp.server import ServerStatus, AlertList, ServerList
+from healthapp.ingest import StatusRecorder
+from healthapp.history import HeartbeatHistory
+from healthapp.alerter import AlertProcessor, alerter_phase_seconds
+from healthapp.metrics import InstrumentedRedis, RequestMetrics
+from common import get_redis, command_calls
+from fleet import Fleet, api_key, outage, flap
+from alert_list import populate as populate_alerts, call
+
+staleness = 300
+phases = ('stale_scan', 'firing_diff', 'write', 'notify', 'purge')
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def bench_ingest(redis_url, agents, requests):
+    get_redis(redis_url)
+    r = InstrumentedRedis.from_url(redis_url)
+    fleet = Fleet(agents)
+
+    recorder = StatusRecorder(r, staleness, HeartbeatHistory(7, 90))
+    app = falcon.API(middleware=[RequestMetrics()])
+    app.add_route('/api/v0/status/{server_name}', ServerStatus(r, api_key, recorder))
+    client = TestClient(app)
+
+    latencies = []
+    commands = command_calls(r)
+    start = time.time()
+    for i in xrange(requests):
+        request_start = time.time()
+        result = fleet.post(client, fleet.names[i % agents])
+        latencies.append(time.time() - request_start)
+        assert result.status_code == 200, result.status
+    duration = time.time() - start
+    commands = command_calls(r) - commands - 1
+
+    latencies.sort()
+    return {
+        'req_per_sec': requests / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'commands_per_request': float(commands) / requests,
+    }
+
+
+def phase_totals():
+    return dict((phase, alerter_phase_seconds.labels(phase).sum) for phase in phases)
+
+
+def run_alerter(r, processor):
+    before = phase_totals()
+    commands = command_calls(r)
+    start = time.time()
+    processor.run_once()
+    duration = time.time() - start
+    commands = command_calls(r) - commands - 1
+
+    after = phase_totals()
+    result = dict(('%s_ms' % phase, (after[phase] - before[phase]) * 1000) for phase in phases)
+    result['total_ms'] = duration * 1000
+    result['commands'] = commands
+    return result
+
+
+def bench_alerter(redis_url, agents, outage_fraction, flap_fraction, flap_ticks):
+    results = {}
+
+    for name, scenario in (('outage', outage), ('flap', flap)):
+        r = get_redis(redis_url)
+        fleet = Fleet(agents)
+        processor = AlertProcessor(r, {'server_staleness_duration': staleness})
+        fleet.set_last_posts(r, fleet.names, int(time.time()))
+
+        ticks = scenario(fleet, outage_fraction if name == 'outage' else flap_fraction)
+
+        if name == 'outage':
+            # went down, stayed down, came back
+            for run in ('start', 'ongoing', 'recovery'):
+                down, up = next(ticks)
+                now = int(time.time())
+                if run == 'recovery':
+                    down, up = set(), fleet.names
+                fleet.set_last_posts(r, down, now - 2 * staleness)
+                fleet.set_last_posts(r, up, now)
+                results['outage_%s' % run] = run_alerter(r, processor)
+        else:
+            runs = []
+            for tick in xrange(flap_ticks):
+                down, up = next(ticks)
+                now = int(time.time())
+                fleet.set_last_posts(r, down, now - 2 * staleness)
+                fleet.set_last_posts(r, up, now)
+                runs.append(run_alerter(r, processor))
+            # median of each number across the ticks
+            results['flap'] = dict((key, median([run[key] for run in runs])) for key in runs[0])
+
+    return results
+
+
+def bench_lists(redis_url, servers, history_sizes, repeats):
+    results = {}
+    for alert_count in history_sizes:
+        r = get_redis(redis_url)
+        populate_alerts(r, servers, alert_count)
+
+        for name, resource in (('alerts', AlertList(r, None)), ('servers', ServerList(r, staleness, None))):
+            durations = []
+            for i in xrange(repeats):
+                commands = command_calls(r)
+                counting, duration = call(resource, r)
+                commands = command_calls(r) - commands - 1
+                durations.append(duration)
+            results['%s_%s_alerts' % (name, alert_count)] = {
+                'ms': median(durations) * 1000,
+                'round_trips': counting.round_trips,
+                'commands': commands,
+            }
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s%s.' % (prefix, key)))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline, current, tolerance, min_ms):
+    '''Print each number against the baseline. Returns names of the ones which got worse.'''
+    old = flatten(baseline['results'])
+    new = flatten(current['results'])
+    regressions = []
+
+    print '%-50s %12s %12s %8s' % ('metric', 'baseline', 'current', 'change')
+    for key in sorted(set(old) | set(new)):
+        if key not in old or key not in new:
+            print '%-50s %12s %12s' % (key, old.get(key, '-'), new.get(key, '-'))
+            continue
+
+        change = (new[key] - old[key]) / float(old[key]) if old[key] else 0.0
+        higher_is_better = key.endswith('req_per_sec')
+        worse = -change if higher_is_better else change
+        flag = ''
+        # sub millisecond timings are mostly noise
+        if worse > tolerance and not (key.endswith('_ms') and max(old[key], new[key]) < min_ms):
+            flag = '  WORSE'
+            regressions.append(key)
+        print '%-50s %12.2f %12.2f %+7.1f%%%s' % (key, old[key], new[key], change * 100, flag)
+
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open('/dev/null', 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--agents', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=10000, help='agent posts in the ingest section')
+    parser.add_argument('--outage', type=float, default=0.3, help='fraction of the fleet which goes down')
+    parser.add_argument('--flap', type=float, default=0.05, help='fraction of the fleet which flaps')
+    parser.add_argument('--flap-ticks', type=int, default=6)
+    parser.add_argument('--alerts', default='100,1000,10000', help='alert history sizes for the lists section')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--sections', default='ingest,alerter,lists')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='how much worse a number may get before it counts')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='ignore timings shorter than this')
+    args = parser.parse_args()
+
+    # the alerter logs a line per alert
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sections = args.sections.split(',')
+    results = {}
+    if 'ingest' in sections:
+        results['ingest'] = bench_ingest(args.redis, args.agents, args.requests)
+    if 'alerter' in sections:
+        results['alerter'] = bench_alerter(args.redis, args.agents, args.outage, args.flap, args.flap_ticks)
+    if 'lists' in sections:
+        results['lists'] = bench_lists(args.redis, min(args.agents, 100), [int(x) for x in args.alerts.split(',')], args.repeats)
+
+    run = {
+        'meta': {
+            'revision': git_revision(),
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as h:
+            h.write(ujson.dumps(run, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as h:
+            baseline = ujson.loads(h.read())
+        regressions = compare(baseline, run, args.tolerance, args.min_ms)
+        if regressions:
+            print '%s numbers worse than %s by more than %d%%' % (len(regressions), args.baseline, args.tolerance * 100)
+            sys.exit(1)
+    elif not args.output:
+        print ujson.dumps(run, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,22 @@
 # Run one of these on each server that needs to be monitored
 
+import argparse
 import requests
 import socket
 import time
 import logging
 import ujson
 import os
-import hmac
-import hashlib
-import base64
 import platform
+import hashlib
+import random
 from config import process_config
 from service import daemon_init
+from collectors import load_collectors
+from integrity import sign
+from constants import (default_agent_run_interval, default_agent_full_post_interval, default_agent_jitter,
+                       default_agent_timeout, default_relay_address, default_relay_flush_interval,
+                       default_server_staleness_duration, default_max_status_body_size, default_max_batch_body_size)
 
 logger = logging.getLogger()
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
@@ -26,52 +31,204 @@ logger.setLevel(logging.INFO)
 logger.addHandler(ch)
 
 
-def get_stats():
-    return {
+def get_stats(collectors=()):
+    '''Stats to post, and the names of those which came from volatile collectors'''
+    stats = {
         'OS': platform.system(),
         'Kernel': platform.release()
     }
+    volatile = set()
+
+    for collector in collectors:
+        try:
+            collected = collector.collect()
+        except Exception:
+            logger.exception('Collector %s failed', collector.__class__.__name__)
+            continue
+        stats.update(collected)
+        if collector.volatile:
+            volatile.update(collected)
+
+    return stats, volatile
+
+
+def stable_hash(stats, volatile):
+    return hashlib.sha1(ujson.dumps(dict((name, value) for name, value in stats.iteritems() if name not in volatile),
+                                    sort_keys=True)).hexdigest()
 
 
 def generate_payload(stats, api_key):
-    body = ujson.dumps(stats)
-    hmac_obj = hmac.new(api_key, body, hashlib.sha512)
+    # sorted so unchanged stats always give the same body, and hash
+    body = ujson.dumps(stats, sort_keys=True)
     headers = {
-        'X-INTEGRITY': base64.urlsafe_b64encode(hmac_obj.digest())
+        'X-INTEGRITY': sign(api_key, body)
     }
     return {
         'body': body,
-        'headers': headers
+        'headers': headers,
+        'hash': hashlib.sha1(body).hexdigest()
     }
 
 
+def monotonic():
+    # python 2 has no time.monotonic. os.times()' elapsed real time comes from
+    # times(2), which counts clock ticks and so never jumps with the wall clock.
+    return os.times()[4]
+
+
+class ApiClient(object):
+    '''
+    Posts to the API over one keep-alive session, failing over between
+    api_urls in order. Sticks with whichever url last worked.
+    '''
+
+    def __init__(self, api_urls, api_key, hostname, timeout):
+        self.api_urls = api_urls
+        self.api_key = api_key
+        self.hostname = hostname
+        self.timeout = timeout
+        self.current = 0
+        self.session = requests.Session()
+
+    def post(self, route, payload):
+        for attempt in xrange(len(self.api_urls)):
+            api_url = self.api_urls[self.current]
+            url = '%s/api/v0/%s/%s' % (api_url, route, self.hostname)
+            try:
+                r = self.session.post(url, data=payload['body'], headers=payload['headers'], timeout=self.timeout)
+                if r.status_code < 500:
+                    return r
+                r.raise_for_status()
+            except requests.RequestException as e:
+                if attempt == len(self.api_urls) - 1:
+                    raise
+                self.current = (self.current + 1) % len(self.api_urls)
+                logger.warning('Failed posting to %s (%s). Failing over to %s', url, e, self.api_urls[self.current])
+
+    def send_status(self, payload):
+        r = self.post('status', payload)
+        r.raise_for_status()
+
+    def send_keepalive(self, info_hash):
+        '''
+        Tell the API we're alive and our stats still hash to info_hash. Returns
+        False if it wants our full stats instead, or refused the keepalive.
+        '''
+        payload = generate_payload({'hash': info_hash, 'time': int(time.time())}, self.api_key)
+        r = self.post('heartbeat', payload)
+
+        # 412: stored info differs from ours. 404: API predates keepalives. any
+        # other refusal, eg 400 for a keepalive whose time is off because our
+        # clock is, mustn't leave us looking stale either, so post in full.
+        if not r.ok:
+            if r.status_code not in (404, 412):
+                logger.warning('Keepalive refused (%s %s). Posting in full', r.status_code, r.text[:200])
+            return False
+
+        return True
+
+
+def next_delay(interval, jitter, failures, max_backoff):
+    '''
+    Seconds from one scheduled run to the next. Normally interval, give or
+    take up to jitter * interval. After consecutive failures, back off
+    exponentially up to max_backoff, picking a random point in that window
+    so a fleet which failed together doesn't retry together.
+    '''
+    if failures:
+        return random.uniform(interval, min(max_backoff, interval * 2 ** failures))
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+def validate_backoff(max_backoff, server_staleness_duration):
+    # agents still backing off once the API is back keep looking stale, and
+    # the alerter would open an alert for every one of them
+    if max_backoff <= 0 or max_backoff * 2 > server_staleness_duration:
+        raise ValueError('agent_max_backoff must be positive and at most half of server_staleness_duration (%s)'
+                         % server_staleness_duration)
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--relay', action='store_true', help='forward posts of the agents pointed at us in batches, instead of posting our own')
+    args = parser.parse_args()
+
     configs = process_config()
     daemon_init(configs)
 
-    api_url = configs.get('api_url', 'http://localhost:8000')
+    api_urls = configs.get('api_url', 'http://localhost:8000')
     api_key = configs.get('api_key')
 
     if not api_key:
         logger.critical('no api_key found in config')
         return
 
+    if not isinstance(api_urls, list):
+        api_urls = [api_urls]
+
     api_key = str(api_key)
     hostname = socket.getfqdn()
 
-    url = '%s/api/v0/status/%s' % (api_url, hostname)
-    interval = 60
+    if args.relay:
+        # imported here so plain agents don't need the API's dependencies
+        from relay import run_relay
+        client = ApiClient(api_urls, api_key, hostname, configs.get('agent_timeout', default_agent_timeout))
+        run_relay(client, api_key, configs.get('relay_address', default_relay_address),
+                  configs.get('relay_flush_interval', default_relay_flush_interval),
+                  configs.get('server_staleness_duration', default_server_staleness_duration),
+                  configs.get('max_status_body_size', default_max_status_body_size),
+                  configs.get('max_batch_body_size', default_max_batch_body_size))
+        return
+
+    interval = configs.get('agent_interval', default_agent_run_interval)
+    jitter = configs.get('agent_jitter', default_agent_jitter)
+    server_staleness_duration = configs.get('server_staleness_duration', default_server_staleness_duration)
+    max_backoff = configs.get('agent_max_backoff', server_staleness_duration // 2)
+    validate_backoff(max_backoff, server_staleness_duration)
+    client = ApiClient(api_urls, api_key, hostname, configs.get('agent_timeout', default_agent_timeout))
+    collectors = load_collectors(configs.get('agent_collectors', []))
+
+    # while our stats are unchanged we just send the hash of those we last
+    # posted, but still post them in full every so often in case the stored
+    # copy drifted. changes to volatile stats alone wait for that.
+    full_post_interval = configs.get('agent_full_post_interval', default_agent_full_post_interval)
+    last_hash = None
+    last_stable_hash = None
+    last_full_post = 0
+    failures = 0
+
+    # start at a random point in the interval so agents restarted together
+    # spread out. runs are scheduled against the monotonic clock so time
+    # spent posting doesn't make us drift.
+    next_run = monotonic() + random.uniform(0, interval)
+
     while True:
-        payload = generate_payload(get_stats(), api_key)
+        delay = max(0, next_run - monotonic())
+        logger.info('Sleeping %.1f until next iteration', delay)
+        time.sleep(delay)
+
+        stats, volatile = get_stats(collectors)
+        current_stable_hash = stable_hash(stats, volatile)
         try:
-            r = requests.post(url, data=payload['body'], headers=payload['headers'])
-            r.raise_for_status()
-            logger.info('Posted status to %s successfully', url)
+            if current_stable_hash == last_stable_hash and time.time() - last_full_post < full_post_interval and \
+                    client.send_keepalive(last_hash):
+                logger.info('Sent keepalive successfully')
+            else:
+                payload = generate_payload(stats, api_key)
+                client.send_status(payload)
+                last_hash = payload['hash']
+                last_stable_hash = current_stable_hash
+                last_full_post = time.time()
+                logger.info('Posted status successfully')
+            failures = 0
         except Exception:
+            failures += 1
             logger.exception('Failed posting')
 
-        logger.info('Sleeping %s until next iteration', interval)
-        time.sleep(interval)
+        next_run += next_delay(interval, jitter, failures, max_backoff)
+
+        # don't try to catch up on runs we missed, eg after being suspended
+        next_run = max(next_run, monotonic())
 
 
 if __name__ == '__main__':
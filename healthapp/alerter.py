@@ -1,18 +1,25 @@
 # stateful service which monitors server status in redis
 # and keeps track of alerts and alerting
 
-import redis
 import time
+import ujson
 import uuid
 import logging
 import os
-from datetime import datetime
-from collections import defaultdict
+import sys
+import signal
+from collections import Counter
 
-from constants import key_map, default_alert_process_interval, default_server_staleness_duration
-from notify import notify_alert_new, notify_alert_closed, notify_ongoing_alert
+from constants import (key_map, default_alert_process_interval, default_server_staleness_duration, default_alert_full_scan_interval,
+                       default_alerter_lease_ttl, default_alerter_metrics_address)
+from notify import notify_alert_new, notify_alert_closed, notify_ongoing_alert, flush_notifications
 from config import process_config
 from service import daemon_init
+from retention import AlertPurger
+from leader import LeaderLease, LostLeadership, fenced_pipeline, execute_fenced, worker_identity, lease_holder
+from shards import shard_of, shard_key, all_shard_keys, state_server_name
+from metrics import registry, Stopwatch, InstrumentedRedis, serve_metrics
+from storage import stale_info, short_alert_id, alert_info_bucket, pack_alert, unpack_alert, write_alert
 
 logger = logging.getLogger()
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
@@ -26,157 +33,748 @@ ch.setFormatter(formatter)
 logger.setLevel(logging.INFO)
 logger.addHandler(ch)
 
-
-def get_bad_states(r, server_staleness_duration):
+alerter_run_seconds = registry.histogram(
+    'healthapp_alerter_run_seconds', 'Duration of alert loop runs, by shard', ['shard'])
+alerter_phase_seconds = registry.histogram(
+    'healthapp_alerter_phase_seconds', 'Duration of each phase of alert loop runs', ['phase'])
+alerter_transitions = registry.counter(
+    'healthapp_alerter_transitions_total', 'Alerts created, closed and purged, and ongoing alert notifications', ['transition'])
+alerter_firing = registry.gauge(
+    'healthapp_alerter_firing_alerts', 'Alerts firing as of the last run, by shard', ['shard'])
+
+
+def get_bad_states(r, good_time, since=None, last_posts_key=key_map['server_last_posts']):
+    '''
+    Servers which haven't posted since good_time. If since is given, only
+    those whose last post was after it, ie the ones which went stale since
+    the previous run.
+    '''
     bad_states = {}
 
-    good_time = int(time.time() - server_staleness_duration)
-    for server, value in r.zrevrangebyscore(key_map['server_last_posts'], good_time, 0, score_cast_func=int, withscores=True):
-        key = 'stale_%s' % server
-        bad_states[key] = {
-            'info': 'Server %s last reported on %s' % (server, datetime.fromtimestamp(value)),
-            'server_name': server
-        }
+    min_time = '(%s' % since if since is not None else 0
+    for server, value in r.zrevrangebyscore(last_posts_key, good_time, min_time, score_cast_func=int, withscores=True):
+        bad_states['stale_%s' % server] = bad_state(server, value)
 
     return bad_states
 
 
-def generate_alert_id(state_name):
-    return '%s_%s' % (state_name, uuid.uuid4())
-
-
-def create_alert(r, state_name, description):
-    now = time.time()
-    alert_id = generate_alert_id(state_name)
-
-    description['start_time'] = now
-    description['end_time'] = -1
-    description['state_name'] = state_name
-
-    # first, save new alert
-    r.hmset(key_map['alert_info'].format(alert_id=alert_id), description)
-
-    # then log that alert record in our list of alerts
-    r.zadd(key_map['alerts_historical'], now, alert_id)
-
-    # likewise for alerts per this server
-    r.zadd(key_map['server_alerts'].format(server_name=description['server_name']), now, alert_id)
-
-    # then map this alert state name to the currently firing list of alerts
-    r.hset(key_map['alert_currently_firing'], state_name, alert_id)
-
-    return alert_id
+def bad_state(server, last_post):
+    return {
+        'info': stale_info(server, last_post),
+        'server_name': server,
+        'last_post': last_post
+    }
 
 
-def close_alert(r, state_name, alert_id):
-    now = time.time()
+def validate_hysteresis(open_ticks, close_ticks, close_staleness, server_staleness_duration):
+    if open_ticks < 1 or close_ticks < 1:
+        raise ValueError('alert_open_ticks and alert_close_ticks must be at least 1')
+    if not 0 < close_staleness <= server_staleness_duration:
+        raise ValueError('alert_close_staleness must be positive and at most server_staleness_duration (%s)' % server_staleness_duration)
 
-    # first, take this alert out of our list of ongoing alerts
-    r.hdel(key_map['alert_currently_firing'], state_name)
 
-    alert_key = key_map['alert_info'].format(alert_id=alert_id)
-
-    # alert might not be real anymore. don't create it if it's been deleted.
-    if not r.exists(alert_key):
-        return
+def generate_alert_id(state_name):
+    return '%s_%s' % (state_name, uuid.uuid4())
 
-    # then, update its status as closed
-    r.hset(alert_key, 'end_time', now)
 
-    # get start time
-    start_time = r.hget(alert_key, 'start_time')
+class AlertTransitions(object):
+    '''
+    Collects the alert state changes of one run and applies them together:
+    one pipelined read for the start times of closing alerts, then a single
+    MULTI/EXEC for every write. A crash part way through a run can't leave
+    alerts half created or half closed. Given the leader lease, the write
+    only goes through if we're still leader. With compact, new alerts go
+    to compact storage, see storage.py.
+
+    Given ticks_key, consecutive bad or good runs of servers on their way to
+    opening or closing an alert are written there along with everything
+    else. Given recently_closed_key, closed alerts are remembered there so a
+    quick reopening can carry on the same alert instead of starting another.
+    '''
+
+    def __init__(self, r, lease=None, firing_key=key_map['alert_currently_firing'], compact=False,
+                 ticks_key=None, recently_closed_key=None):
+        self.r = r
+        self.lease = lease
+        self.firing_key = firing_key
+        self.compact = compact
+        self.ticks_key = ticks_key
+        self.recently_closed_key = recently_closed_key
+        self.created = []
+        self.closed = []
+        self.reopened = []
+        self.emailed = []
+        self.ticks = {}
+        self.settled = []
+        self.cleared = []
+
+    def __len__(self):
+        return len(self.created) + len(self.closed) + len(self.reopened) + len(self.emailed) + len(self.ticks) + len(self.settled) + \
+            len(self.cleared)
+
+    def create(self, state_name, description):
+        alert_id = short_alert_id() if self.compact else generate_alert_id(state_name)
+        self.created.append((state_name, alert_id, description))
+        return alert_id
+
+    def close(self, state_name, alert_id):
+        self.closed.append((state_name, alert_id))
+
+    def reopen(self, state_name, alert_id, description):
+        self.reopened.append((state_name, alert_id, description))
+
+    def ongoing_email_sent(self, alert_id):
+        self.emailed.append(alert_id)
+
+    def set_ticks(self, state_name, ticks):
+        '''Record a state's consecutive bad (positive) or good (negative) runs. None to forget them.'''
+        self.ticks[state_name] = ticks
+
+    def settle(self, state_name):
+        '''Stop remembering a recently closed alert'''
+        self.settled.append(state_name)
+
+    def clear(self, key):
+        '''Delete a key along with everything else, eg one a feature turned off since left behind'''
+        self.cleared.append(key)
+
+    def stored(self, alert_ids):
+        '''
+        (exists, start time, packed) of each alert as stored, as they're
+        closed or reopened in whichever storage they were created in
+        '''
+        if not alert_ids:
+            return []
+
+        pipe = self.r.pipeline(transaction=False)
+        for alert_id in alert_ids:
+            alert_key = key_map['alert_info'].format(alert_id=alert_id)
+            pipe.exists(alert_key)
+            pipe.hget(alert_key, 'start_time')
+            if self.compact:
+                pipe.hget(alert_info_bucket(alert_id), alert_id)
+        results = pipe.execute()
+
+        if self.compact:
+            return zip(results[::3], results[1::3], results[2::3])
+        return [(exists, start_time, None) for exists, start_time in zip(results[::2], results[1::2])]
+
+    def flush(self):
+        '''
+        Write out all queued transitions. Returns list of (state_name,
+        alert_id, duration) for the alerts which were actually closed.
+        '''
+        if not self:
+            return []
+
+        now = time.time()
+
+        stored = self.stored([alert_id for state_name, alert_id in self.closed] +
+                             [alert_id for state_name, alert_id, description in self.reopened])
+        closed_stored, reopened_stored = stored[:len(self.closed)], stored[len(self.closed):]
+
+        pipe = fenced_pipeline(self.r, self.lease)
+
+        for state_name, alert_id, description in self.created:
+            description['start_time'] = now
+            description['end_time'] = -1
+            description['state_name'] = state_name
+
+            # first, save new alert
+            write_alert(pipe, alert_id, description, self.compact)
+
+            # then log that alert record in our list of alerts
+            pipe.zadd(key_map['alerts_historical'], now, alert_id)
+
+            # likewise for alerts per this server
+            pipe.zadd(key_map['server_alerts'].format(server_name=description['server_name']), now, alert_id)
+
+            # then map this alert state name to the currently firing list of alerts
+            pipe.hset(self.firing_key, state_name, alert_id)
+
+            # the first ongoing email is due an interval after it started
+            pipe.hset(key_map['alert_ongoing_emails'], alert_id, int(now))
+
+            # and tell the web UI
+            self.publish_opened(pipe, state_name, alert_id, description)
+
+        for (state_name, alert_id, description), (exists, start_time, packed) in zip(self.reopened, reopened_stored):
+            pipe.hdel(self.recently_closed_key, state_name)
+
+            # purged since it closed. the next run opens a new one.
+            if not exists and not packed:
+                continue
+
+            # ongoing again, keeping its start time
+            if packed:
+                info = unpack_alert(packed)
+                info['end_time'] = -1
+                info['last_post'] = description.get('last_post', info['last_post'])
+                pipe.hset(alert_info_bucket(alert_id), alert_id, pack_alert(info))
+            else:
+                alert_key = key_map['alert_info'].format(alert_id=alert_id)
+                pipe.hmset(alert_key, {'end_time': -1, 'info': description.get('info', '')})
+                pipe.hdel(alert_key, 'duration')
+            pipe.hset(self.firing_key, state_name, alert_id)
+            pipe.hset(key_map['alert_ongoing_emails'], alert_id, int(now))
+            self.publish_opened(pipe, state_name, alert_id, description)
+
+        for alert_id in self.emailed:
+            pipe.hset(key_map['alert_ongoing_emails'], alert_id, int(now))
+
+        closed = []
+        for (state_name, alert_id), (exists, start_time, packed) in zip(self.closed, closed_stored):
+
+            # take this alert out of our list of ongoing alerts
+            pipe.hdel(self.firing_key, state_name)
+            pipe.hdel(key_map['alert_ongoing_emails'], alert_id)
+
+            # alert might not be real anymore. don't create it if it's been deleted.
+            if not exists and not packed:
+                continue
+
+            # update its status as closed and record duration
+            if packed:
+                info = unpack_alert(packed)
+                info['end_time'] = now
+                duration = now - info['start_time']
+                pipe.hset(alert_info_bucket(alert_id), alert_id, pack_alert(info))
+            else:
+                duration = now - float(start_time or 0)
+                pipe.hmset(key_map['alert_info'].format(alert_id=alert_id), {'end_time': now, 'duration': duration})
+            pipe.publish(key_map['events'], ujson.dumps({'type': 'alert_closed', 'alert_id': alert_id}))
+            closed.append((state_name, alert_id, duration))
+
+            if self.recently_closed_key:
+                pipe.hset(self.recently_closed_key, state_name, '%s %d %d' % (alert_id, now, duration))
+
+        if self.settled and self.recently_closed_key:
+            pipe.hdel(self.recently_closed_key, *self.settled)
+
+        changed = dict((state_name, ticks) for state_name, ticks in self.ticks.iteritems() if ticks is not None)
+        if changed and self.ticks_key:
+            pipe.hmset(self.ticks_key, changed)
+        forgotten = [state_name for state_name, ticks in self.ticks.iteritems() if ticks is None]
+        if forgotten and self.ticks_key:
+            pipe.hdel(self.ticks_key, *forgotten)
+
+        if self.cleared:
+            pipe.delete(*self.cleared)
+
+        # just tick counts don't change what the web UI shows
+        if self.created or self.closed or self.reopened or self.emailed:
+            pipe.incr(key_map['alerts_version'])
+        execute_fenced(pipe)
+
+        self.created = []
+        self.closed = []
+        self.reopened = []
+        self.emailed = []
+        self.ticks = {}
+        self.settled = []
+        self.cleared = []
+
+        return closed
+
+    def publish_opened(self, pipe, state_name, alert_id, description):
+        # tell the web UI
+        if state_name.startswith('stale_'):
+            pipe.publish(key_map['events'], ujson.dumps({'type': 'server_stale', 'server': description['server_name']}))
+        pipe.publish(key_map['events'], ujson.dumps({
+            'type': 'alert_opened',
+            'alert_id': alert_id,
+            'server': description['server_name']
+        }))
+
+
+def parse_recently_closed(value):
+    '''alert id, when it closed and its duration, from a recently closed hash value'''
+    alert_id, closed_at, duration = value.rsplit(' ', 2)
+    return alert_id, int(closed_at), int(duration)
+
+
+def wait_for_recoveries(pubsub, timeout, recovered):
+    '''
+    Block for timeout seconds, calling recovered(channel, server_name) for
+    each server the API tells us has started reporting again as soon as we
+    hear about it.
+    '''
+    until = time.time() + timeout
 
-    if start_time:
-        start_time = float(start_time)
-    else:
-        start_time = 0
+    while True:
+        remaining = until - time.time()
+        if remaining <= 0:
+            return
 
-    # record duration
-    duration = now - start_time
-    r.hset(alert_key, 'duration', duration)
+        message = pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+        if not message:
+            continue
 
-    # send notifications
-    notify_alert_closed(state_name, alert_id, duration)
+        recovered(message['channel'], message['data'])
 
 
-def should_send_ongoing_alert(last_ongoing_alert_email, alert_send_email_interval, alert_id):
+def should_send_ongoing_alert(last_ongoing_alert_email, alert_send_email_interval, alert_id, now):
     if not alert_send_email_interval or alert_send_email_interval == -1:
         return False
 
-    now = int(time.time())
-
-    if (now - last_ongoing_alert_email[alert_id]) > alert_send_email_interval:
-        last_ongoing_alert_email[alert_id] = now
-        return True
-
-    return False
-
-
-def main():
-    configs = process_config()
-    daemon_init(configs)
-
-    redis_url = configs.get('redis', 'localhost:6379')
-    alert_process_interval = configs.get('alert_process_interval', default_alert_process_interval)
-    server_staleness_duration = configs.get('server_staleness_duration', default_server_staleness_duration)
-    alert_send_email_interval = configs.get('alert_send_email_interval', -1)
-
-    r = redis.StrictRedis.from_url(redis_url)
-
-    last_ongoing_alert_email = defaultdict(int)
-
-    while True:
-        logger.info('Starting alert run..')
+    return (now - int(last_ongoing_alert_email.get(alert_id) or 0)) > alert_send_email_interval
+
+
+class AlertProcessor(object):
+    '''
+    Holds the alert loop's configuration and the state it carries between
+    runs for one shard of servers. run_once() does one pass of the loop.
+    Given the shard's lease, runs only write while it's held.
+    '''
+
+    def __init__(self, r, configs, lease=None, shard=0, shards=1):
+        self.r = r
+        self.lease = lease
+        self.shard = shard
+        self.shards = shards
+        self.alert_process_interval = configs.get('alert_process_interval', default_alert_process_interval)
+        self.server_staleness_duration = configs.get('server_staleness_duration', default_server_staleness_duration)
+        self.alert_send_email_interval = configs.get('alert_send_email_interval', -1)
+        self.alert_incremental_staleness = configs.get('alert_incremental_staleness', False)
+        self.alert_full_scan_interval = configs.get('alert_full_scan_interval', default_alert_full_scan_interval)
+        self.compact = configs.get('compact_storage', False)
+
+        # hysteresis: an alert opens once its server has been stale for
+        # alert_open_ticks runs in a row, and closes once it's posted within
+        # alert_close_staleness (at most server_staleness_duration) for
+        # alert_close_ticks runs in a row. alerts which open again within
+        # alert_flap_window seconds of closing carry on where they left off,
+        # and their closing is only notified once they've stayed closed that long.
+        self.alert_open_ticks = configs.get('alert_open_ticks', 1)
+        self.alert_close_ticks = configs.get('alert_close_ticks', 1)
+        self.alert_close_staleness = configs.get('alert_close_staleness', self.server_staleness_duration)
+        self.alert_flap_window = configs.get('alert_flap_window', 0)
+        validate_hysteresis(self.alert_open_ticks, self.alert_close_ticks, self.alert_close_staleness, self.server_staleness_duration)
+        self.close_hysteresis = self.alert_close_ticks > 1 or self.alert_close_staleness < self.server_staleness_duration
+        self.hysteresis = self.alert_open_ticks > 1 or self.close_hysteresis
+        self.damped = self.hysteresis or bool(self.alert_flap_window)
+
+        self.last_posts_key = shard_key('server_last_posts', shard, shards)
+        self.firing_key = shard_key('alert_currently_firing', shard, shards)
+        self.recovery_channel = shard_key('server_recovered', shard, shards)
+        self.ticks_key = shard_key('alert_ticks', shard, shards)
+        self.recently_closed_key = shard_key('alert_recently_closed', shard, shards)
+
+        # tick counts and recently closed alerts left behind by hysteresis or
+        # flap merging since turned off, deleted by the first run. alerts whose
+        # closing was held back by the flap window get it sent then.
+        self.leftovers = [key for key, used in ((self.ticks_key, self.hysteresis), (self.recently_closed_key, self.alert_flap_window))
+                          if not used and r.exists(key)]
+
+        # alert history is shared by all shards, so only the first purges it
+        self.purger = AlertPurger.from_configs(r, configs, lease) if shard == 0 else None
+
+        # in incremental mode, each run only looks at servers which went stale
+        # since the previous run's cutoff, and recoveries are pushed to us by the
+        # API as they happen. a periodic full scan catches anything missed, eg
+        # recoveries published while we weren't listening, or while another
+        # alerter had this shard.
+        self.last_full_scan = 0
+        self.watermark = None
+
+    def run_once(self):
+        r = self.r
+        logger.info('Starting alert run of shard %s..', self.shard)
 
         loop_start = time.time()
-        closed_alerts = 0
+        phases = Stopwatch(alerter_phase_seconds)
         ongoing_alerts = 0
         new_alerts = 0
-
-        # all currently bad alerts are here. dict of bad alert state name to info on that state
-        bad_states = get_bad_states(r, server_staleness_duration)
+        reopened_alerts = 0
+        firing_ids = set()
+        ongoing = []
+        settled = []
+        transitions = self.transitions()
+
+        good_time = int(loop_start - self.server_staleness_duration)
+        full_scan = not self.alert_incremental_staleness or loop_start - self.last_full_scan >= self.alert_full_scan_interval
+
+        # with a lower close threshold, scan down to that. servers between it and
+        # server_staleness_duration keep their alerts open but don't open new ones.
+        close_good_time = int(loop_start - self.alert_close_staleness)
+
+        # all currently bad alerts are here. dict of bad alert state name to info on that state.
+        # when scanning incrementally, just the newly bad ones.
+        if full_scan:
+            bad_states = get_bad_states(r, close_good_time, last_posts_key=self.last_posts_key)
+            self.last_full_scan = loop_start
+        else:
+            bad_states = get_bad_states(r, close_good_time, self.watermark, self.last_posts_key)
+        # servers between the two thresholds aren't alerted on yet, so keep
+        # scanning them until they cross server_staleness_duration
+        self.watermark = good_time
+        phases.lap('stale_scan')
+
+        if self.damped or self.leftovers:
+            pipe = r.pipeline(transaction=False)
+            pipe.hgetall(self.firing_key)
+            pipe.hgetall(self.ticks_key)
+            pipe.hgetall(self.recently_closed_key)
+            firing, ticks, recently_closed = pipe.execute()
+            ticks = dict((state_name, int(count)) for state_name, count in ticks.iteritems()) if self.hysteresis else {}
+            for key in self.leftovers:
+                transitions.clear(key)
+            self.leftovers = []
+        else:
+            firing = r.hgetall(self.firing_key)
+            ticks = {}
+            recently_closed = {}
+
+        # an incremental run only sees servers which just went stale. with
+        # hysteresis, look up the others we're counting runs of too.
+        judged = full_scan
+        if self.hysteresis and not full_scan:
+            bad_states.update(self.recheck((set(firing) | set(ticks)) - set(bad_states), close_good_time))
+            judged = True
+        lingering = set(state_name for state_name, description in bad_states.iteritems() if description['last_post'] > good_time)
+
+        last_ongoing_alert_email = {}
+        if firing:
+            alert_ids = firing.values()
+            last_ongoing_alert_email = dict(zip(alert_ids, r.hmget(key_map['alert_ongoing_emails'], alert_ids)))
 
         # 1: iterate through mapping of currently firing alerts in redis, checking if each
-        # is stil in bad state. if not mark them as closed
-        for state_name, alert_id in r.hgetall(key_map['alert_currently_firing']).iteritems():
+        # is stil in bad state. if not mark them as closed, once they've been good for
+        # alert_close_ticks runs in a row. an incremental run can't tell, so those stay
+        # open until the server reports again.
+        for state_name, alert_id in firing.iteritems():
 
             # Remove known alert from list of current states. It will then
             # be left with just new alerts.
             current_state = bad_states.pop(state_name, None)
 
-            if current_state:
-                logger.info('Alert "%s" still firing', state_name)
-                if should_send_ongoing_alert(last_ongoing_alert_email, alert_send_email_interval, alert_id):
-                    logger.info('Will send ongoing email')
-                    notify_ongoing_alert(alert_id, state_name)
-                else:
-                    logger.info('Will not send ongoing email')
-                ongoing_alerts += 1
+            if not current_state and judged:
+                good_ticks = 1 - min(ticks.get(state_name, 0), 0)
+                if good_ticks >= self.alert_close_ticks:
+                    logger.info('Alert "%s" no longer firing. Closing.', state_name)
+                    transitions.close(state_name, alert_id)
+                    if state_name in ticks:
+                        transitions.set_ticks(state_name, None)
+                    continue
+
+                logger.info('Alert "%s" good for %s of the %s runs needed to close it', state_name, good_ticks, self.alert_close_ticks)
+                transitions.set_ticks(state_name, -good_ticks)
+            elif state_name in ticks:
+                # bad again, so count good runs from scratch next time
+                transitions.set_ticks(state_name, None)
+
+            logger.info('Alert "%s" still firing', state_name)
+            if should_send_ongoing_alert(last_ongoing_alert_email, self.alert_send_email_interval, alert_id, loop_start):
+                logger.info('Will send ongoing email')
+                transitions.ongoing_email_sent(alert_id)
+                ongoing.append((alert_id, state_name))
             else:
-                logger.info('Alert "%s" no longer firing. Closing.', state_name)
-                closed_alerts += 1
-                close_alert(r, state_name, alert_id)
-                last_ongoing_alert_email.pop(alert_id, None)
+                logger.info('Will not send ongoing email')
+            ongoing_alerts += 1
+            firing_ids.add(alert_id)
 
-        # 2: create new alerts for states which are bad but not yet kept track of
+        # 2: create new alerts for states which have been bad for alert_open_ticks runs
+        # in a row but not yet kept track of. one which closed less than
+        # alert_flap_window ago is reopened instead.
         for state_name, description in bad_states.iteritems():
-            alert_id = create_alert(r, state_name, description)
-            logger.info('Created new alert "%s" with id %s', state_name, alert_id)
-            new_alerts += 1
-            last_ongoing_alert_email[alert_id] = int(time.time())
+            if state_name in lingering:
+                continue
+
+            bad_ticks = max(ticks.get(state_name, 0), 0) + 1
+            if bad_ticks < self.alert_open_ticks:
+                logger.info('"%s" bad for %s of the %s runs needed to alert', state_name, bad_ticks, self.alert_open_ticks)
+                transitions.set_ticks(state_name, bad_ticks)
+                continue
+            if state_name in ticks:
+                transitions.set_ticks(state_name, None)
+
+            recent = recently_closed.pop(state_name, None)
+            if recent and parse_recently_closed(recent)[1] > loop_start - self.alert_flap_window:
+                alert_id = parse_recently_closed(recent)[0]
+                transitions.reopen(state_name, alert_id, description)
+                logger.info('Reopened alert "%s" with id %s, which closed moments ago', state_name, alert_id)
+                reopened_alerts += 1
+            else:
+                if recent:
+                    settled.append((state_name,) + parse_recently_closed(recent))
+                alert_id = transitions.create(state_name, description)
+                logger.info('Created new alert "%s" with id %s', state_name, alert_id)
+                new_alerts += 1
+            firing_ids.add(alert_id)
+
+        for state_name, count in ticks.iteritems():
+            # counting bad runs of a server which is fine again, or good runs of a
+            # closed alert. start over.
+            if state_name not in transitions.ticks and (count < 0 and state_name not in firing or
+                                                        count > 0 and judged and (state_name not in bad_states or state_name in lingering)):
+                transitions.set_ticks(state_name, None)
+
+        # alerts which have stayed closed for alert_flap_window are done with
+        for state_name, value in recently_closed.iteritems():
+            alert_id, closed_at, duration = parse_recently_closed(value)
+            if closed_at <= loop_start - self.alert_flap_window:
+                settled.append((state_name, alert_id, closed_at, duration))
+        for state_name, alert_id, closed_at, duration in settled:
+            transitions.settle(state_name)
+        phases.lap('firing_diff')
+
+        # write every transition out at once, then notify about them. if we've
+        # lost the shard, this raises LostLeadership before anything is sent.
+        created = transitions.created
+        closed = transitions.flush()
+        phases.lap('write')
+
+        # with alert_flap_window, an alert's closing is only sent once it's stayed closed
+        closed_alerts = len(closed)
+        if self.alert_flap_window:
+            closed = []
+        closed += [(state_name, alert_id, duration) for state_name, alert_id, closed_at, duration in settled]
+        for state_name, alert_id, duration in closed:
+            notify_alert_closed(state_name, alert_id, duration)
+        for state_name, alert_id, description in created:
             notify_alert_new(alert_id, state_name, description)
+        for alert_id, state_name in ongoing:
+            notify_ongoing_alert(alert_id, state_name)
 
-        # 3: purge records of ancient alerts
-        # TODO
+        # emails are sent in the background. in digest mode, this run's are combined into one.
+        flush_notifications()
+        phases.lap('notify')
+
+        # 3: purge records of ancient alerts, one bounded batch per run
+        purged_alerts = 0
+        if self.purger:
+            if self.shards > 1:
+                firing_ids = self.all_firing_ids()
+            purged_alerts = self.purger.purge(firing_ids)
+            phases.lap('purge')
 
         # Log some info for this round
         loop_end = time.time()
         duration = loop_end - loop_start
-        logger.info('New alerts: %s. Ongoing alerts: %s. Closed alerts: %s', new_alerts, ongoing_alerts, closed_alerts)
-        logger.info('Alert processor ran in %.2f seconds. Will sleep %s seconds', duration, alert_process_interval)
+        alerter_run_seconds.labels(self.shard).observe(duration)
+        alerter_firing.labels(self.shard).set(ongoing_alerts + new_alerts + reopened_alerts)
+        alerter_transitions.labels('new').inc(new_alerts)
+        alerter_transitions.labels('reopened').inc(reopened_alerts)
+        alerter_transitions.labels('closed').inc(closed_alerts)
+        alerter_transitions.labels('purged').inc(purged_alerts)
+        alerter_transitions.labels('ongoing_notified').inc(len(ongoing))
+        logger.info('New alerts: %s. Reopened alerts: %s. Ongoing alerts: %s. Closed alerts: %s. Purged alerts: %s',
+                    new_alerts, reopened_alerts, ongoing_alerts, closed_alerts, purged_alerts)
+        logger.info('Alert processor ran shard %s in %.2f seconds. Will sleep %s seconds', self.shard, duration, self.alert_process_interval)
+
+        return duration
+
+    def all_firing_ids(self):
+        pipe = self.r.pipeline(transaction=False)
+        for key in all_shard_keys('alert_currently_firing', self.shards):
+            pipe.hvals(key)
+        return set(alert_id for shard_ids in pipe.execute() for alert_id in shard_ids)
+
+    def transitions(self):
+        return AlertTransitions(self.r, self.lease, self.firing_key, self.compact,
+                                self.ticks_key if self.hysteresis else None,
+                                self.recently_closed_key if self.alert_flap_window else None)
+
+    def recheck(self, state_names, close_good_time):
+        '''The bad states among these, going by their servers' last posts'''
+        state_names = list(state_names)
+        pipe = self.r.pipeline(transaction=False)
+        for state_name in state_names:
+            pipe.zscore(self.last_posts_key, state_server_name(state_name))
+
+        bad_states = {}
+        for state_name, last_post in zip(state_names, pipe.execute()):
+            if last_post is not None and last_post <= close_good_time:
+                bad_states[state_name] = bad_state(state_server_name(state_name), int(last_post))
+        return bad_states
+
+    def close_recovered(self, server_name):
+        '''Close the server's alert as soon as we hear it's reporting again'''
+        # with close hysteresis, one post isn't enough. runs count them instead.
+        if self.close_hysteresis:
+            return
+
+        state_name = 'stale_%s' % server_name
+        alert_id = self.r.hget(self.firing_key, state_name)
+
+        if alert_id:
+            logger.info('Server %s reporting again. Closing alert "%s".', server_name, state_name)
+            transitions = self.transitions()
+            transitions.close(state_name, alert_id)
+            closed = transitions.flush()
+            if not self.alert_flap_window:
+                for state_name, alert_id, duration in closed:
+                    notify_alert_closed(state_name, alert_id, duration)
+                flush_notifications()
+
+
+class AlertWorker(object):
+    '''
+    One alert-processor process. Servers are split into alerter_shards
+    shards, each processed by whichever worker holds its lease. A worker
+    claims up to its fair share of the shards and runs each one's
+    AlertProcessor every alert_process_interval.
+
+    Workers register themselves so each knows who is alive. When one joins,
+    workers holding more than their share release shards for it to claim.
+    When one dies, its leases expire and the rest pick its shards up within
+    about alerter_lease_ttl.
+    '''
+
+    def __init__(self, r, configs):
+        self.r = r
+        self.configs = configs
+        self.shards = configs.get('alerter_shards', 1)
+        self.lease_ttl = configs.get('alerter_lease_ttl', default_alerter_lease_ttl)
+        self.renew_interval = self.lease_ttl / 3.0
+        self.identity = worker_identity()
+
+        self.leases = {}
+        self.processors = {}
+        self.next_runs = {}
+        self.next_rebalance = 0
+
+        # one connection listens for the recoveries of all of our shards
+        self.recoveries = None
+        if configs.get('alert_incremental_staleness', False):
+            self.recoveries = r.pubsub()
+
+    def live_workers(self):
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zadd(key_map['alerter_workers'], now, self.identity)
+        pipe.zremrangebyscore(key_map['alerter_workers'], '-inf', now - self.lease_ttl)
+        pipe.zrange(key_map['alerter_workers'], 0, -1)
+        pipe.mget(all_shard_keys('alerter_lease', self.shards))
+        results = pipe.execute()
+        return results[2], results[3]
+
+    def rebalance(self):
+        '''Renew our leases, then give up or claim shards to get to our share'''
+        workers, holders = self.live_workers()
+        self.next_rebalance = time.time() + self.renew_interval
+
+        for shard, lease in self.leases.items():
+            if not lease.acquire():
+                self.drop(shard)
+
+        # each worker gets ceil(shards / workers) at most, but only
+        # floor(shards / workers) while any worker has fewer than that
+        counts = Counter(lease_holder(holder) for holder in holders if holder)
+        least = self.shards // len(workers)
+        most = -(-self.shards // len(workers))
+        if any(counts[worker] < least for worker in workers):
+            most = least
+
+        for shard in sorted(self.leases)[most:]:
+            logger.info('Releasing shard %s to make room for other workers', shard)
+            self.drop(shard)
+
+        # claim free shards, starting from a different one per worker so they
+        # don't all go for the same ones
+        start = shard_of(self.identity, self.shards)
+        for i in xrange(self.shards):
+            if len(self.leases) >= most:
+                break
+            shard = (start + i) % self.shards
+            if shard in self.leases or holders[shard]:
+                continue
+            lease = LeaderLease(self.r, self.lease_ttl, self.identity, shard_key('alerter_lease', shard, self.shards))
+            if lease.acquire():
+                self.claim(shard, lease)
+
+    def claim(self, shard, lease):
+        logger.info('Claimed shard %s', shard)
+        processor = AlertProcessor(self.r, self.configs, lease, shard, self.shards)
+        self.leases[shard] = lease
+        self.processors[shard] = processor
+        self.next_runs[shard] = 0
+        if self.recoveries:
+            self.recoveries.subscribe(processor.recovery_channel)
+
+    def drop(self, shard):
+        lease = self.leases.pop(shard)
+        processor = self.processors.pop(shard)
+        del self.next_runs[shard]
+        if self.recoveries:
+            self.recoveries.unsubscribe(processor.recovery_channel)
+        lease.release()
+
+    def run_due(self):
+        for shard in sorted(self.processors):
+            # long runs of other shards mustn't let our leases lapse
+            if time.time() >= self.next_rebalance:
+                self.rebalance()
+
+            if shard not in self.processors or time.time() < self.next_runs[shard]:
+                continue
+
+            try:
+                duration = self.processors[shard].run_once()
+            except LostLeadership as e:
+                logger.warning('%s. Dropping shard %s.', e, shard)
+                self.drop(shard)
+                continue
+
+            self.next_runs[shard] = time.time() + self.processors[shard].alert_process_interval
+            self.r.hset(key_map['alerter_shard_stats'], shard, ujson.dumps({
+                'worker': self.identity,
+                'duration': duration,
+                'time': time.time()
+            }))
+
+    def recovered(self, channel, server_name):
+        for shard, processor in self.processors.items():
+            if processor.recovery_channel != channel:
+                continue
+            try:
+                processor.close_recovered(server_name)
+            except LostLeadership as e:
+                logger.warning('%s. Dropping shard %s.', e, shard)
+                self.drop(shard)
+
+    def wait(self):
+        # wake up for the next due run, or in time to renew our leases
+        timeout = max(0, self.next_rebalance - time.time())
+        if self.next_runs:
+            timeout = max(0, min(timeout, min(self.next_runs.values()) - time.time()))
+
+        if self.recoveries and self.processors:
+            wait_for_recoveries(self.recoveries, timeout, self.recovered)
+        else:
+            time.sleep(timeout)
+
+    def run(self):
+        try:
+            while True:
+                if time.time() >= self.next_rebalance:
+                    self.rebalance()
+                self.run_due()
+                self.wait()
+        finally:
+            for shard in self.leases.keys():
+                self.drop(shard)
+            self.r.zrem(key_map['alerter_workers'], self.identity)
+
+
+def main():
+    configs = process_config()
+    daemon_init(configs)
+
+    redis_url = configs.get('redis', 'localhost:6379')
+    r = InstrumentedRedis.from_url(redis_url)
+
+    metrics_address = configs.get('alerter_metrics_address', default_alerter_metrics_address)
+    if metrics_address:
+        serve_metrics(metrics_address)
+
+    # exit cleanly on SIGTERM so our shards are handed over straight away
+    # rather than once their leases expire
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-        # Wait until next...
-        time.sleep(alert_process_interval)
+    # any number of alerters can run, splitting the shards between them. with
+    # one shard, one is leader and the rest wait to take over.
+    AlertWorker(r, configs).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+# The web UI's static files, served from memory.
+#
+# Everything under static/ is read once when the app is built, along with
+# gzip (and brotli, if the module is installed) copies of the text ones.
+# Each asset is also served under a fingerprinted name containing a hash
+# of its content, eg jquery.min.0123abcd.js, which spa.html is rewritten to
+# use. Those never change, so browsers may cache them forever; the plain
+# names and the page itself are revalidated by ETag on every load.
+
+import os
+import gzip
+import hashlib
+from cStringIO import StringIO
+
+import falcon
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+mimes = {'.css': 'text/css',
+         '.html': 'text/html',
+         '.jpg': 'image/jpeg',
+         '.js': 'text/javascript',
+         '.png': 'image/png',
+         '.svg': 'image/svg+xml',
+         '.ttf': 'application/octet-stream',
+         '.woff': 'application/font-woff'}
+
+# already compressed formats aren't worth compressing again
+compressible = ('text/css', 'text/html', 'text/javascript', 'image/svg+xml', 'application/octet-stream')
+
+immutable_cache_control = ['public', 'max-age=31536000', 'immutable']
+
+
+def gzip_compress(body):
+    out = StringIO()
+    # fixed mtime so the output, and so its etag, is the same every time
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as h:
+        h.write(body)
+    return out.getvalue()
+
+
+def etag_matches(req, etag):
+    '''Whether the request's If-None-Match lets us answer 304 for etag'''
+    if_none_match = req.get_header('If-None-Match')
+    return bool(if_none_match) and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')])
+
+
+class Asset(object):
+    '''
+    One file's body, content type and compressed variants. variants maps
+    content encoding ('' for none) to (body, etag).
+    '''
+
+    def __init__(self, filename, body):
+        self.filename = filename
+        self.content_type = mimes.get(os.path.splitext(filename)[1], 'application/octet-stream')
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.variants = {'': (body, '"%s"' % self.digest)}
+
+        if self.content_type in compressible:
+            compressors = [('gzip', gzip_compress)]
+            if brotli:
+                compressors.append(('br', brotli.compress))
+            for encoding, compress in compressors:
+                compressed = compress(body)
+                if len(compressed) < len(body):
+                    self.variants[encoding] = (compressed, '"%s-%s"' % (self.digest, encoding))
+
+    @property
+    def fingerprinted(self):
+        name, ext = os.path.splitext(self.filename)
+        return '%s.%s%s' % (name, self.digest[:12], ext)
+
+    def variant(self, req):
+        '''Best encoding the client accepts, with its body and etag'''
+        accepted = [part.split(';', 1)[0].strip() for part in (req.get_header('Accept-Encoding') or '').split(',')]
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                return (encoding,) + self.variants[encoding]
+        return ('',) + self.variants['']
+
+    def respond(self, req, resp, cache_control):
+        encoding, body, etag = self.variant(req)
+
+        resp.etag = etag
+        resp.cache_control = cache_control
+        if len(self.variants) > 1:
+            resp.set_header('Vary', 'Accept-Encoding')
+
+        if etag_matches(req, etag):
+            resp.status = falcon.HTTP_304
+            return
+
+        resp.content_type = self.content_type
+        if encoding:
+            resp.set_header('Content-Encoding', encoding)
+        resp.body = body
+
+
+class AssetTable(object):
+    '''Every file in a directory, by plain and fingerprinted name'''
+
+    def __init__(self, root):
+        self.assets = {}
+        self.fingerprinted = {}
+
+        for filename in sorted(os.listdir(root)):
+            path = os.path.join(root, filename)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as h:
+                asset = Asset(filename, h.read())
+            self.assets[filename] = asset
+            self.fingerprinted[asset.fingerprinted] = asset
+
+    def url(self, filename):
+        return '/static/' + self.assets[filename].fingerprinted
+
+    def page(self, filename):
+        '''An html page with its links to our assets pointed at their fingerprinted urls'''
+        body = self.assets[filename].variants[''][0]
+        for name in self.assets:
+            body = body.replace('"/static/%s"' % name, '"%s"' % self.url(name))
+        return Asset(filename, body)
+
+
+class StaticResource(object):
+    def __init__(self, assets):
+        self.assets = assets
+
+    def on_get(self, req, resp, filename):
+        asset = self.assets.fingerprinted.get(filename)
+        if asset:
+            asset.respond(req, resp, immutable_cache_control)
+            return
+
+        asset = self.assets.assets.get(filename)
+        if not asset:
+            raise falcon.HTTPNotFound()
+        asset.respond(req, resp, ['no-cache'])
+
+
+class SinglePageApp(object):
+    '''Serves the web UI's page for any path not otherwise routed'''
+
+    def __init__(self, assets, filename='spa.html'):
+        self.page = assets.page(filename)
+
+    def __call__(self, req, resp):
+        self.page.respond(req, resp, ['no-cache'])
@@ -1,8 +1,15 @@
+import time
 import click
 import redis
+import ujson
+from datetime import datetime
 
-from constants import key_map
+from constants import key_map, default_heartbeat_rollup_days
 from config import process_config
+from history import HeartbeatHistory
+from shards import shard_of, server_shard_key, all_shard_keys, state_server_name
+from leader import lease_holder
+from storage import delete_server_infos, delete_alerts, StorageMigration
 
 
 def load_redis():
@@ -16,22 +23,208 @@ def cli():
     pass
 
 
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def scan_servers(r, shards, pattern=None, seen_before=None, batch_size=1000):
+    '''
+    Names of known servers matching a glob pattern and last seen before a
+    time, found by ZSCANning each shard's last posts a batch at a time.
+    '''
+    for key in all_shard_keys('server_last_posts', shards):
+        for server_name, last_post in r.zscan_iter(key, match=pattern, count=batch_size):
+            if seen_before is None or last_post < seen_before:
+                yield server_name
+
+
+def history_keys(server_name, now, rollup_days):
+    # history and rollups live in a key per day
+    history = HeartbeatHistory(rollup_days, rollup_days)
+    keys = []
+    for day in history.days(now - (rollup_days + 1) * 24 * 60 * 60, now):
+        keys.append(key_map['heartbeats'].format(server_name=server_name, day=day))
+        keys.append(key_map['heartbeat_rollup'].format(server_name=server_name, day=day))
+    return keys
+
+
+def forget_servers(r, server_names, shards, rollup_days, dry_run=False):
+    '''
+    Delete everything stored about these servers and their alerts in two
+    pipelined round trips. Returns how many alerts they had.
+    '''
+    pipe = r.pipeline(transaction=False)
+    for server_name in server_names:
+        pipe.zrange(key_map['server_alerts'].format(server_name=server_name), 0, -1)
+    alert_ids = [alert_id for server_alerts in pipe.execute() for alert_id in server_alerts]
+
+    if dry_run:
+        return len(alert_ids)
+
+    now = time.time()
+    pipe = r.pipeline(transaction=False)
+    for batch in chunks(alert_ids, 1000):
+        pipe.zrem(key_map['alerts_historical'], *batch)
+        pipe.hdel(key_map['alert_ongoing_emails'], *batch)
+        delete_alerts(pipe, batch)
+
+    for server_name in server_names:
+        pipe.zrem(server_shard_key('server_last_posts', server_name, shards), server_name)
+        pipe.delete(key_map['server_alerts'].format(server_name=server_name),
+                    key_map['server_alert_summary'].format(server_name=server_name),
+                    *history_keys(server_name, now, rollup_days))
+    delete_server_infos(pipe, server_names)
+    for key in all_shard_keys('alert_ticks', shards) + all_shard_keys('alert_recently_closed', shards):
+        pipe.hdel(key, *['stale_%s' % server_name for server_name in server_names])
+    pipe.hdel(key_map['server_info_hashes'], *server_names)
+
+    pipe.incr(key_map['servers_version'])
+    pipe.incr(key_map['alerts_version'])
+    pipe.execute()
+
+    return len(alert_ids)
+
+
+@cli.command()
+@click.option('--server', multiple=True, help='Server to forget. Can be given more than once.')
+@click.option('--file', 'server_file', type=click.File(), help='File of servers to forget, one per line. - for stdin.')
+@click.option('--pattern', help='Forget known servers whose names match this glob, eg "web-*.dc2.example.com"')
+@click.option('--not-seen-days', type=float, help='Forget known servers which haven\'t posted for this many days')
+@click.option('--batch-size', type=int, default=100, show_default=True, help='Servers forgotten per round of pipelines')
+@click.option('--pause', type=float, default=0.1, show_default=True, help='Seconds to wait between batches, to go easy on redis')
+@click.option('--dry-run', is_flag=True, help='Only count what would be forgotten')
+def forget(server, server_file, pattern, not_seen_days, batch_size, pause, dry_run):
+    '''
+    Delete servers which don't exist anymore, along with their alerts and
+    history. Servers are given by name, or picked from the known servers by
+    --pattern and/or --not-seen-days.
+    '''
+    configs = process_config()
+    shards = configs.get('alerter_shards', 1)
+    rollup_days = configs.get('heartbeat_rollup_days', default_heartbeat_rollup_days)
+
+    if not (server or server_file or pattern or not_seen_days is not None):
+        raise click.UsageError('Give servers to forget with --server, --file, --pattern or --not-seen-days')
+
+    r = load_redis()
+
+    server_names = set(server)
+    if server_file:
+        server_names.update(line.strip() for line in server_file if line.strip())
+    if pattern or not_seen_days is not None:
+        seen_before = time.time() - not_seen_days * 24 * 60 * 60 if not_seen_days is not None else None
+        server_names.update(scan_servers(r, shards, pattern, seen_before))
+
+    server_names = sorted(server_names)
+    done = 0
+    alerts = 0
+    for batch in chunks(server_names, batch_size):
+        if done:
+            time.sleep(pause)
+        alerts += forget_servers(r, batch, shards, rollup_days, dry_run)
+        done += len(batch)
+        if not dry_run:
+            click.echo('Forgot %s/%s servers' % (done, len(server_names)), err=True)
+
+    click.echo('%s %s servers and %s alerts' % ('Would forget' if dry_run else 'Forgot', len(server_names), alerts))
+
+
+@cli.command('migrate-storage')
+@click.option('--batch-size', type=int, default=100, show_default=True, help='Keys SCANned per batch')
+@click.option('--pause', type=float, default=0.1, show_default=True, help='Seconds to wait between batches, to go easy on redis')
+@click.option('--restart', is_flag=True, help='Start over, eg to pick up alerts which were firing last time')
+def migrate_storage(batch_size, pause, restart):
+    '''
+    Move server and alert infos into compact storage while everything keeps
+    running. Turn on compact_storage and restart the API and alerters first.
+    Stopping part way is fine: running it again carries on from where it got to.
+    '''
+    configs = process_config()
+    if not configs.get('compact_storage'):
+        raise click.UsageError('Turn on compact_storage in the config, and restart the API and alerters with it, first')
+
+    r = load_redis()
+    migration = StorageMigration(r, configs.get('alerter_shards', 1), batch_size)
+    if restart:
+        migration.restart()
+
+    totals = dict((phase, [0, 0]) for phase in migration.phases)
+    while True:
+        result = migration.step()
+        if not result:
+            break
+        phase, moved, skipped = result
+        totals[phase][0] += moved
+        totals[phase][1] += skipped
+        click.echo('Moved %s %s (%s skipped)' % (totals[phase][0], phase, totals[phase][1]), err=True)
+        time.sleep(pause)
+
+    click.echo('Moved %s servers and %s alerts. Skipped %s alerts which are firing, changed or gone, '
+               'which --restart picks up once they close.' % (totals['servers'][0], totals['alerts'][0], totals['alerts'][1]))
+
+
 @cli.command()
-@click.option('--server', help='Server to forget', required=True)
-def forget(server):
-    server_name = server
+def shards():
+    '''Show which alerter holds each shard and how long its last run took'''
+    shards = process_config().get('alerter_shards', 1)
 
     r = load_redis()
 
-    for alert_id in r.zrange(key_map['server_alerts'].format(server_name=server_name), 0, -1, withscores=False):
-        r.zrem(key_map['alerts_historical'], alert_id)
-        r.delete(key_map['alert_info'].format(alert_id=alert_id))
+    holders = r.mget(all_shard_keys('alerter_lease', shards))
+    stats = r.hgetall(key_map['alerter_shard_stats'])
+    now = time.time()
+
+    for shard, holder in enumerate(holders):
+        line = '%5d  %-40s' % (shard, lease_holder(holder) if holder else '(unclaimed)')
+        shard_stats = stats.get(str(shard))
+        if shard_stats:
+            shard_stats = ujson.loads(shard_stats)
+            last_run = datetime.fromtimestamp(shard_stats['time'])
+            line += '  last run %s (%ds ago) took %.2fs' % (last_run, now - shard_stats['time'], shard_stats['duration'])
+        click.echo(line)
+
+
+@cli.command()
+@click.option('--old-shards', type=int, required=True, help='alerter_shards the data was written with')
+def reshard(old_shards):
+    '''
+    Move servers and firing alerts from old_shards shards into the
+    configured alerter_shards. Stop the alerters and API first.
+    '''
+    shards = process_config().get('alerter_shards', 1)
+
+    r = load_redis()
 
-    r.delete(key_map['server_alerts'].format(server_name=server_name))
+    last_posts = {}
+    firing = {}
+    pipe = r.pipeline(transaction=False)
+    for key in all_shard_keys('server_last_posts', old_shards):
+        pipe.zrange(key, 0, -1, withscores=True)
+    for key in all_shard_keys('alert_currently_firing', old_shards):
+        pipe.hgetall(key)
+    results = pipe.execute()
+    for result in results[:old_shards]:
+        last_posts.update(result)
+    for result in results[old_shards:]:
+        firing.update(result)
 
-    r.zrem(key_map['server_last_posts'], server_name)
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(*(all_shard_keys('server_last_posts', old_shards) + all_shard_keys('alert_currently_firing', old_shards)))
+    # counts of runs towards hysteresis and recently closed alerts just start over
+    pipe.delete(*(all_shard_keys('alert_ticks', old_shards) + all_shard_keys('alert_recently_closed', old_shards)))
+    for server_name, last_post in last_posts.iteritems():
+        pipe.zadd(server_shard_key('server_last_posts', server_name, shards), last_post, server_name)
+    for state_name, alert_id in firing.iteritems():
+        pipe.hset(server_shard_key('alert_currently_firing', state_server_name(state_name), shards), state_name, alert_id)
+    pipe.delete(key_map['alerter_shard_stats'])
+    pipe.execute()
 
-    r.delete(key_map['server_info'].format(server_name=server_name))
+    counts = [0] * shards
+    for server_name in last_posts:
+        counts[shard_of(server_name, shards)] += 1
+    click.echo('Moved %s servers and %s firing alerts into %s shards of %s-%s servers' % (
+        len(last_posts), len(firing), shards, min(counts), max(counts)))
 
 
 def main():
@@ -0,0 +1,194 @@
+# Optional extra stats for agents to report, read straight from /proc.
+#
+# Each collector opens the files it needs once and re-reads them with a
+# seek on every collect(), and none of them spawn processes, so they stay
+# cheap enough to run on every heartbeat.
+
+import os
+import time
+import importlib
+
+# collector names usable in the agent_collectors config. any other name is
+# taken to be the "module:Class" path of a custom collector.
+collector_types = {
+    'loadavg': 'healthapp.collectors:LoadAvgCollector',
+    'meminfo': 'healthapp.collectors:MemInfoCollector',
+    'uptime': 'healthapp.collectors:UptimeCollector',
+    'disk': 'healthapp.collectors:DiskCollector',
+    'network': 'healthapp.collectors:NetworkCollector',
+}
+
+# filesystems which don't take up disk space
+virtual_filesystems = frozenset([
+    'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devpts', 'devtmpfs',
+    'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'overlay', 'proc', 'pstore', 'ramfs', 'rpc_pipefs',
+    'securityfs', 'squashfs', 'sysfs', 'tmpfs', 'tracefs',
+])
+
+# filesystems whose statvfs() can hang for good on a server which went away,
+# which would stop the agent heartbeating. so are any fuse.* filesystems.
+network_filesystems = frozenset([
+    '9p', 'afs', 'ceph', 'cifs', 'coda', 'fuse', 'gfs2', 'glusterfs', 'gpfs', 'lustre', 'ncpfs', 'nfs', 'nfs4',
+    'ocfs2', 'smb3', 'smbfs', 'sshfs',
+])
+
+
+class ProcFile(object):
+    '''A /proc file kept open and re-read from the start on each read()'''
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path)
+
+    def read(self):
+        self.handle.seek(0)
+        return self.handle.read()
+
+    def lines(self):
+        return self.read().splitlines()
+
+
+class Collector(object):
+    '''
+    Base class for collectors. collect() returns a dict of stats, which is
+    merged into what the agent posts.
+
+    Stats of volatile collectors change on nearly every collect(), so they
+    don't count as a change of the agent's stats: they're posted along with
+    the rest when those change, or every agent_full_post_interval, and
+    keepalives go out in between.
+    '''
+
+    volatile = False
+
+    def collect(self):
+        raise NotImplementedError
+
+
+class LoadAvgCollector(Collector):
+    volatile = True
+
+    def __init__(self):
+        self.loadavg = ProcFile('/proc/loadavg')
+
+    def collect(self):
+        one, five, fifteen = self.loadavg.read().split()[:3]
+        return {'Load': {'1m': float(one), '5m': float(five), '15m': float(fifteen)}}
+
+
+class MemInfoCollector(Collector):
+    fields = ('MemTotal', 'MemFree', 'MemAvailable', 'Buffers', 'Cached', 'SwapTotal', 'SwapFree')
+    volatile = True
+
+    def __init__(self):
+        self.meminfo = ProcFile('/proc/meminfo')
+
+    def collect(self):
+        memory = {}
+        for line in self.meminfo.lines():
+            name, value = line.split(':', 1)
+            if name in self.fields:
+                # values are in kB
+                memory[name] = int(value.split()[0]) * 1024
+        return {'Memory': memory}
+
+
+class UptimeCollector(Collector):
+    volatile = True
+
+    def __init__(self):
+        self.uptime = ProcFile('/proc/uptime')
+
+    def collect(self):
+        return {'Uptime': int(float(self.uptime.read().split()[0]))}
+
+
+class DiskCollector(Collector):
+    '''Usage of each mounted local, real filesystem'''
+
+    # free space moves with every write
+    volatile = True
+
+    def __init__(self):
+        self.mounts = ProcFile('/proc/mounts')
+
+    def collect(self):
+        disks = {}
+        for line in self.mounts.lines():
+            device, mountpoint, fstype = line.split()[:3]
+
+            # /proc/mounts escapes spaces and such as octal
+            mountpoint = mountpoint.decode('string_escape')
+
+            if fstype in virtual_filesystems or fstype in network_filesystems or fstype.startswith('fuse.') or mountpoint in disks:
+                continue
+
+            try:
+                stat = os.statvfs(mountpoint)
+            except OSError:
+                continue
+
+            total = stat.f_blocks * stat.f_frsize
+            if not total:
+                continue
+
+            free = stat.f_bavail * stat.f_frsize
+            disks[mountpoint] = {
+                'total': total,
+                'free': free,
+                'used_percent': round(100.0 * (total - free) / total, 1)
+            }
+        return {'Disks': disks}
+
+
+class NetworkCollector(Collector):
+    '''Per interface receive and transmit rates since the previous collect()'''
+
+    volatile = True
+
+    def __init__(self):
+        self.dev = ProcFile('/proc/net/dev')
+        self.last_counters = None
+        self.last_time = None
+
+    def read_counters(self):
+        counters = {}
+        # first two lines are headers
+        for line in self.dev.lines()[2:]:
+            interface, values = line.split(':', 1)
+            interface = interface.strip()
+            if interface == 'lo':
+                continue
+            values = values.split()
+            counters[interface] = (int(values[0]), int(values[8]))
+        return counters
+
+    def collect(self):
+        now = time.time()
+        counters = self.read_counters()
+
+        network = {}
+        if self.last_counters is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            for interface, (rx, tx) in counters.iteritems():
+                if interface not in self.last_counters:
+                    continue
+                last_rx, last_tx = self.last_counters[interface]
+                network[interface] = {
+                    # counters reset if an interface is recreated
+                    'rx_bytes_per_sec': int(max(0, rx - last_rx) / elapsed),
+                    'tx_bytes_per_sec': int(max(0, tx - last_tx) / elapsed),
+                }
+
+        self.last_counters = counters
+        self.last_time = now
+        return {'Network': network}
+
+
+def load_collectors(names):
+    collectors = []
+    for name in names:
+        path = collector_types.get(name, name)
+        module_name, class_name = path.split(':', 1)
+        collectors.append(getattr(importlib.import_module(module_name), class_name)())
+    return collectors
@@ -5,6 +5,33 @@ key_map = {
     'server_last_posts': 'healthapp:server_last_posts',
     'server_info': 'healthapp:server_info:{server_name}',
 
+    # with compact_storage, hashes of server name -> info instead, each
+    # holding one bucket of servers. see storage.py
+    'server_info_bucket': 'healthapp:server_infos:{bucket}',
+
+    # raw heartbeat history, one packed string per server per day. see history.py
+    'heartbeats': 'healthapp:heartbeats:{server_name}:{day}',
+
+    # per day hourly heartbeat counts
+    'heartbeat_rollup': 'healthapp:heartbeat_rollup:{server_name}:{day}',
+
+    # hash of server name -> sha1 of its last posted info, so unchanged
+    # posts can skip rewriting it
+    'server_info_hashes': 'healthapp:server_info_hashes',
+
+    # pub/sub channel the API publishes server names to when a stale server
+    # starts posting again
+    'server_recovered': 'healthapp:server_recovered',
+
+    # pub/sub channel of JSON events for the web UI's live updates: server
+    # heartbeats and staleness, alerts opening and closing. see events.py
+    'events': 'healthapp:events',
+
+    # the API's metrics, added up across the worker processes of each API
+    # server (host and master pid). see SharedMetrics in metrics.py
+    'metrics_totals': 'healthapp:metrics:{server}:totals',
+    'metrics_processes': 'healthapp:metrics:{server}:processes',
+
     # sorted set mapping server name -> list of alert IDs with score being
     # timestamp
     'server_alerts': 'healthapp:server_alerts:{server_name}',
@@ -17,9 +44,50 @@ key_map = {
     # info on alert
     'alert_info': 'healthapp:alert_info:{alert_id}',
 
-    # historical list of alerts. purge this regularly.
+    # with compact_storage, hashes of alert id -> packed info instead, each
+    # holding one bucket of alerts. see storage.py
+    'alert_info_bucket': 'healthapp:alert_infos:{bucket}',
+
+    # hash of where an interrupted `healthapp-admin migrate-storage` got to
+    'storage_migration': 'healthapp:storage_migration',
+
+    # hash of state name -> runs in a row it's been bad without an alert
+    # (positive) or good with one (negative), for alert hysteresis. only
+    # states on their way to opening or closing an alert have one.
+    'alert_ticks': 'healthapp:alert_ticks',
+
+    # hash of state name -> "<alert id> <closed at> <duration>" of alerts
+    # closed within alert_flap_window, which reopen rather than start anew
+    'alert_recently_closed': 'healthapp:alerts_recently_closed',
+
+    # historical list of alerts. purged by the alerter per the retention configs.
     # sorted set with key being alert id and value being time
-    'alerts_historical': 'healthapp:alerts_list'
+    'alerts_historical': 'healthapp:alerts_list',
+
+    # counters bumped whenever servers or alerts change, used to tell if
+    # cached list responses are still current. servers' last post times
+    # alone don't count, see ingest.py
+    'servers_version': 'healthapp:servers_version',
+    'alerts_version': 'healthapp:alerts_version',
+
+    # hash of firing alert id -> when its last "alert ongoing" email went
+    # out, so any alerter taking over keeps to the schedule
+    'alert_ongoing_emails': 'healthapp:alert_ongoing_emails',
+
+    # alerter leader election. identity and fencing token of the current
+    # leader (of each shard, see shards.py), expiring unless renewed, and the
+    # counter tokens come from. see leader.py
+    'alerter_lease': 'healthapp:alerter_lease',
+    'alerter_lease_token': 'healthapp:alerter_lease_token',
+
+    # sorted set of alert-processor workers -> when they were last alive,
+    # and hash of shard -> json stats of its last alert loop run
+    'alerter_workers': 'healthapp:alerter_workers',
+    'alerter_shard_stats': 'healthapp:alerter_shard_stats',
+
+    # daily rollups of purged alerts per server. hash of "<day>:count" and
+    # "<day>:downtime" to values, trimmed to alert_summary_retention_days
+    'server_alert_summary': 'healthapp:server_alert_summary:{server_name}'
 }
 
 # map alert prefix names to human readable keywords
@@ -30,3 +98,31 @@ alert_topic_map = {
 default_server_staleness_duration = 4 * 60
 default_alert_process_interval = 60
 default_agent_run_interval = 60
+default_agent_full_post_interval = 60 * 60
+default_agent_jitter = 0.1
+default_agent_timeout = 10
+default_alert_purge_batch_size = 500
+default_alert_summary_retention_days = 365
+default_alert_full_scan_interval = 10 * 60
+default_alerter_lease_ttl = 15
+default_alerter_metrics_address = '127.0.0.1:9188'
+default_metrics_flush_interval = 5
+default_list_cache_ttl = 5
+default_list_cache_size = 256
+default_max_status_body_size = 64 * 1024
+default_max_batch_body_size = 16 * 1024 * 1024
+default_ingest_flush_interval = 0.5
+default_ingest_flush_size = 1000
+default_heartbeat_history_days = 7
+default_heartbeat_rollup_days = 90
+default_events_heartbeat_interval = 1
+default_events_keepalive_interval = 15
+default_events_max_pending = 1000
+default_events_max_streams = 8
+default_green_api_address = '127.0.0.1:8000'
+default_green_api_workers = 1
+default_green_api_max_clients = 10000
+default_green_redis_max_connections = 100
+default_green_events_max_streams = 1000
+default_relay_address = '0.0.0.0:8001'
+default_relay_flush_interval = 5
@@ -0,0 +1,180 @@
+# live updates for the web UI over server-sent events.
+#
+# the ingest scripts and the alerter publish small JSON events to one redis
+# channel. each API process holds a single subscription to it and fans the
+# events out to every connected browser, so viewers cost the same whatever
+# the size of the fleet. heartbeats are coalesced into one event per
+# interval listing just the servers which posted.
+#
+# streams hold a connection each, so the API needs a threaded (gthread) or
+# async gunicorn worker rather than the default sync one. under gthread each
+# stream also holds one of the worker's threads, which agents' posts are
+# served by too, so only events_max_streams streams are served per worker
+# process and browsers beyond that get a 503 and try again later.
+
+import time
+import logging
+import threading
+from Queue import Queue, Full, Empty
+
+import ujson
+
+import falcon
+
+from constants import (key_map, default_events_heartbeat_interval, default_events_keepalive_interval, default_events_max_pending,
+                       default_events_max_streams)
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+event_subscribers = registry.gauge('healthapp_event_subscribers', 'Browsers connected to the event stream')
+events_dropped = registry.counter('healthapp_event_subscribers_dropped_total', 'Event streams closed for falling too far behind')
+events_refused = registry.counter('healthapp_event_subscribers_refused_total', 'Event streams refused for being over events_max_streams')
+
+
+def event_message(event_type, **fields):
+    fields['type'] = event_type
+    return ujson.dumps(fields)
+
+
+class EventHub(object):
+    '''
+    One redis subscription, fanned out to a queue per stream. A stream which
+    falls max_pending events behind is dropped; the browser reconnects and
+    reloads what it's showing. At most max_streams are open at once.
+    '''
+
+    def __init__(self, r, heartbeat_interval=default_events_heartbeat_interval, max_pending=default_events_max_pending,
+                 max_streams=default_events_max_streams):
+        self.r = r
+        self.heartbeat_interval = heartbeat_interval
+        self.max_pending = max_pending
+        self.max_streams = max_streams
+        self.streams = 0
+        self.subscribers = set()
+        self.heartbeats = {}
+        self.lock = threading.Lock()
+        self.listener = None
+        event_subscribers.set_function(lambda: self.streams)
+
+    def subscribe(self):
+        '''A queue for a new stream, or None if there are max_streams already'''
+        # started on first use so it lives in the forked worker process
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return None
+            self.streams += 1
+
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.run, name='events')
+                self.listener.daemon = True
+                self.listener.start()
+
+            queue = Queue(self.max_pending)
+            self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        '''Once a stream has finished'''
+        with self.lock:
+            self.subscribers.discard(queue)
+            self.streams -= 1
+
+    def drop(self, queue):
+        # its stream finds out and finishes at its next keepalive
+        with self.lock:
+            self.subscribers.discard(queue)
+
+    def subscribed(self, queue):
+        return queue in self.subscribers
+
+    def broadcast(self, message):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for queue in subscribers:
+            try:
+                queue.put_nowait(message)
+            except Full:
+                events_dropped.inc()
+                self.drop(queue)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('Lost event subscription. Reconnecting.')
+                time.sleep(1)
+
+    def listen(self):
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(key_map['events'])
+        next_flush = time.time() + self.heartbeat_interval
+
+        try:
+            while True:
+                message = pubsub.get_message(timeout=max(0, next_flush - time.time()))
+                if message:
+                    self.handle(message['data'])
+
+                if time.time() >= next_flush:
+                    if self.heartbeats:
+                        heartbeats, self.heartbeats = self.heartbeats, {}
+                        self.broadcast(event_message('heartbeats', servers=heartbeats))
+                    next_flush = time.time() + self.heartbeat_interval
+        finally:
+            pubsub.close()
+
+    def handle(self, message):
+        if not self.subscribers:
+            return
+
+        event = ujson.loads(message)
+        if event['type'] == 'heartbeat':
+            self.heartbeats[event['server']] = event['time']
+        elif event['type'] == 'heartbeats':
+            # a batch written by a HeartbeatBuffer
+            self.heartbeats.update(event['servers'])
+        else:
+            self.broadcast(message)
+
+
+class EventStream:
+    '''
+    /api/v0/events: a text/event-stream of JSON events, each with a type of
+    heartbeats, server_stale, alert_opened or alert_closed.
+    '''
+
+    def __init__(self, hub, keepalive_interval=default_events_keepalive_interval):
+        self.hub = hub
+        self.keepalive_interval = keepalive_interval
+
+    def on_get(self, req, resp):
+        queue = self.hub.subscribe()
+        if queue is None:
+            events_refused.inc()
+            raise falcon.HTTPServiceUnavailable('Too many event streams', 'Try again later', retry_after=30)
+
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.set_header('X-Accel-Buffering', 'no')
+        resp.stream = self.stream(queue)
+
+    def stream(self, queue):
+        try:
+            # how long browsers should wait before reconnecting
+            yield 'retry: 3000\n\n'
+
+            while True:
+                try:
+                    message = queue.get(timeout=self.keepalive_interval)
+                except Empty:
+                    if not self.hub.subscribed(queue):
+                        return
+                    # comments keep proxies from timing the connection out
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'data: %s\n\n' % message
+        finally:
+            self.hub.unsubscribe(queue)
@@ -0,0 +1,117 @@
+# Cooperative API server for high agent fan-in.
+#
+# Serves the same falcon app as the gunicorn setup, but on gevent: every
+# request is a greenlet and waits on sockets and redis cooperatively, so a
+# worker process keeps thousands of agent posts in flight instead of one
+# at a time (or one per thread). Requests share a bounded pool of redis
+# connections. Run one worker per core:
+#
+#   healthapp-green-api
+#
+# or get the same from gunicorn with `--worker-class gevent`.
+
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import errno  # noqa: E402
+import signal  # noqa: E402
+import socket  # noqa: E402
+import logging  # noqa: E402
+
+from gevent.pool import Pool  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from constants import (default_green_api_address, default_green_api_workers, default_green_api_max_clients,  # noqa: E402
+                       default_green_redis_max_connections, default_green_events_max_streams)
+from config import process_config  # noqa: E402
+from service import daemon_init  # noqa: E402
+from server import get_app  # noqa: E402
+
+logger = logging.getLogger()
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
+log_file = os.environ.get('LOG_FILE')
+if log_file:
+    ch = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760, backupCount=10)
+else:
+    ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logger.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+def listen(address, backlog=2048):
+    host, port = address.rsplit(':', 1)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, int(port)))
+    listener.listen(backlog)
+    return listener
+
+
+def serve(listener, max_clients):
+    '''Run one worker process on an already bound listener. Never returns.'''
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # built here rather than before forking so each worker has its own
+    # redis connections and background threads
+    app = get_app(redis_max_connections=default_green_redis_max_connections, events_max_streams=default_green_events_max_streams)
+    server = WSGIServer(listener, app, spawn=Pool(max_clients), log=None)
+    logger.info('Worker %s serving', os.getpid())
+    server.serve_forever()
+
+
+def spawn(listener, max_clients):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(listener, max_clients)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def main():
+    configs = process_config()
+
+    address = configs.get('green_api_address', default_green_api_address)
+    workers = configs.get('green_api_workers', default_green_api_workers)
+    max_clients = configs.get('green_api_max_clients', default_green_api_max_clients)
+
+    # bind before dropping privileges, so low ports work
+    listener = listen(address)
+    daemon_init(configs)
+    logger.info('Listening on %s with %s workers', address, workers)
+
+    if workers == 1:
+        serve(listener, max_clients)
+
+    children = set(spawn(listener, max_clients) for i in xrange(workers))
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # replace any worker which dies
+    while True:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        logger.error('Worker %s exited with status %s. Restarting it.', pid, status)
+        time.sleep(1)
+        children.add(spawn(listener, max_clients))
+
+
+if __name__ == '__main__':
+    main()
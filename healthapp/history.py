@@ -0,0 +1,147 @@
+# Compact per server heartbeat history.
+#
+# Every heartbeat appends a 3 byte record to that server's key for the
+# (UTC) day: the seconds since the start of the day, big endian. A server
+# posting once a minute costs ~4.3KB a day. Alongside, each day gets a
+# 48 byte rollup of how many heartbeats arrived in each hour, kept as 24
+# u16 counters updated with BITFIELD. Raw history and rollups expire after
+# their own retention periods.
+
+import struct
+
+from constants import key_map
+
+day_seconds = 24 * 60 * 60
+hour_seconds = 60 * 60
+record_size = 3
+
+
+def pack_offset(offset):
+    return struct.pack('>I', offset)[1:]
+
+
+def unpack_offsets(data):
+    return [struct.unpack('>I', '\0' + data[i:i + record_size])[0] for i in xrange(0, len(data) - record_size + 1, record_size)]
+
+
+class HeartbeatHistory(object):
+    '''
+    Writes and reads heartbeat history. history_days of raw heartbeats and
+    rollup_days of hourly rollups are kept. history_days of 0 disables it.
+    '''
+
+    def __init__(self, history_days, rollup_days):
+        self.history_days = history_days
+        self.rollup_days = rollup_days
+
+    def enabled(self):
+        return bool(self.history_days)
+
+    def keys(self, server_name, now):
+        day = int(now) // day_seconds
+        return [key_map['heartbeats'].format(server_name=server_name, day=day),
+                key_map['heartbeat_rollup'].format(server_name=server_name, day=day)]
+
+    def args(self, now):
+        '''
+        Record, rollup counter and expiry times for a heartbeat at now, as
+        passed to the ingest scripts. All blank if history is disabled.
+        '''
+        if not self.enabled():
+            return ['', '', 0, 0]
+
+        now = int(now)
+        day_start = now - now % day_seconds
+        day_end = day_start + day_seconds
+        offset = now - day_start
+
+        return [pack_offset(offset), '#%d' % (offset // hour_seconds),
+                day_end + self.history_days * day_seconds, day_end + self.rollup_days * day_seconds]
+
+    def write(self, pipe, server_name, now):
+        if not self.enabled():
+            return
+
+        history_key, rollup_key = self.keys(server_name, now)
+        record, hour, history_expire, rollup_expire = self.args(now)
+
+        pipe.append(history_key, record)
+        pipe.expireat(history_key, history_expire)
+        pipe.execute_command('BITFIELD', rollup_key, 'OVERFLOW', 'SAT', 'INCRBY', 'u16', hour, 1)
+        pipe.expireat(rollup_key, rollup_expire)
+
+    def earliest(self, now, hourly=False):
+        '''Start of the oldest day of raw heartbeats (or hourly rollups) still kept'''
+        days = self.rollup_days if hourly else self.history_days
+        return (int(now) // day_seconds - days) * day_seconds
+
+    def days(self, start, end):
+        return range(int(start) // day_seconds, int(end) // day_seconds + 1)
+
+    def read(self, r, server_name, start, end):
+        '''Sorted timestamps of heartbeats between start and end'''
+        days = self.days(start, end)
+        data = r.mget([key_map['heartbeats'].format(server_name=server_name, day=day) for day in days])
+
+        timestamps = []
+        for day, records in zip(days, data):
+            if not records:
+                continue
+            base = day * day_seconds
+            timestamps.extend(base + offset for offset in unpack_offsets(records))
+
+        return [timestamp for timestamp in sorted(timestamps) if start <= timestamp <= end]
+
+    def read_hourly(self, r, server_name, start, end):
+        '''List of (hour start time, heartbeat count) between start and end'''
+        days = self.days(start, end)
+        data = r.mget([key_map['heartbeat_rollup'].format(server_name=server_name, day=day) for day in days])
+
+        hours = []
+        for day, counters in zip(days, data):
+            counters = (counters or '').ljust(48, '\0')
+            for hour in xrange(24):
+                hour_start = day * day_seconds + hour * hour_seconds
+                if start <= hour_start + hour_seconds and hour_start <= end:
+                    hours.append((hour_start, struct.unpack('>H', counters[hour * 2:hour * 2 + 2])[0]))
+
+        return hours
+
+
+def find_gaps(timestamps, start, end, max_gap):
+    '''
+    Periods between start and end longer than max_gap seconds without a
+    heartbeat, as a list of [from, to].
+    '''
+    gaps = []
+    previous = start
+    for timestamp in timestamps + [end]:
+        if timestamp - previous > max_gap:
+            gaps.append([previous, timestamp])
+        previous = max(previous, timestamp)
+    return gaps
+
+
+def find_hourly_gaps(hours, start, end):
+    '''
+    Like find_gaps, but from hourly rollups, so only whole hours without a
+    heartbeat count.
+    '''
+    gaps = []
+    for hour_start, count in hours:
+        if count:
+            continue
+        since, to = max(start, hour_start), min(end, hour_start + hour_seconds)
+        if gaps and gaps[-1][1] == since:
+            gaps[-1][1] = to
+        else:
+            gaps.append([since, to])
+    return gaps
+
+
+def uptime_percent(start, end, gaps):
+    total = end - start
+    if total <= 0:
+        return 100.0
+    down = sum(to - since for since, to in gaps)
+    return round(100.0 * (total - down) / total, 3)
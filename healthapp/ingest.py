@@ -0,0 +1,277 @@
+# Writing agent posts to redis, either one at a time as they arrive or
+# buffered and written in batches.
+
+import time
+import atexit
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+
+import ujson
+
+from constants import key_map
+from shards import server_shard_key
+from storage import server_info_bucket, write_server_infos
+
+logger = logging.getLogger(__name__)
+
+# Shared by both scripts below: refresh a server's last post time and
+# history, tell the alerter if the server had gone stale and tell the web
+# UI it posted. the server list only changes version for a new server or
+# one which was stale. its last post times are left to the list's cache
+# expiry, or every post would change it.
+#
+# KEYS: server_last_posts, servers_version, server_recovered (of the server's
+#       shard), heartbeats, heartbeat_rollup, events
+# ARGV: server_name, now, stale cutoff, history record, rollup counter,
+#       history expiry, rollup expiry (history ones blank if disabled)
+heartbeat_lua = '''
+local last_post = redis.call('zscore', KEYS[1], ARGV[1])
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+if not last_post then
+    redis.call('incr', KEYS[2])
+elseif tonumber(last_post) <= tonumber(ARGV[3]) then
+    redis.call('incr', KEYS[2])
+    redis.call('publish', KEYS[3], ARGV[1])
+end
+if ARGV[4] ~= '' then
+    redis.call('append', KEYS[4], ARGV[4])
+    redis.call('expireat', KEYS[4], ARGV[6])
+    redis.call('bitfield', KEYS[5], 'overflow', 'sat', 'incrby', 'u16', ARGV[5], 1)
+    redis.call('expireat', KEYS[5], ARGV[7])
+end
+redis.call('publish', KEYS[6], cjson.encode({type='heartbeat', server=ARGV[1], time=tonumber(ARGV[2])}))
+'''
+
+# Record a server's post in one round trip. Only rewrites the stored info
+# if its content hash changed.
+#
+# KEYS: (heartbeat keys), server_info, server_info_hashes
+# ARGV: (heartbeat args), body, body hash
+record_status_script = '''
+if redis.call('hget', KEYS[8], ARGV[1]) ~= ARGV[9] or redis.call('exists', KEYS[7]) == 0 then
+    redis.call('set', KEYS[7], ARGV[8])
+    redis.call('hset', KEYS[8], ARGV[1], ARGV[9])
+    redis.call('incr', KEYS[2])
+end
+''' + heartbeat_lua
+
+# The same with compact_storage, keeping the info in its bucket hash and
+# dropping any copy left under the old schema. see storage.py
+#
+# KEYS: (heartbeat keys), server info bucket, server_info_hashes, server_info
+# ARGV: (heartbeat args), body, body hash
+record_status_compact_script = '''
+if redis.call('hget', KEYS[8], ARGV[1]) ~= ARGV[9] or redis.call('hexists', KEYS[7], ARGV[1]) == 0 then
+    redis.call('hset', KEYS[7], ARGV[1], ARGV[8])
+    redis.call('hset', KEYS[8], ARGV[1], ARGV[9])
+    redis.call('del', KEYS[9])
+    redis.call('incr', KEYS[2])
+end
+''' + heartbeat_lua
+
+# Refresh a server's last post time if its stored info hash matches the
+# given one. Returns 1 if it did, 0 if the hash didn't match.
+#
+# KEYS: (heartbeat keys), server_info_hashes
+# ARGV: (heartbeat args), body hash
+keepalive_script = '''
+if redis.call('hget', KEYS[7], ARGV[1]) ~= ARGV[8] then
+    return 0
+end
+''' + heartbeat_lua + '''
+return 1
+'''
+
+
+def body_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class StatusRecorder(object):
+    '''Writes validated agent posts to redis'''
+
+    def __init__(self, r, server_staleness_duration, history, shards=1, compact=False):
+        self.r = r
+        self.server_staleness_duration = server_staleness_duration
+        self.history = history
+        self.shards = shards
+        self.compact = compact
+        self.record_status = r.register_script(record_status_compact_script if compact else record_status_script)
+        self.keepalive_status = r.register_script(keepalive_script)
+
+    def heartbeat_keys_args(self, server_name, now):
+        keys = [
+            server_shard_key('server_last_posts', server_name, self.shards),
+            key_map['servers_version'],
+            server_shard_key('server_recovered', server_name, self.shards),
+        ] + self.history.keys(server_name, now) + [key_map['events']]
+        args = [server_name, now, now - self.server_staleness_duration] + self.history.args(now)
+        return keys, args
+
+    def record(self, server_name, body, now):
+        keys, args = self.heartbeat_keys_args(server_name, now)
+        if self.compact:
+            keys += [server_info_bucket(server_name), key_map['server_info_hashes'], key_map['server_info'].format(server_name=server_name)]
+        else:
+            keys += [key_map['server_info'].format(server_name=server_name), key_map['server_info_hashes']]
+        args += [body, body_hash(body)]
+        self.record_status(keys=keys, args=args)
+
+    def keepalive(self, server_name, info_hash, now):
+        keys, args = self.heartbeat_keys_args(server_name, now)
+        keys += [key_map['server_info_hashes']]
+        args += [info_hash]
+        return self.keepalive_status(keys=keys, args=args) == 1
+
+    def record_many(self, statuses):
+        '''
+        Write many posts in two round trips: one to read the stored info hashes
+        and last post times, then one ZADD per shard for every timestamp plus
+        one write of just the infos which changed, along with each post's
+        history and a single event for the web UI. statuses is a dict of
+        server name -> (body, time). A body of None is a keepalive which only
+        refreshes the time. Returns dict of server name -> hash of the info
+        now stored, for the servers which posted a body.
+        '''
+        if not statuses:
+            return {}
+
+        names = statuses.keys()
+        now = max(posted for body, posted in statuses.itervalues())
+        good_time = now - self.server_staleness_duration
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hmget(key_map['server_info_hashes'], names)
+        for server_name in names:
+            pipe.zscore(server_shard_key('server_last_posts', server_name, self.shards), server_name)
+        results = pipe.execute()
+        stored_hashes, last_posts = results[0], results[1:]
+
+        infos = {}
+        hashes = {}
+        posted_hashes = {}
+        scores = defaultdict(list)
+        recovered = []
+        joined = False
+
+        pipe = self.r.pipeline(transaction=False)
+
+        for server_name, stored_hash, last_post in zip(names, stored_hashes, last_posts):
+            body, posted = statuses[server_name]
+            scores[server_shard_key('server_last_posts', server_name, self.shards)].extend((posted, server_name))
+            self.history.write(pipe, server_name, posted)
+
+            if body is None:
+                new_hash = stored_hash
+            else:
+                new_hash = posted_hashes[server_name] = body_hash(body)
+
+            if new_hash != stored_hash:
+                infos[server_name] = body
+                hashes[server_name] = new_hash
+
+            if last_post is None:
+                joined = True
+            elif last_post <= good_time:
+                recovered.append(server_name)
+
+        for key, key_scores in scores.iteritems():
+            pipe.zadd(key, *key_scores)
+        if infos:
+            write_server_infos(pipe, infos, self.compact)
+            pipe.hmset(key_map['server_info_hashes'], hashes)
+        # as in heartbeat_lua, fresher last posts alone don't change the version
+        if infos or recovered or joined:
+            pipe.incr(key_map['servers_version'])
+        for server_name in recovered:
+            pipe.publish(server_shard_key('server_recovered', server_name, self.shards), server_name)
+        pipe.publish(key_map['events'], ujson.dumps({
+            'type': 'heartbeats',
+            'servers': dict((server_name, posted) for server_name, (body, posted) in statuses.iteritems())
+        }))
+        pipe.execute()
+
+        return posted_hashes
+
+
+class HeartbeatBuffer(object):
+    '''
+    Holds agent posts in memory and writes them with record_many() every
+    flush_interval seconds, or as soon as flush_size servers are waiting.
+    Only the latest post per server is kept. If the worker dies, at most
+    flush_interval seconds (and never more than flush_size servers) worth
+    of posts are lost, which agents make up for on their next post.
+
+    Keepalives can only be buffered when this worker already knows the
+    server's stored info hash, from having written or checked it itself.
+    '''
+
+    def __init__(self, recorder, flush_interval, flush_size):
+        self.recorder = recorder
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.statuses = {}
+        self.known_hashes = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def add(self, server_name, body, now):
+        with self.lock:
+            # started on first use rather than up front so it lives in the
+            # forked worker process, not a preloading master. under the lock
+            # so concurrent first posts don't start two.
+            if self.flusher is None:
+                self.start()
+
+            self.statuses[server_name] = (body, now)
+            full = len(self.statuses) >= self.flush_size
+
+        if full:
+            self.flush()
+
+    def add_keepalive(self, server_name, info_hash, now):
+        '''
+        Buffer a keepalive if we can vouch for its hash. Returns False if it
+        has to be checked against redis instead.
+        '''
+        with self.lock:
+            if self.known_hashes.get(server_name) != info_hash:
+                return False
+
+            # never drop a pending full post in favour of a keepalive
+            if server_name in self.statuses:
+                return False
+
+        self.add(server_name, None, now)
+        return True
+
+    def confirm_hash(self, server_name, info_hash):
+        self.known_hashes[server_name] = info_hash
+
+    def start(self):
+        self.flusher = threading.Thread(target=self.run, name='heartbeat-flusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed flushing heartbeats')
+
+    def flush(self):
+        with self.lock:
+            statuses, self.statuses = self.statuses, {}
+        self.known_hashes.update(self.recorder.record_many(statuses))
+
+
+def validate_batching(flush_interval, server_staleness_duration):
+    # buffered posts mustn't sit around long enough to make a server look stale
+    if flush_interval <= 0 or flush_interval * 10 > server_staleness_duration:
+        raise ValueError('ingest_flush_interval must be positive and at most a tenth of server_staleness_duration (%s)'
+                         % server_staleness_duration)
@@ -0,0 +1,11 @@
+# HMAC signing shared by everything which sends or checks signed bodies
+
+import hmac
+import hashlib
+import base64
+
+
+def sign(key, body):
+    '''Returns the X-INTEGRITY header value for body'''
+    hmac_obj = hmac.new(key, body, hashlib.sha512)
+    return base64.urlsafe_b64encode(hmac_obj.digest())
@@ -0,0 +1,142 @@
+# leader election between alerter processes.
+#
+# the leader holds a lease: a redis key, set with NX and a PX expiry, whose
+# value is its identity plus a fencing token which goes up by one on every
+# acquisition. it renews the lease several times per ttl. standbys keep
+# trying to take the lease and get it within one ttl of the leader dying.
+#
+# a leader which stalls for longer than the ttl (GC, swap, network) can
+# wake up after someone else took over. every alerter write goes through
+# a transaction which WATCHes the lease and checks it still holds our
+# token, so a stale leader's writes are refused instead of racing the new
+# leader's.
+
+import os
+import uuid
+import socket
+import logging
+
+import redis
+
+from constants import key_map
+
+logger = logging.getLogger(__name__)
+
+
+class LostLeadership(Exception):
+    pass
+
+
+# take the lease if nobody holds it, or renew it if we do. returns our
+# fencing token, or nil if someone else is leader.
+acquire_lua = '''
+local current = redis.call('get', KEYS[1])
+if current then
+    local holder, token = string.match(current, '^(.*) (%d+)$')
+    if holder ~= ARGV[1] then
+        return nil
+    end
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return tonumber(token)
+end
+
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], ARGV[1] .. ' ' .. token, 'nx', 'px', ARGV[2])
+return token
+'''
+
+# give the lease up, only if it's still ours
+release_lua = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+def worker_identity():
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def lease_holder(value):
+    '''Identity of the holder of a lease, given the lease key's value'''
+    return value.rsplit(' ', 1)[0]
+
+
+class LeaderLease(object):
+    '''
+    A lease on alerter leadership of a shard, ttl seconds long. Call
+    acquire() at least every renew_interval seconds; it returns whether
+    we're leader.
+    '''
+
+    def __init__(self, r, ttl, identity=None, key=key_map['alerter_lease']):
+        self.r = r
+        self.ttl = ttl
+        self.renew_interval = ttl / 3.0
+        self.identity = identity or worker_identity()
+        self.key = key
+        self.token = None
+        self.acquire_script = r.register_script(acquire_lua)
+        self.release_script = r.register_script(release_lua)
+
+    @property
+    def value(self):
+        return '%s %s' % (self.identity, self.token)
+
+    def acquire(self):
+        '''
+        Take or renew the lease. Returns True if we hold it. If we only just
+        got it, self.token changes.
+        '''
+        keys = [self.key, key_map['alerter_lease_token']]
+        try:
+            token = self.acquire_script(keys=keys, args=[self.identity, int(self.ttl * 1000)])
+        except redis.RedisError:
+            logger.exception('Failed renewing alerter lease')
+            token = None
+
+        if token is None:
+            if self.token is not None:
+                logger.warning('Lost %s (token %s)', self.key, self.token)
+            self.token = None
+            return False
+
+        if token != self.token:
+            logger.info('Acquired %s as %s with token %s', self.key, self.identity, token)
+            self.token = token
+        return True
+
+    def release(self):
+        if self.token is not None:
+            self.release_script(keys=[self.key], args=[self.value])
+            self.token = None
+
+    def watch(self, pipe):
+        '''
+        Put a MULTI pipeline into a transaction which will only commit while
+        we hold the lease with our current token.
+        '''
+        pipe.watch(self.key)
+        if self.token is None or pipe.get(self.key) != self.value:
+            pipe.reset()
+            raise LostLeadership('%s no longer held by %s' % (self.key, self.value))
+        pipe.multi()
+
+
+def fenced_pipeline(r, lease=None):
+    '''
+    MULTI pipeline for alerter writes. Given a lease, its commands run only
+    if we are still the leader when it's executed with execute_fenced().
+    '''
+    pipe = r.pipeline(transaction=True)
+    if lease:
+        lease.watch(pipe)
+    return pipe
+
+
+def execute_fenced(pipe):
+    try:
+        return pipe.execute()
+    except redis.WatchError:
+        raise LostLeadership('Alerter lease changed during write')
@@ -0,0 +1,460 @@
+# in process metrics, served in the prometheus text exposition format by
+# the API at /metrics and by the alerter on a local port.
+#
+# kept deliberately cheap so they can always be on: updating a metric is a
+# dict lookup and a few additions under a lock. each process (eg each
+# gunicorn worker) has its own registry. the API's workers add theirs up in
+# redis (SharedMetrics), so whichever worker serves /metrics gives the
+# totals of all of them.
+
+import os
+import time
+import atexit
+import socket
+import logging
+import threading
+from collections import defaultdict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import redis
+import ujson
+from redis.client import StrictPipeline
+
+from constants import key_map, default_metrics_flush_interval
+
+logger = logging.getLogger(__name__)
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+default_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    '''
+    A named metric with optional labels. Call labels(*values) to get the
+    child for one combination of label values, or use the metric itself
+    if it has no labels.
+    '''
+
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        # unlabelled metrics proxy straight to their only child
+        if name in ('inc', 'dec', 'set', 'observe', 'time', 'set_function'):
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+    def render(self, children=None):
+        '''Text of the metric, with children of dict label values -> child if given instead of its own'''
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted((self.children if children is None else children).items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class CounterValue(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        '''dict of part -> number, as summed across processes by SharedMetrics'''
+        return {'': self.value}
+
+    def load(self, parts):
+        self.value = parts.get('', 0)
+        return self
+
+    def render(self, name, label_names, values):
+        return ['%s%s %s' % (name, format_labels(label_names, values), format_value(self.value))]
+
+
+class GaugeValue(CounterValue):
+    function = None
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        '''Take the value from calling function each time metrics are rendered'''
+        self.function = function
+
+    def snapshot(self):
+        return {'': self.function() if self.function else self.value}
+
+    def render(self, name, label_names, values):
+        value = self.function() if self.function else self.value
+        return ['%s%s %s' % (name, format_labels(label_names, values), format_value(value))]
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return Timer(self)
+
+    def snapshot(self):
+        parts = dict((str(i), count) for i, count in enumerate(self.counts))
+        parts.update({'sum': self.sum, 'count': self.count})
+        return parts
+
+    def load(self, parts):
+        self.counts = [int(parts.get(str(i), 0)) for i in xrange(len(self.buckets))]
+        self.sum = parts.get('sum', 0.0)
+        self.count = int(parts.get('count', 0))
+        return self
+
+    def render(self, name, label_names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (name, format_labels(label_names, values, [('le', format_value(bound))]), cumulative))
+        lines.append('%s_bucket%s %s' % (name, format_labels(label_names, values, [('le', '+Inf')]), self.count))
+        lines.append('%s_sum%s %s' % (name, format_labels(label_names, values), format_value(self.sum)))
+        lines.append('%s_count%s %s' % (name, format_labels(label_names, values), self.count))
+        return lines
+
+
+class Timer(object):
+    '''Context manager observing how long its block took'''
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Stopwatch(object):
+    '''Times consecutive phases of some work into a histogram labelled by phase'''
+
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.histogram.labels(*(self.labels + (phase,))).observe(now - self.last)
+        self.last = now
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=default_buckets):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# one per process, shared by every module's metrics
+registry = Registry()
+
+redis_command_seconds = registry.histogram(
+    'healthapp_redis_command_seconds', 'Redis round trips and their latency, by command. Pipelines count as one.', ['command'])
+redis_pipelined_commands = registry.counter(
+    'healthapp_redis_pipelined_commands_total', 'Commands sent to redis in pipelines')
+redis_errors = registry.counter(
+    'healthapp_redis_errors_total', 'Redis round trips which failed, by command', ['command'])
+
+
+class InstrumentedPipeline(StrictPipeline):
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return []
+
+        command = 'MULTI' if self.transaction else 'PIPELINE'
+        redis_pipelined_commands.inc(len(self.command_stack))
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        except redis.RedisError:
+            redis_errors.labels(command).inc()
+            raise
+        finally:
+            redis_command_seconds.labels(command).observe(time.time() - start)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    '''StrictRedis which records the latency of every round trip'''
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        except redis.RedisError:
+            redis_errors.labels(args[0]).inc()
+            raise
+        finally:
+            redis_command_seconds.labels(args[0]).observe(time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+http_request_seconds = registry.histogram(
+    'healthapp_http_request_seconds', 'API request latency by route and method', ['route', 'method'])
+http_requests = registry.counter(
+    'healthapp_http_requests_total', 'API requests by route, method and response status', ['route', 'method', 'status'])
+
+
+class RequestMetrics(object):
+    '''Falcon middleware counting and timing every request by route'''
+
+    def __init__(self, shared=None):
+        self.shared = shared
+
+    def process_request(self, req, resp):
+        req.context['metrics_start'] = time.time()
+        if self.shared:
+            self.shared.start()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        route = req.uri_template or 'other'
+        http_request_seconds.labels(route, req.method).observe(time.time() - req.context['metrics_start'])
+        http_requests.labels(route, req.method, resp.status.split(' ', 1)[0]).inc()
+
+
+class SharedMetrics(object):
+    '''
+    Adds up the registries of all the worker processes of one API server in
+    redis. Every flush_interval seconds, each process adds what its counters
+    and histograms gained since its last flush, and writes its gauges, which
+    count for as long as it keeps doing so. The totals are per master process
+    (gunicorn's or healthapp-green-api's) on this host, so they start again
+    from zero, as any process' counters would, when the API is restarted.
+    '''
+
+    # totals of API servers which stopped go after this long
+    expire_seconds = 24 * 60 * 60
+
+    def __init__(self, r, flush_interval=default_metrics_flush_interval, registry=registry):
+        self.r = r
+        self.flush_interval = flush_interval
+        self.registry = registry
+        self.server = '%s:%s' % (socket.gethostname(), os.getppid())
+        self.totals_key = key_map['metrics_totals'].format(server=self.server)
+        self.processes_key = key_map['metrics_processes'].format(server=self.server)
+        self.flushed = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def start(self):
+        # started on first use so it lives in the forked worker process
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, name='metrics-flusher')
+                self.flusher.daemon = True
+                self.flusher.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed flushing metrics')
+
+    def flush(self):
+        with self.lock:
+            pipe = self.r.pipeline(transaction=False)
+            gauges = {}
+            for metric in self.registry.metrics:
+                for values, child in metric.children.items():
+                    for part, value in child.snapshot().iteritems():
+                        field = '%s\t%s\t%s' % (metric.name, ujson.dumps(values), part)
+                        if metric.kind == 'gauge':
+                            gauges[field] = value
+                            continue
+                        gained = value - self.flushed.get(field, 0)
+                        if gained:
+                            pipe.hincrbyfloat(self.totals_key, field, gained)
+                            self.flushed[field] = value
+            pipe.hset(self.processes_key, os.getpid(), ujson.dumps({'time': time.time(), 'gauges': gauges}))
+            pipe.expire(self.totals_key, self.expire_seconds)
+            pipe.expire(self.processes_key, self.expire_seconds)
+            pipe.execute()
+
+    def render(self):
+        self.start()
+        self.flush()
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(self.totals_key)
+        pipe.hgetall(self.processes_key)
+        totals, processes = pipe.execute()
+
+        # metric name -> label values -> part -> value
+        parts = defaultdict(lambda: defaultdict(dict))
+        for field, value in totals.iteritems():
+            name, values, part = field.split('\t')
+            parts[name][tuple(ujson.loads(values))][part] = float(value)
+
+        # gauges of processes which stopped flushing, eg workers which exited,
+        # no longer count
+        gone = []
+        for pid, process in processes.iteritems():
+            process = ujson.loads(process)
+            if process['time'] < time.time() - 3 * self.flush_interval:
+                gone.append(pid)
+                continue
+            for field, value in process['gauges'].iteritems():
+                name, values, part = field.split('\t')
+                child_parts = parts[name][tuple(ujson.loads(values))]
+                child_parts[part] = child_parts.get(part, 0) + value
+        if gone:
+            self.r.hdel(self.processes_key, *gone)
+
+        lines = []
+        for metric in self.registry.metrics:
+            children = dict((values, metric.new_child().load(child_parts)) for values, child_parts in parts[metric.name].iteritems())
+            lines.extend(metric.render(children))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(object):
+    '''Serves the registry, or the totals of all workers if given SharedMetrics, at /metrics'''
+
+    def __init__(self, shared=None):
+        self.shared = shared
+
+    def on_get(self, req, resp):
+        resp.content_type = content_type
+        resp.body = self.shared.render() if self.shared else registry.render()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(address):
+    '''
+    Serve /metrics on host:port from a background thread. Returns the
+    server, or None if the port couldn't be bound, eg because another
+    alerter on this host already has it.
+    '''
+    host, port = address.rsplit(':', 1)
+    try:
+        server = HTTPServer((host, int(port)), MetricsHandler)
+    except socket.error:
+        logger.exception('Failed serving metrics on %s', address)
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on http://%s/metrics', address)
+    return server
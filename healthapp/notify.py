@@ -1,6 +1,12 @@
 import smtplib
+import socket
 import logging
+import threading
+import importlib
+import time
+from Queue import Queue
 from config import process_config
+from metrics import registry
 from email.mime.text import MIMEText
 
 logger = logging.getLogger(__name__)
@@ -17,48 +23,267 @@ message_templates = {
     'alert_closed': {
         'subject': 'Alert "%(state_name)s" closed',
         'body': '''Hi,\n\nAlert "%(state_name)s" closed after %(duration)s seconds.\n\n%(alert_id)s\n\nRegards'''
+    },
+    'digest': {
+        'subject': '%(count)s alert updates',
+        'body': '''Hi,\n\n%(summary)s\n\nRegards'''
     }
 }
 
+# notifier types usable in the notifiers config. any other type is taken
+# to be the "module:Class" path of a custom Notifier subclass.
+notifier_types = {
+    'email': 'healthapp.notify:EmailNotifier',
+    'webhook': 'healthapp.webhook:WebhookNotifier',
+}
+
+default_notification_workers = 1
+default_notification_retries = 3
+default_notification_retry_delay = 2
+
+saved_notifiers = None
+
+notification_queue_depth = registry.gauge(
+    'healthapp_notification_queue_depth', 'Notifications waiting to be sent, by notifier type', ['notifier'])
+notification_seconds = registry.histogram(
+    'healthapp_notification_send_seconds', 'Time taken to send each notification, including retries', ['notifier'])
+notification_retries = registry.counter(
+    'healthapp_notification_retries_total', 'Notification sends which failed and were retried', ['notifier'])
+notification_failures = registry.counter(
+    'healthapp_notification_failures_total', 'Notifications given up on after all retries', ['notifier'])
+
 
 def notify_alert_new(alert_id, state_name, description):
-    template = message_templates['alert_new']
-    subject = template['subject'] % {'state_name': state_name}
-    body = template['body'] % {'state_name': state_name, 'alert_id': alert_id, 'description': description}
-    send_email(subject, body)
+    for notifier in get_notifiers():
+        notifier.alert_new(alert_id, state_name, description)
 
 
 def notify_alert_closed(state_name, alert_id, duration):
-    template = message_templates['alert_closed']
-    subject = template['subject'] % {'state_name': state_name}
-    body = template['body'] % {'state_name': state_name, 'alert_id': alert_id, 'duration': duration}
-    send_email(subject, body)
+    for notifier in get_notifiers():
+        notifier.alert_closed(state_name, alert_id, duration)
 
 
 def notify_ongoing_alert(alert_id, state_name):
-    template = message_templates['alert_ongoing']
-    subject = template['subject'] % {'state_name': state_name}
-    body = template['body'] % {'state_name': state_name, 'alert_id': alert_id}
-    send_email(subject, body)
+    for notifier in get_notifiers():
+        notifier.alert_ongoing(alert_id, state_name)
+
+
+def flush_notifications():
+    '''Hand notifications queued since the last call to the workers to send'''
+    for notifier in get_notifiers():
+        notifier.flush()
+
+
+class Notifier(object):
+    '''
+    Base class for notification channels. Each gets a dict of its settings
+    from the notifiers config. alert_* calls should only queue messages;
+    they're sent after flush(), which the alerter calls at the end of each run.
+    '''
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def alert_new(self, alert_id, state_name, description):
+        raise NotImplementedError
+
+    def alert_closed(self, state_name, alert_id, duration):
+        raise NotImplementedError
+
+    def alert_ongoing(self, alert_id, state_name):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class NotificationQueue(object):
+    '''
+    Dispatches messages from a pool of worker threads so slow notification
+    channels never hold up the alert loop. Each worker gets its own sender
+    from make_sender, which must have send(message) and close() methods.
+    Failed sends are retried with exponential backoff.
+    '''
+
+    def __init__(self, make_sender, workers=default_notification_workers,
+                 retries=default_notification_retries, retry_delay=default_notification_retry_delay, name='notifier'):
+        self.make_sender = make_sender
+        self.name = name
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = Queue()
+        self.failures = 0
+
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.worker, name='notify-%s' % i)
+            worker.daemon = True
+            worker.start()
+
+    def put(self, message):
+        notification_queue_depth.labels(self.name).inc()
+        self.queue.put(message)
+
+    def join(self):
+        '''Block until everything queued so far has been sent or given up on'''
+        self.queue.join()
+
+    def worker(self):
+        sender = self.make_sender()
+
+        while True:
+            message = self.queue.get()
+            try:
+                with notification_seconds.labels(self.name).time():
+                    self.send(sender, message)
+            finally:
+                notification_queue_depth.labels(self.name).dec()
+                self.queue.task_done()
+
+    def send(self, sender, message):
+        for attempt in xrange(self.retries + 1):
+            try:
+                sender.send(message)
+                return
+            except Exception:
+                sender.close()
+                if attempt == self.retries:
+                    self.failures += 1
+                    notification_failures.labels(self.name).inc()
+                    logger.exception('Failed sending notification %s. Giving up.', message)
+                    return
+                delay = self.retry_delay * 2 ** attempt
+                notification_retries.labels(self.name).inc()
+                logger.warning('Failed sending notification %s. Retrying in %s seconds', message, delay)
+                time.sleep(delay)
+
+    @classmethod
+    def from_settings(cls, make_sender, settings):
+        return cls(make_sender,
+                   workers=settings.get('workers', default_notification_workers),
+                   retries=settings.get('retries', default_notification_retries),
+                   retry_delay=settings.get('retry_delay', default_notification_retry_delay),
+                   name=settings.get('type', 'notifier'))
+
+
+class SMTPSender(object):
+    '''
+    Sends emails over one persistent SMTP connection, opening it on first
+    use and reopening it if the server has dropped it since.
+    '''
+
+    def __init__(self, server, sender, recipients):
+        self.server = server
+        self.sender = sender
+        self.recipients = recipients
+        self.conn = None
+
+    def connect(self):
+        self.close()
+        self.conn = smtplib.SMTP(self.server)
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self.conn = None
+
+    def send(self, message):
+        subject, body = message
+        msg = MIMEText(body)
+
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = '; '.join(self.recipients)
+
+        if self.conn is None:
+            self.connect()
+
+        try:
+            self.conn.sendmail(self.sender, self.recipients, msg.as_string())
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # idle connections get dropped by the server. try once on a fresh one.
+            self.connect()
+            self.conn.sendmail(self.sender, self.recipients, msg.as_string())
+
+
+class EmailNotifier(Notifier):
+    '''
+    Emails alert transitions. Settings fall back to the top level email_*
+    configs. With digest enabled, everything from one alert run is sent as
+    a single summary email.
+    '''
+
+    def __init__(self, settings):
+        super(EmailNotifier, self).__init__(settings)
+        configs = process_config()
+        self.server = settings.get('server', configs.get('email_server'))
+        self.sender = settings.get('sender', configs.get('email_sender'))
+        self.recipients = settings.get('recipients', configs.get('email_recipients'))
+        self.digest = settings.get('digest', configs.get('email_digest', False))
+        self.pending = []
+        self.queue = NotificationQueue.from_settings(self.make_sender, settings)
+
+    def make_sender(self):
+        return SMTPSender(self.server, self.sender, self.recipients)
+
+    def send_email(self, template_name, params):
+        template = message_templates[template_name]
+        self.pending.append((template['subject'] % params, template['body'] % params))
+
+    def alert_new(self, alert_id, state_name, description):
+        self.send_email('alert_new', {'state_name': state_name, 'alert_id': alert_id, 'description': description})
+
+    def alert_closed(self, state_name, alert_id, duration):
+        self.send_email('alert_closed', {'state_name': state_name, 'alert_id': alert_id, 'duration': duration})
+
+    def alert_ongoing(self, alert_id, state_name):
+        self.send_email('alert_ongoing', {'state_name': state_name, 'alert_id': alert_id})
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+
+        if self.digest and len(pending) > 1:
+            template = message_templates['digest']
+            summary = '\n'.join(subject for subject, body in pending)
+            pending = [(template['subject'] % {'count': len(pending)}, template['body'] % {'summary': summary})]
+
+        for message in pending:
+            self.queue.put(message)
+
+
+def load_notifier(settings):
+    path = notifier_types.get(settings['type'], settings['type'])
+    module_name, class_name = path.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)(settings)
+
+
+def get_notifiers():
+    global saved_notifiers
 
+    # value is memoized so there's one set of notifiers and workers per process
+    if saved_notifiers is not None:
+        return saved_notifiers
 
-def send_email(subject, body):
-    # value is memoized so we can call this more than once without issue
     configs = process_config()
 
-    if not configs.get('enable_emails'):
-        logger.debug('Alert emails disabled')
-        return
+    notifiers_settings = configs.get('notifiers')
 
-    msg = MIMEText(body)
+    # older configs just have enable_emails
+    if notifiers_settings is None:
+        notifiers_settings = []
+        if configs.get('enable_emails'):
+            notifiers_settings.append({
+                'type': 'email',
+                'workers': configs.get('notification_workers', default_notification_workers),
+                'retries': configs.get('notification_retries', default_notification_retries),
+                'retry_delay': configs.get('notification_retry_delay', default_notification_retry_delay)
+            })
+        else:
+            logger.debug('Alert emails disabled')
 
-    msg['Subject'] = subject
-    msg['From'] = configs['email_sender']
-    msg['To'] = '; '.join(configs['email_recipients'])
+    saved_notifiers = [load_notifier(settings) for settings in notifiers_settings]
 
-    try:
-        s = smtplib.SMTP(configs['email_server'])
-        s.sendmail(configs['email_sender'], configs['email_recipients'], msg.as_string())
-        s.quit()
-    except Exception:
-        logger.exception('Failed sending email')
+    return saved_notifiers
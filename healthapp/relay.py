@@ -0,0 +1,178 @@
+# Relay (agent --relay): stands in for the API for the agents near it, eg in
+# one datacenter, and forwards their posts to the real API in one signed
+# batch every relay_flush_interval seconds. Agents point api_url at it and
+# need no other changes.
+#
+# Keepalives are answered here: if an agent's hash matches the last status
+# it sent us, that status is forwarded again as its post. Otherwise the
+# agent is told to send its full status, as the API would.
+
+import time
+import logging
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import falcon
+import ujson
+
+from agent import generate_payload
+from ingest import body_hash
+from constants import default_max_batch_body_size
+from server import read_signed_body, looks_like_json_object
+
+logger = logging.getLogger(__name__)
+
+
+class RelayBuffer(object):
+    '''
+    Latest post of each server since the last flush, forwarded in batches of
+    at most max_batch_body_size bytes. A batch which fails to send is kept to
+    try again next time, unless newer posts came in meanwhile. One the API
+    refuses (a 4xx) is dropped, as it would only be refused again and hold up
+    everything after it.
+    '''
+
+    # room for the rest of the batch body around its servers
+    batch_overhead = 1024
+
+    def __init__(self, client, api_key, flush_interval, max_batch_body_size=default_max_batch_body_size):
+        self.client = client
+        self.api_key = api_key
+        self.flush_interval = flush_interval
+        self.max_batch_body_size = max_batch_body_size
+        self.statuses = {}
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def add(self, server_name, body, now):
+        with self.lock:
+            self.statuses[server_name] = (body, now)
+            self.bodies[server_name] = (body_hash(body), body)
+
+    def add_keepalive(self, server_name, info_hash, now):
+        '''Returns False if the agent needs to send its full status'''
+        with self.lock:
+            known = self.bodies.get(server_name)
+            if not known or known[0] != info_hash:
+                return False
+            self.statuses[server_name] = (known[1], now)
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed forwarding batch')
+
+    def flush(self):
+        with self.lock:
+            statuses, self.statuses = self.statuses, {}
+
+        for batch in self.batches(statuses):
+            try:
+                self.forward(batch)
+            except Exception:
+                logger.exception('Failed forwarding posts of %s servers', len(batch))
+                with self.lock:
+                    for server_name, status in batch.iteritems():
+                        self.statuses.setdefault(server_name, status)
+
+    def batches(self, statuses):
+        '''statuses split into dicts whose batch bodies fit max_batch_body_size'''
+        batch, size = {}, self.batch_overhead
+        for server_name, status in statuses.iteritems():
+            entry_size = len(ujson.dumps({server_name: status}))
+            if batch and size + entry_size > self.max_batch_body_size:
+                yield batch
+                batch, size = {}, self.batch_overhead
+            batch[server_name] = status
+            size += entry_size
+        if batch:
+            yield batch
+
+    def forward(self, batch):
+        payload = generate_payload({'time': int(time.time()), 'servers': batch}, self.api_key)
+        r = self.client.post('batch', payload)
+        if 400 <= r.status_code < 500:
+            logger.error('API refused posts of %s servers (%s %s). Dropping them', len(batch), r.status_code, r.text[:200])
+            return
+        r.raise_for_status()
+
+        rejected = r.json().get('rejected')
+        if rejected:
+            logger.warning('API rejected posts of %s', ', '.join(rejected))
+        logger.info('Forwarded posts of %s servers', len(batch))
+
+
+class RelayStatus:
+    def __init__(self, api_key, buffer, max_body_size):
+        self.api_key = api_key
+        self.buffer = buffer
+        self.max_body_size = max_body_size
+
+    def on_post(self, req, resp, server_name):
+        raw_body = read_signed_body(req, server_name, self.api_key, self.max_body_size)
+
+        if not looks_like_json_object(raw_body):
+            raise falcon.HTTPBadRequest('Failed parsing json body')
+
+        self.buffer.add(server_name, raw_body, int(time.time()))
+
+
+class RelayHeartbeat:
+    max_body_size = 1024
+
+    def __init__(self, api_key, buffer, server_staleness_duration):
+        self.api_key = api_key
+        self.buffer = buffer
+        self.server_staleness_duration = server_staleness_duration
+
+    def on_post(self, req, resp, server_name):
+        raw_body = read_signed_body(req, server_name, self.api_key, self.max_body_size)
+
+        try:
+            body = ujson.loads(raw_body)
+            info_hash = str(body['hash'])
+            sent = float(body['time'])
+        except (ValueError, KeyError, TypeError):
+            raise falcon.HTTPBadRequest('Failed parsing json body')
+
+        now = int(time.time())
+        if abs(now - sent) > self.server_staleness_duration:
+            raise falcon.HTTPBadRequest('Stale keepalive')
+
+        if not self.buffer.add_keepalive(server_name, info_hash, now):
+            raise falcon.HTTPPreconditionFailed('Info changed', 'Post full status')
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def run_relay(client, api_key, address, flush_interval, server_staleness_duration, max_body_size,
+              max_batch_body_size=default_max_batch_body_size):
+    buffer = RelayBuffer(client, api_key, flush_interval, max_batch_body_size)
+
+    app = falcon.API()
+    app.add_route('/api/v0/status/{server_name}', RelayStatus(api_key, buffer, max_body_size))
+    app.add_route('/api/v0/heartbeat/{server_name}', RelayHeartbeat(api_key, buffer, server_staleness_duration))
+
+    flusher = threading.Thread(target=buffer.run, name='relay-flusher')
+    flusher.daemon = True
+    flusher.start()
+
+    host, port = address.rsplit(':', 1)
+    server = make_server(host, int(port), app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    logger.info('Relaying posts from %s every %s seconds', address, flush_interval)
+    try:
+        server.serve_forever()
+    finally:
+        buffer.flush()
@@ -0,0 +1,168 @@
+# purge records of ancient alerts, a bounded batch at a time, so alert
+# history and redis memory don't grow forever.
+
+import time
+import logging
+from datetime import datetime
+
+from constants import key_map, default_alert_purge_batch_size, default_alert_summary_retention_days
+from leader import fenced_pipeline, execute_fenced
+from shards import state_server_name
+from storage import read_alert_infos, delete_alerts
+
+logger = logging.getLogger(__name__)
+
+
+def alert_server_name(alert_id, info):
+    if info.get('server_name'):
+        return info['server_name']
+    if info.get('state_name'):
+        return state_server_name(info['state_name'])
+
+    # ids of the old schema look like <topic>_<server name>_<uuid>. compact
+    # storage's short ones don't say.
+    parts = alert_id.rsplit('_', 1)[0].split('_', 1)
+    return parts[1] if len(parts) == 2 else None
+
+
+class AlertPurger(object):
+    '''
+    Enforces alert retention. Rules are max age (seconds) and/or max count,
+    applied to the global alert history and optionally overridden for
+    individual servers. Each call to purge() deletes at most batch_size
+    alerts so a large backlog is worked through over several alerter ticks
+    rather than stalling one of them. Given the alerter leader lease, purges
+    only go through while we hold it. Purged alerts are rolled up into daily
+    per server summaries, which keep the last summary_days days.
+    '''
+
+    def __init__(self, r, max_age=None, max_count=None, server_rules=None, batch_size=default_alert_purge_batch_size, lease=None,
+                 compact=False, summary_days=default_alert_summary_retention_days):
+        self.r = r
+        self.lease = lease
+        self.compact = compact
+        self.max_age = max_age
+        self.max_count = max_count
+        self.server_rules = server_rules or {}
+        self.batch_size = batch_size
+        self.summary_days = summary_days
+
+    @classmethod
+    def from_configs(cls, r, configs, lease=None):
+        return cls(r,
+                   max_age=configs.get('alert_retention_max_age'),
+                   max_count=configs.get('alert_retention_max_count'),
+                   server_rules=configs.get('alert_retention_servers'),
+                   batch_size=configs.get('alert_purge_batch_size', default_alert_purge_batch_size),
+                   lease=lease,
+                   compact=configs.get('compact_storage', False),
+                   summary_days=configs.get('alert_summary_retention_days', default_alert_summary_retention_days))
+
+    def enabled(self):
+        return bool(self.max_age or self.max_count or self.server_rules)
+
+    def rules(self):
+        yield key_map['alerts_historical'], self.max_age, self.max_count
+        for server_name, rule in self.server_rules.iteritems():
+            yield key_map['server_alerts'].format(server_name=server_name), rule.get('max_age'), rule.get('max_count')
+
+    def find_expired(self, firing_ids):
+        now = time.time()
+
+        # firing alerts are never purged but may well be the oldest ones, so
+        # over fetch by that many to avoid them hogging every batch
+        num = self.batch_size + len(firing_ids)
+
+        pipe = self.r.pipeline(transaction=False)
+        rules = []
+        for key, max_age, max_count in self.rules():
+            if max_age:
+                pipe.zrangebyscore(key, '-inf', now - max_age, start=0, num=num)
+                rules.append((key, None))
+            if max_count:
+                pipe.zcard(key)
+                rules.append((key, max_count))
+        results = pipe.execute()
+
+        expired = set()
+        pipe = self.r.pipeline(transaction=False)
+        for (key, max_count), result in zip(rules, results):
+            if max_count is None:
+                expired.update(result)
+            elif result > max_count:
+                pipe.zrange(key, 0, min(result - max_count, num) - 1)
+        for result in pipe.execute():
+            expired.update(result)
+
+        expired -= firing_ids
+        return sorted(expired)[:self.batch_size]
+
+    def purge(self, firing_ids):
+        '''
+        Delete one batch of expired alerts, rolling each one up into its
+        server's daily summary first. Returns number of alerts purged.
+        '''
+        if not self.enabled():
+            return 0
+
+        alert_ids = self.find_expired(set(firing_ids))
+        if not alert_ids:
+            return 0
+
+        infos = read_alert_infos(self.r, alert_ids, self.compact)
+        server_names = [alert_server_name(alert_id, info) for alert_id, info in zip(alert_ids, infos)]
+
+        # fields of the summaries we're adding to, to drop the old days
+        oldest_day = summary_day(time.time() - self.summary_days * 24 * 60 * 60)
+        summary_keys = list(set(key_map['server_alert_summary'].format(server_name=server_name)
+                                for server_name, info in zip(server_names, infos) if info))
+        pipe = self.r.pipeline(transaction=False)
+        for key in summary_keys:
+            pipe.hkeys(key)
+        summary_fields = pipe.execute()
+
+        pipe = fenced_pipeline(self.r, self.lease)
+        for alert_id, server_name, info in zip(alert_ids, server_names, infos):
+            if info and summary_day(float(info.get('start_time', 0))) >= oldest_day:
+                rollup_alert(pipe, server_name, info)
+            pipe.zrem(key_map['alerts_historical'], alert_id)
+            if server_name:
+                pipe.zrem(key_map['server_alerts'].format(server_name=server_name), alert_id)
+        self.trim_summaries(pipe, summary_keys, summary_fields, oldest_day)
+        delete_alerts(pipe, alert_ids)
+        pipe.incr(key_map['alerts_version'])
+        execute_fenced(pipe)
+
+        logger.info('Purged %s ancient alerts', len(alert_ids))
+        return len(alert_ids)
+
+    def trim_summaries(self, pipe, keys, fields, oldest_day):
+        '''
+        Drop days before oldest_day from these summaries, and expire them
+        if summary_days pass without another rollup.
+        '''
+        for key, key_fields in zip(keys, fields):
+            # fields are "<day>:<stat>", so sort by day as strings
+            old = [field for field in key_fields if field < oldest_day]
+            if old:
+                pipe.hdel(key, *old)
+            pipe.expire(key, self.summary_days * 24 * 60 * 60)
+
+
+def summary_day(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def rollup_alert(pipe, server_name, info):
+    '''
+    Fold a closed alert into its server's daily summary hash, which keeps
+    a count and the total downtime (seconds) of alerts started each day.
+    '''
+    day = summary_day(float(info.get('start_time', 0)))
+    summary_key = key_map['server_alert_summary'].format(server_name=server_name)
+
+    pipe.hincrby(summary_key, '%s:count' % day, 1)
+
+    duration = info.get('duration')
+    if duration:
+        pipe.hincrbyfloat(summary_key, '%s:downtime' % day, float(duration))
@@ -6,37 +6,51 @@ import falcon
 import redis
 import time
 import ujson
-import re
 import os
 import hashlib
 import base64
 import hmac
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from operator import itemgetter
 
-from constants import key_map, default_server_staleness_duration, alert_topic_map
+from constants import (key_map, default_server_staleness_duration, default_list_cache_ttl, default_list_cache_size, default_max_status_body_size,
+                       default_max_batch_body_size, default_ingest_flush_interval, default_ingest_flush_size,
+                       default_heartbeat_history_days, default_heartbeat_rollup_days, default_events_heartbeat_interval,
+                       default_events_keepalive_interval, default_events_max_pending, default_events_max_streams,
+                       default_metrics_flush_interval, alert_topic_map)
 from config import process_config
-
-mimes = {'.css': 'text/css',
-         '.jpg': 'image/jpeg',
-         '.js': 'text/javascript',
-         '.png': 'image/png',
-         '.svg': 'image/svg+xml',
-         '.ttf': 'application/octet-stream',
-         '.woff': 'application/font-woff'}
+from ingest import StatusRecorder, HeartbeatBuffer, validate_batching
+from shards import server_shard_key, all_shard_keys
+from storage import read_server_infos, read_alert_infos
+from metrics import InstrumentedRedis, RequestMetrics, MetricsResource, SharedMetrics
+from history import HeartbeatHistory, find_gaps, find_hourly_gaps, uptime_percent
+from events import EventHub, EventStream
+from assets import AssetTable, StaticResource, SinglePageApp, etag_matches
 
 ui_root = os.path.abspath(os.path.dirname(__file__))
 
-_filename_ascii_strip_re = re.compile(r'[^A-Za-z0-9_.-]')
-
 
 def confirm_hmac(r, server_name, body, api_key, given_hmac):
     hmac_obj = hmac.new(api_key, body, hashlib.sha512)
     return hmac.compare_digest(hmac_obj.digest(), given_hmac)
 
 
-def get_server_info(r, server_name):
-    info = r.get(key_map['server_info'].format(server_name=server_name))
+# how many keys to fetch per pipeline when hydrating large lists of
+# servers or alerts. keeps individual pipelines from ballooning.
+hydrate_batch_size = 1000
+
+# how long a request waits for a free connection from a bounded redis pool
+redis_pool_timeout = 5
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def parse_server_info(server_name, info, last_updated):
     if not info:
         return {}
 
@@ -47,16 +61,46 @@ def get_server_info(r, server_name):
 
     data['name'] = server_name
 
-    last_updated = r.zscore(key_map['server_last_posts'], server_name)
-
     if last_updated:
         data['Last Updated'] = str(datetime.fromtimestamp(last_updated))
 
     return data
 
 
-def get_alert_info(r, alert_id):
-    info = r.hgetall(key_map['alert_info'].format(alert_id=alert_id))
+def get_servers_info(r, server_names, last_posts=None, shards=1, compact=False):
+    '''
+    Fetch info for many servers using one pipelined round trip per batch.
+    Returns dict of server name -> info. Pass last_posts (dict of server
+    name -> score) if the caller already has the last post times.
+    '''
+    server_names = list(set(server_names))
+    servers = {}
+
+    for batch in chunks(server_names, hydrate_batch_size):
+        pipe = r.pipeline(transaction=False)
+        info_results, read_infos = read_server_infos(pipe, batch, compact)
+        if last_posts is None:
+            for server_name in batch:
+                pipe.zscore(server_shard_key('server_last_posts', server_name, shards), server_name)
+        results = pipe.execute()
+        infos = read_infos(r, results[:info_results])
+
+        if last_posts is None:
+            scores = results[info_results:]
+        else:
+            scores = [last_posts.get(server_name) for server_name in batch]
+
+        for server_name, info, last_updated in zip(batch, infos, scores):
+            servers[server_name] = parse_server_info(server_name, info, last_updated)
+
+    return servers
+
+
+def get_server_info(r, server_name, shards=1, compact=False):
+    return get_servers_info(r, [server_name], shards=shards, compact=compact).get(server_name, {})
+
+
+def parse_alert_info(alert_id, info):
     if not info:
         return {}
 
@@ -84,133 +128,497 @@ def get_alert_info(r, alert_id):
 
     info['human_bad'] = alert_topic_map.get(alert_parts[0], alert_parts[0])
 
-    server_name = info.get('server_name')
+    return info
 
-    if not server_name:
-        server_name = alert_parts[1]
 
-    info['server'] = get_server_info(r, server_name)
+def alert_server_name(info):
+    return info.get('server_name') or info['state_name'].split('_', 1)[1]
 
-    # server record missing. possible if you've manually deleted records
-    if not info['server']:
-        info['server'] = {'name': alert_parts[1], 'OS': 'Linux'}
 
-    return info
+def get_alerts_info(r, alert_ids, shards=1, compact=False):
+    '''
+    Hydrate many alerts at once. Alert hashes are fetched in pipelined
+    batches and the servers they reference are deduped and fetched together
+    afterwards, so this costs a handful of round trips instead of ~3 per
+    alert. Returns list of alert infos in the same order as alert_ids,
+    skipping alerts which no longer exist.
+    '''
+    alerts = []
 
+    for batch in chunks(list(alert_ids), hydrate_batch_size):
+        for alert_id, info in zip(batch, read_alert_infos(r, batch, compact)):
+            info = parse_alert_info(alert_id, info)
+            if info:
+                alerts.append(info)
 
-class StaticResource(object):
-    def __init__(self, path):
-        self.path = path.lstrip('/')
+    servers = get_servers_info(r, (alert_server_name(info) for info in alerts), shards=shards, compact=compact)
 
-    def on_get(self, req, resp, filename):
-        suffix = os.path.splitext(req.path)[1]
-        resp.content_type = mimes.get(suffix, 'application/octet-stream')
+    for info in alerts:
+        info['server'] = servers.get(alert_server_name(info))
+
+        # server record missing. possible if you've manually deleted records
+        if not info['server']:
+            info['server'] = {'name': info['state_name'].split('_', 1)[1], 'OS': 'Linux'}
+
+    return alerts
+
+
+def get_alert_info(r, alert_id, shards=1, compact=False):
+    alerts = get_alerts_info(r, [alert_id], shards, compact)
+    if not alerts:
+        return {}
+    return alerts[0]
+
+
+def get_alert_summary(r, server_name):
+    '''
+    Daily rollups of purged alerts for this server. Returns dict of
+    day -> {'count': .., 'downtime': ..}
+    '''
+    summary = {}
+    for field, value in r.hgetall(key_map['server_alert_summary'].format(server_name=server_name)).iteritems():
+        day, stat = field.split(':', 1)
+        summary.setdefault(day, {'count': 0, 'downtime': 0.0})[stat] = int(value) if stat == 'count' else float(value)
+    return summary
 
-        filepath = os.path.join(ui_root, self.path, secure_filename(filename))
-        try:
-            resp.stream = open(filepath, 'rb')
-            resp.stream_len = os.path.getsize(filepath)
-        except IOError:
-            raise falcon.HTTPNotFound()
 
+def looks_like_json_object(body):
+    # full parsing is left to whoever reads the info back. this only
+    # rejects anything which obviously isn't a JSON object.
+    body = body.strip()
+    return body.startswith('{') and body.endswith('}')
 
-def secure_filename(filename):
-    for sep in os.path.sep, os.path.altsep:
-        if sep:
-            filename = filename.replace(sep, ' ')
-    filename = str(_filename_ascii_strip_re.sub('', '_'.join(
-        filename.split()))).strip('._')
-    return filename
 
+def read_signed_body(req, server_name, api_key, max_body_size):
+    '''
+    Read an agent's request body, bounded by max_body_size, and check its
+    X-INTEGRITY header against it.
+    '''
+    hmac_header = req.get_header('X-INTEGRITY')
 
-def home_route(req, resp):
-    resp.content_type = 'text/html'
-    resp.body = open(os.path.join(ui_root, 'static/spa.html')).read()
+    if not hmac_header:
+        raise falcon.HTTPUnauthorized('Missing hmac token')
+
+    hmac_digest = base64.urlsafe_b64decode(hmac_header)
+
+    if req.content_length and req.content_length > max_body_size:
+        raise falcon.HTTPRequestEntityTooLarge('Body too large', 'Max %s bytes' % max_body_size)
+
+    raw_body = req.stream.read(max_body_size + 1)
+
+    if len(raw_body) > max_body_size:
+        raise falcon.HTTPRequestEntityTooLarge('Body too large', 'Max %s bytes' % max_body_size)
+
+    if not confirm_hmac(None, server_name, raw_body, api_key, hmac_digest):
+        raise falcon.HTTPUnauthorized('Incorrect hmac')
+
+    return raw_body
 
 
 class ServerStatus:
-    def __init__(self, r, api_key):
+    def __init__(self, r, api_key, recorder, buffer=None, max_body_size=default_max_status_body_size):
         self.r = r
         self.api_key = api_key
+        self.recorder = recorder
+        self.buffer = buffer
+        self.max_body_size = max_body_size
 
     def on_post(self, req, resp, server_name):
-        hmac_header = req.get_header('X-INTEGRITY')
+        raw_body = read_signed_body(req, server_name, self.api_key, self.max_body_size)
+
+        if not looks_like_json_object(raw_body):
+            raise falcon.HTTPBadRequest('Failed parsing json body')
+
+        now = int(time.time())
+
+        if self.buffer:
+            self.buffer.add(server_name, raw_body, now)
+        else:
+            self.recorder.record(server_name, raw_body, now)
+
+    def on_get(self, req, resp, server_name):
+        info = get_server_info(self.r, server_name, self.recorder.shards, self.recorder.compact)
 
-        if not hmac_header:
-            raise falcon.HTTPUnauthorized('Missing hmac token')
+        if not info:
+            raise falcon.HTTPNotFound()
+
+        resp.body = ujson.dumps(info)
 
-        hmac_digest = base64.urlsafe_b64decode(hmac_header)
 
-        raw_body = req.stream.read()
+class ServerHeartbeat:
+    '''
+    Keepalive from an agent whose stats haven't changed since its last full
+    post. The body is just {"hash": <sha1 of that post's body>, "time": ..}.
+    Answers 412 if the stored info has a different hash, in which case the
+    agent should post its full status instead.
+    '''
 
-        if not confirm_hmac(self.r, server_name, raw_body, self.api_key, hmac_digest):
-            raise falcon.HTTPUnauthorized('Incorrect hmac')
+    # plenty for the hash and timestamp
+    max_body_size = 1024
+
+    def __init__(self, api_key, recorder, buffer, server_staleness_duration):
+        self.api_key = api_key
+        self.recorder = recorder
+        self.buffer = buffer
+        self.server_staleness_duration = server_staleness_duration
+
+    def on_post(self, req, resp, server_name):
+        raw_body = read_signed_body(req, server_name, self.api_key, self.max_body_size)
 
         try:
-            ujson.loads(raw_body)
-        except ValueError:
+            body = ujson.loads(raw_body)
+            info_hash = str(body['hash'])
+            sent = float(body['time'])
+        except (ValueError, KeyError, TypeError):
             raise falcon.HTTPBadRequest('Failed parsing json body')
 
-        self.r.set(key_map['server_info'].format(server_name=server_name), raw_body)
-
         now = int(time.time())
-        self.r.zadd(key_map['server_last_posts'], now, server_name)
 
-    def on_get(self, req, resp, server_name):
-        info = get_server_info(self.r, server_name)
+        # don't let an old keepalive be replayed to keep a dead server looking alive
+        if abs(now - sent) > self.server_staleness_duration:
+            raise falcon.HTTPBadRequest('Stale keepalive')
 
-        if not info:
-            raise falcon.HTTPNotFound()
+        if self.buffer and self.buffer.add_keepalive(server_name, info_hash, now):
+            return
 
-        resp.body = ujson.dumps(info)
+        if not self.recorder.keepalive(server_name, info_hash, now):
+            raise falcon.HTTPPreconditionFailed('Info changed', 'Post full status')
+
+        if self.buffer:
+            self.buffer.confirm_hash(server_name, info_hash)
+
+
+class ServerStatusBatch:
+    '''
+    Posts of many servers at once, from a relay (agent --relay) which
+    collected them from the agents near it. The body is signed as a whole:
+    {"time": <when sent>, "servers": {<server name>: [<status body>, <when
+    received>], ..}}. Answers with the names of any servers whose status
+    was rejected.
+    '''
+
+    def __init__(self, api_key, recorder, buffer, server_staleness_duration, max_body_size=default_max_batch_body_size,
+                 max_status_body_size=default_max_status_body_size):
+        self.api_key = api_key
+        self.recorder = recorder
+        self.buffer = buffer
+        self.server_staleness_duration = server_staleness_duration
+        self.max_body_size = max_body_size
+        self.max_status_body_size = max_status_body_size
+
+    def on_post(self, req, resp, relay_name):
+        raw_body = read_signed_body(req, relay_name, self.api_key, self.max_body_size)
+
+        try:
+            body = ujson.loads(raw_body)
+            sent = float(body['time'])
+            servers = body['servers'].items()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise falcon.HTTPBadRequest('Failed parsing json body')
+
+        now = int(time.time())
+
+        # as with keepalives, don't let a batch be replayed
+        if abs(now - sent) > self.server_staleness_duration:
+            raise falcon.HTTPBadRequest('Stale batch')
+
+        statuses = {}
+        rejected = []
+        for server_name, status in servers:
+            try:
+                status_body, received = status
+                received = int(received)
+            except (ValueError, TypeError):
+                rejected.append(server_name)
+                continue
+
+            if not isinstance(status_body, basestring):
+                rejected.append(server_name)
+                continue
+
+            # stored as the agent posted it, which is utf-8
+            if isinstance(status_body, unicode):
+                status_body = status_body.encode('utf-8')
+
+            if len(status_body) > self.max_status_body_size or not looks_like_json_object(status_body):
+                rejected.append(server_name)
+                continue
+
+            # posts waited at the relay for a few seconds at most. never
+            # record one as newer than now, or older than the batch allows.
+            statuses[server_name] = (status_body, max(min(received, now), now - self.server_staleness_duration))
+
+        if self.buffer:
+            for server_name, (status_body, received) in statuses.iteritems():
+                self.buffer.add(server_name, status_body, received)
+        else:
+            self.recorder.record_many(statuses)
+
+        resp.body = ujson.dumps({'accepted': len(statuses), 'rejected': rejected})
+
+
+class ServerUptime:
+    '''
+    Uptime percentage and list of heartbeat gaps for a server between start
+    and end (default the last day). resolution=raw uses individual
+    heartbeats, which are kept for a shorter time than the hourly rollups
+    used by resolution=hourly. start is moved up to the oldest day kept.
+    '''
+
+    def __init__(self, r, history, server_staleness_duration):
+        self.r = r
+        self.history = history
+        self.server_staleness_duration = server_staleness_duration
+
+    def on_get(self, req, resp, server_name):
+        now = int(time.time())
+        end = min(get_param_as_score(req, 'end') or now, now)
+        start = get_param_as_score(req, 'start') or end - 24 * 60 * 60
+        max_gap = get_param_as_score(req, 'max_gap') or self.server_staleness_duration
+        resolution = req.get_param('resolution') or 'raw'
+
+        if resolution not in ('raw', 'hourly'):
+            raise falcon.HTTPInvalidParam('Must be one of raw, hourly', 'resolution')
+
+        # reads cost a key per day, so stop at the oldest day still kept
+        start = max(start, self.history.earliest(now, resolution == 'hourly'))
+        if start >= end:
+            raise falcon.HTTPInvalidParam('Must be before end, within the history kept', 'start')
+
+        if resolution == 'raw':
+            timestamps = self.history.read(self.r, server_name, start, end)
+            heartbeats = len(timestamps)
+            gaps = find_gaps(timestamps, start, end, max_gap)
+        else:
+            hours = self.history.read_hourly(self.r, server_name, start, end)
+            heartbeats = sum(count for hour_start, count in hours)
+            gaps = find_hourly_gaps(hours, start, end)
+
+        resp.body = ujson.dumps({
+            'server': server_name,
+            'start': start,
+            'end': end,
+            'resolution': resolution,
+            'heartbeats': heartbeats,
+            'uptime_percent': uptime_percent(start, end, gaps),
+            'gaps': gaps
+        })
+
+
+class ResponseCache(object):
+    '''
+    Conditional GET support and a short lived in-process cache of serialized
+    responses for the list endpoints. Both are keyed on redis counters which
+    get bumped whenever the data behind a response changes, so an unchanged
+    list costs one MGET instead of a full rebuild, and nothing at all to send
+    if the client already has it.
+
+    Bodies are kept in the order they were rendered, which is also the order
+    they expire in, and there are at most max_entries of them: the query
+    string is up to the client.
+    '''
+
+    def __init__(self, r, ttl, max_entries=default_list_cache_size):
+        self.r = r
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def respond(self, req, resp, version_keys, render, salt=''):
+        versions = self.r.mget([key_map[key] for key in version_keys])
+        key = '%s?%s' % (req.path, req.query_string)
+        etag = '"%s"' % hashlib.sha1('%s|%s|%s' % (key, versions, salt)).hexdigest()
+
+        # have browsers revalidate every time, which mostly gets them a 304
+        resp.etag = etag
+        resp.cache_control = ['no-cache']
+
+        if etag_matches(req, etag):
+            resp.status = falcon.HTTP_304
+            return
+
+        now = time.time()
+        cached = self.bodies.get(key)
+        if cached and cached[0] == etag and cached[1] > now:
+            resp.body = cached[2]
+            return
+
+        body = render(req)
+        with self.lock:
+            self.bodies.pop(key, None)
+            self.bodies[key] = (etag, now + self.ttl, body)
+            while self.bodies:
+                oldest = next(self.bodies.itervalues())
+                if oldest[1] > now and len(self.bodies) <= self.max_entries:
+                    break
+                self.bodies.popitem(last=False)
+        resp.body = body
 
 
 class ServerList:
-    def __init__(self, r, server_staleness_duration):
+    def __init__(self, r, server_staleness_duration, cache, shards=1, compact=False):
         self.r = r
         self.server_staleness_duration = server_staleness_duration
+        self.cache = cache
+        self.shards = shards
+        self.compact = compact
 
     def on_get(self, req, resp):
+        # the servers version changes with servers' infos, and when they join
+        # or come back from being stale, but not with every post. servers turn
+        # stale by not posting, which changes nothing, unless the alerter
+        # notices. so let the etag go stale every tenth of the staleness
+        # duration too, which also keeps last post times shown fresh enough.
+        self.cache.respond(req, resp, ('servers_version', 'alerts_version'), self.render,
+                           salt=int(time.time() * 10 / self.server_staleness_duration))
+
+    def render(self, req):
         good_time = time.time() - self.server_staleness_duration
-        servers = self.r.zrange(key_map['server_last_posts'], 0, -1, withscores=True)
+        pipe = self.r.pipeline(transaction=False)
+        for key in all_shard_keys('server_last_posts', self.shards):
+            pipe.zrange(key, 0, -1, withscores=True)
+        servers = [server for shard in pipe.execute() for server in shard]
+        last_posts = dict(servers)
+        infos = get_servers_info(self.r, last_posts.keys(), last_posts, compact=self.compact)
         pretty = ({
             'name': name,
             'time': str(datetime.fromtimestamp(date)),
             'good': date >= good_time,
-            'info': get_server_info(self.r, name)
+            'info': infos[name]
         } for name, date in servers)
-        resp.body = ujson.dumps({'servers': sorted(pretty, key=itemgetter('name'))})
+        return ujson.dumps({'servers': sorted(pretty, key=itemgetter('name'))})
 
 
-class AlertList:
-    def __init__(self, r):
-        self.r = r
+def get_param_as_score(req, name):
+    value = req.get_param(name)
+    if value is None:
+        return None
 
-    def on_get(self, req, resp):
-        active_ids = set()
-        active_alerts = []
+    try:
+        return float(value)
+    except ValueError:
+        raise falcon.HTTPInvalidParam('Must be a timestamp', name)
 
-        for state_name, alert_id in self.r.hgetall(key_map['alert_currently_firing']).iteritems():
-            active_alerts.append(get_alert_info(self.r, alert_id))
-            active_ids.add(alert_id)
 
-        historical_alerts = []
+def get_param_as_cursor(req, name):
+    '''(score, alert id) from a next cursor, or (score, None) from a plain timestamp'''
+    value = req.get_param(name)
+    if value is None:
+        return None, None
 
-        for alert_id in self.r.zrevrange(key_map['alerts_historical'], 0, -1):
-            if alert_id not in active_ids:
-                info = get_alert_info(self.r, alert_id)
-                if info:
-                    historical_alerts.append(info)
+    score, _, alert_id = value.partition(':')
+    try:
+        return float(score), alert_id or None
+    except ValueError:
+        raise falcon.HTTPInvalidParam('Must be a timestamp or a next cursor', name)
 
-        resp.body = ujson.dumps({'active': active_alerts, 'historical': historical_alerts})
+
+class AlertList:
+    def __init__(self, r, cache, default_limit=50, max_limit=500, shards=1, compact=False):
+        self.r = r
+        self.cache = cache
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.shards = shards
+        self.compact = compact
+
+    def on_get(self, req, resp):
+        # ongoing alerts' durations grow without anything changing in redis, so
+        # let the etag go stale once a minute
+        self.cache.respond(req, resp, ('alerts_version',), self.render, salt=int(time.time() / 60))
+
+    def render(self, req):
+        limit = req.get_param_as_int('limit', min=1, max=self.max_limit) or self.default_limit
+        before, before_id = get_param_as_cursor(req, 'before')
+        after = get_param_as_score(req, 'after')
+        server_name = req.get_param('server')
+        state = req.get_param('state') or 'all'
+
+        if state not in ('all', 'active', 'closed'):
+            raise falcon.HTTPInvalidParam('Must be one of all, active, closed', 'state')
+
+        # historical alerts are paged newest first, using the start time score
+        # and id of the last one sent as the cursor. scope to the per server
+        # set (and its shard's firing alerts) if we were asked for one server.
+        if server_name:
+            historical_key = key_map['server_alerts'].format(server_name=server_name)
+            firing_keys = [server_shard_key('alert_currently_firing', server_name, self.shards)]
+        else:
+            historical_key = key_map['alerts_historical']
+            firing_keys = all_shard_keys('alert_currently_firing', self.shards)
+
+        max_score = '(%r' % before if before is not None else '+inf'
+        min_score = '(%r' % after if after is not None else '-inf'
+
+        pipe = self.r.pipeline(transaction=False)
+        for key in firing_keys:
+            pipe.hgetall(key)
+        if state != 'active':
+            if before_id is not None:
+                pipe.zrevrank(historical_key, before_id)
+            else:
+                # grab one extra so we know whether there's another page
+                pipe.zrevrangebyscore(historical_key, max_score, min_score, start=0, num=limit + 1, withscores=True)
+        results = pipe.execute()
+
+        historical = results.pop() if state != 'active' else []
+        if state != 'active' and before_id is not None:
+            historical = self.after_cursor(historical_key, historical, before, before_id, after, limit + 1)
+
+        active = {}
+        for shard_active in results:
+            active.update(shard_active)
+
+        next_cursor = None
+        if len(historical) > limit:
+            historical = historical[:limit]
+            next_cursor = '%r:%s' % (historical[-1][1], historical[-1][0])
+
+        # active alerts are few, so always send them all with the first page
+        active_ids = set(alert_id for state_name, alert_id in active.iteritems()
+                         if not server_name or state_name.split('_', 1)[1] == server_name)
+        historical_ids = [alert_id for alert_id, score in historical if alert_id not in active_ids]
+
+        if state == 'closed' or before is not None:
+            active_ids = set()
+
+        # hydrate both lists together so servers shared between them are only fetched once
+        alerts = get_alerts_info(self.r, list(active_ids) + historical_ids, self.shards, self.compact)
+
+        active_alerts = [info for info in alerts if info['alert_id'] in active_ids]
+        historical_alerts = [info for info in alerts if info['alert_id'] not in active_ids]
+
+        return ujson.dumps({'active': active_alerts, 'historical': historical_alerts, 'next': next_cursor})
+
+    def after_cursor(self, key, rank, before, before_id, after, count):
+        '''
+        count alerts from key which come after the cursor's, newest first.
+        alerts created in one alerter run share a score, so this resumes from
+        the cursor's alert itself rather than from its score.
+        '''
+        if rank is not None:
+            historical = self.r.zrevrange(key, rank + 1, rank + count, withscores=True)
+        else:
+            # the cursor's alert has been purged since. ties come in reverse id
+            # order, so skip those at or above its id.
+            ties = self.r.zcount(key, before, before)
+            historical = self.r.zrevrangebyscore(key, repr(before), '-inf', start=0, num=count + ties, withscores=True)
+            historical = [(alert_id, score) for alert_id, score in historical if score != before or alert_id < before_id][:count]
+
+        if after is not None:
+            historical = [(alert_id, score) for alert_id, score in historical if score > after]
+        return historical
 
 
 class Alert:
-    def __init__(self, r):
+    def __init__(self, r, shards=1, compact=False):
         self.r = r
+        self.shards = shards
+        self.compact = compact
 
     def on_get(self, req, resp, alert_id):
-        info = get_alert_info(self.r, alert_id)
+        info = get_alert_info(self.r, alert_id, self.shards, self.compact)
 
         if not info:
             raise falcon.HTTPNotFound()
@@ -218,29 +626,95 @@ class Alert:
         resp.body = ujson.dumps(info)
 
 
-def get_app():
+class ServerAlertSummary:
+    def __init__(self, r):
+        self.r = r
+
+    def on_get(self, req, resp, server_name):
+        resp.body = ujson.dumps({'server': server_name, 'days': get_alert_summary(self.r, server_name)})
+
+
+def get_redis(redis_url, max_connections=None):
+    '''
+    Redis client for the API. Given max_connections, concurrent requests
+    share a pool of at most that many connections, waiting for a free one
+    rather than each opening their own.
+    '''
+    if not max_connections:
+        return InstrumentedRedis.from_url(redis_url)
+
+    pool = redis.BlockingConnectionPool.from_url(redis_url, max_connections=max_connections, timeout=redis_pool_timeout)
+    return InstrumentedRedis(connection_pool=pool)
+
+
+def get_app(redis_max_connections=None, events_max_streams=default_events_max_streams):
     configs = process_config()
 
     redis_url = configs.get('redis', 'localhost:6379')
     server_staleness_duration = configs.get('server_staleness_duration', default_server_staleness_duration)
     api_key = configs.get('api_key')
+    list_cache_ttl = configs.get('list_cache_ttl', default_list_cache_ttl)
+    max_status_body_size = configs.get('max_status_body_size', default_max_status_body_size)
+    max_batch_body_size = configs.get('max_batch_body_size', default_max_batch_body_size)
+    shards = configs.get('alerter_shards', 1)
+    compact = configs.get('compact_storage', False)
+
+    r = get_redis(redis_url, configs.get('redis_max_connections', redis_max_connections))
+
+    history = HeartbeatHistory(configs.get('heartbeat_history_days', default_heartbeat_history_days),
+                               configs.get('heartbeat_rollup_days', default_heartbeat_rollup_days))
+    recorder = StatusRecorder(r, server_staleness_duration, history, shards, compact)
+
+    # optionally buffer agent posts and write them in batches
+    buffer = None
+    if configs.get('ingest_batching'):
+        flush_interval = configs.get('ingest_flush_interval', default_ingest_flush_interval)
+        validate_batching(flush_interval, server_staleness_duration)
+        buffer = HeartbeatBuffer(recorder, flush_interval, configs.get('ingest_flush_size', default_ingest_flush_size))
+
+    # shared by all of this worker's requests
+    cache = ResponseCache(r, list_cache_ttl, configs.get('list_cache_size', default_list_cache_size))
+    assets = AssetTable(os.path.join(ui_root, 'static'))
+    hub = EventHub(r, configs.get('events_heartbeat_interval', default_events_heartbeat_interval),
+                   configs.get('events_max_pending', default_events_max_pending), configs.get('events_max_streams', events_max_streams))
 
-    r = redis.StrictRedis.from_url(redis_url)
+    # each worker's metrics, added up in redis so /metrics shows them all
+    shared_metrics = SharedMetrics(r, configs.get('metrics_flush_interval', default_metrics_flush_interval))
 
-    app = falcon.API()
+    app = falcon.API(middleware=[RequestMetrics(shared_metrics)])
 
     # Get updates from servers
-    app.add_route('/api/v0/status/{server_name}', ServerStatus(r, api_key))
+    app.add_route('/api/v0/status/{server_name}', ServerStatus(r, api_key, recorder, buffer, max_status_body_size))
+
+    # Cheap keepalives from agents whose stats haven't changed
+    app.add_route('/api/v0/heartbeat/{server_name}', ServerHeartbeat(api_key, recorder, buffer, server_staleness_duration))
+
+    # Many servers' posts at once, from relays
+    app.add_route('/api/v0/batch/{relay_name}', ServerStatusBatch(api_key, recorder, buffer, server_staleness_duration,
+                                                                  max_batch_body_size, max_status_body_size))
 
     # General listing of servers and their last status update
-    app.add_route('/api/v0/servers', ServerList(r, server_staleness_duration))
+    app.add_route('/api/v0/servers', ServerList(r, server_staleness_duration, cache, shards, compact))
+
+    # List alerts. All active + 50 historical by default. Older alerts are
+    # fetched by passing the returned "next" cursor back as "before".
+    app.add_route('/api/v0/alerts', AlertList(r, cache, shards=shards, compact=compact))
+    app.add_route('/api/v0/alert/{alert_id}', Alert(r, shards, compact))
+
+    # Uptime and missed heartbeats over time
+    app.add_route('/api/v0/uptime/{server_name}', ServerUptime(r, history, server_staleness_duration))
+
+    # Daily counts and downtime of alerts which have since been purged
+    app.add_route('/api/v0/alert_summary/{server_name}', ServerAlertSummary(r))
+
+    # Live updates for the web UI
+    app.add_route('/api/v0/events', EventStream(hub, configs.get('events_keepalive_interval', default_events_keepalive_interval)))
 
-    # List alerts. All active + 50 historical.
-    app.add_route('/api/v0/alerts', AlertList(r))
-    app.add_route('/api/v0/alert/{alert_id}', Alert(r))
+    # Request, redis and notification stats of all this API server's worker processes
+    app.add_route('/metrics', MetricsResource(shared_metrics))
 
     # Pertaining to web UI
-    app.add_route('/static/{filename}', StaticResource('/static'))
-    app.add_sink(home_route, '/')
+    app.add_route('/static/{filename}', StaticResource(assets))
+    app.add_sink(SinglePageApp(assets), '/')
 
     return app
@@ -0,0 +1,51 @@
+# partitioning of servers between alerter workers.
+#
+# each server belongs to one of alerter_shards shards, picked with jump
+# consistent hashing of its name so going from N to N+1 shards only moves
+# about 1/(N+1) of servers. each shard has its own last post sorted set,
+# firing alerts hash and recovery channel, and is processed by whichever
+# alerter holds its lease. with one shard the key names are the unsharded
+# ones.
+
+import hashlib
+
+from constants import key_map
+
+# keys which are split per shard
+sharded_keys = ('server_last_posts', 'alert_currently_firing', 'server_recovered', 'alerter_lease', 'alert_ticks',
+                'alert_recently_closed')
+
+
+def jump_hash(key, buckets):
+    '''Lamping and Veach's jump consistent hash of a 64 bit key'''
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_of(server_name, shards):
+    if shards == 1:
+        return 0
+    return jump_hash(int(hashlib.md5(server_name).hexdigest()[:16], 16), shards)
+
+
+def shard_key(name, shard, shards):
+    if shards == 1:
+        return key_map[name]
+    return '%s:%d' % (key_map[name], shard)
+
+
+def server_shard_key(name, server_name, shards):
+    return shard_key(name, shard_of(server_name, shards), shards)
+
+
+def all_shard_keys(name, shards):
+    return [shard_key(name, shard, shards) for shard in xrange(shards)]
+
+
+def state_server_name(state_name):
+    # alert state names look like <topic>_<server name>
+    return state_name.split('_', 1)[1]
@@ -3,6 +3,21 @@ function init_healthapp() {
     return str ? 'Yes' : 'no';
   });
 
+  // render a server stat, showing nested stats (eg per disk) as nested tables
+  function format_stat(value) {
+    if (value === null || typeof value !== 'object') {
+      return Handlebars.Utils.escapeExpression(value);
+    }
+    var rows = $.map(value, function(inner, key) {
+      return '<tr><td>' + Handlebars.Utils.escapeExpression(key) + '</td><td>' + format_stat(inner) + '</td></tr>';
+    });
+    return '<table class="table table-condensed">' + rows.join('') + '</table>';
+  }
+
+  Handlebars.registerHelper('stat', function(value) {
+    return new Handlebars.SafeString(format_stat(value));
+  });
+
   function get_servers(callback) {
     $.get('/api/v0/servers', callback);
   }
@@ -15,12 +30,25 @@ function init_healthapp() {
     $.get('/api/v0/alerts', callback);
   }
 
+  function get_older_alerts(before, callback) {
+    $.get('/api/v0/alerts', {state: 'closed', before: before}, callback);
+  }
+
   function get_alert(alert_id, callback) {
     $.get('/api/v0/alert/' + alert_id, callback);
   }
 
+  Handlebars.registerPartial('server_row', $('#server-row-template').html());
+  Handlebars.registerPartial('active_alert_row', $('#active-alert-row-template').html());
+  Handlebars.registerPartial('historical_alert_row', $('#historical-alert-row-template').html());
+  Handlebars.registerPartial('historical_alert_rows', $('#historical-alert-rows-template').html());
+
   var server_list = Handlebars.compile($('#server-list-template').html()),
+      server_row = Handlebars.compile($('#server-row-template').html()),
       alert_list = Handlebars.compile($('#alert-list-template').html()),
+      active_alert_row = Handlebars.compile($('#active-alert-row-template').html()),
+      historical_alert_row = Handlebars.compile($('#historical-alert-row-template').html()),
+      historical_alert_rows = Handlebars.compile($('#historical-alert-rows-template').html()),
       flash_template = Handlebars.compile($('#flash-template').html()),
       server_view = Handlebars.compile($('#server-view-template').html()),
       alert_view = Handlebars.compile($('#alert-view-template').html()),
@@ -29,7 +57,9 @@ function init_healthapp() {
       $flashes = $('#flashes'),
       $title = $('h1'),
       router = new Navigo(null, false, '#!'),
-      last_flash = null;
+      last_flash = null,
+      current_page = null,
+      servers = {};
 
   function flash(type, message) {
     last_flash = {type: type, message: message};
@@ -49,8 +79,19 @@ function init_healthapp() {
     }
   };
 
+  // remember what's showing so live updates know what to patch, and what to
+  // reload if we miss some
+  function show_page(page, params) {
+    current_page = {page: page, params: params};
+    page(params);
+  }
+
   function servers_list_page(params) {
     get_servers(function(data) {
+      servers = {};
+      $.each(data.servers, function(i, server) {
+        servers[server.name] = server;
+      });
       render_page('Servers', server_list(data));
     });
   }
@@ -73,6 +114,136 @@ function init_healthapp() {
       });
   }
 
+  function format_time(timestamp) {
+    // same as the API's, in the browser's timezone
+    var date = new Date(timestamp * 1000);
+    function pad(number) {
+      return (number < 10 ? '0' : '') + number;
+    }
+    return date.getFullYear() + '-' + pad(date.getMonth() + 1) + '-' + pad(date.getDate()) + ' ' +
+      pad(date.getHours()) + ':' + pad(date.getMinutes()) + ':' + pad(date.getSeconds());
+  }
+
+  function update_server_row(name, changes) {
+    var server = servers[name],
+        $row = $('#servers tr[data-name="' + name + '"]');
+    if (!server || !$row.length) {
+      return false;
+    }
+    $.extend(server, changes);
+    $row.replaceWith(server_row(server));
+    return true;
+  }
+
+  function on_page(page) {
+    return current_page && current_page.page === page;
+  }
+
+  // live updates. rather than reloading pages, patch just the rows affected
+  function heartbeats_event(event) {
+    if (on_page(servers_list_page)) {
+      var unknown = false;
+      $.each(event.servers, function(name, timestamp) {
+        unknown = !update_server_row(name, {good: true, time: format_time(timestamp)}) || unknown;
+      });
+      if (unknown) {
+        // a new server. list again to get its info
+        servers_list_page();
+      }
+      router.updatePageLinks();
+    } else if (on_page(server_view_page) && current_page.params.servername in event.servers) {
+      // the one server being viewed. fetch its new stats
+      server_view_page(current_page.params);
+    }
+  }
+
+  function server_stale_event(event) {
+    if (on_page(servers_list_page)) {
+      update_server_row(event.server, {good: false});
+      router.updatePageLinks();
+    }
+  }
+
+  function alert_opened_event(event) {
+    if (!on_page(alerts_list_page)) {
+      return;
+    }
+    get_alert(event.alert_id, function(data) {
+      if (on_page(alerts_list_page) && !$('#active-alerts tr[data-id="' + data.alert_id + '"]').length) {
+        $('#active-alerts').prepend(active_alert_row(data));
+        router.updatePageLinks();
+      }
+    });
+  }
+
+  function alert_closed_event(event) {
+    var $row = $('#active-alerts tr[data-id="' + event.alert_id + '"]');
+    if (!on_page(alerts_list_page) || !$row.length) {
+      return;
+    }
+    get_alert(event.alert_id, function(data) {
+      $('#active-alerts tr[data-id="' + data.alert_id + '"]').remove();
+      $('#historical-alerts').prepend(historical_alert_row(data));
+      router.updatePageLinks();
+    });
+  }
+
+  var event_handlers = {
+    heartbeats: heartbeats_event,
+    server_stale: server_stale_event,
+    alert_opened: alert_opened_event,
+    alert_closed: alert_closed_event
+  };
+
+  function listen_for_events(disconnected) {
+    if (!window.EventSource) {
+      return;
+    }
+
+    var source = new EventSource('/api/v0/events');
+
+    source.onmessage = function(message) {
+      var event = JSON.parse(message.data),
+          handler = event_handlers[event.type];
+      if (handler) {
+        handler(event);
+      }
+    };
+
+    // the browser reconnects by itself. anything could have changed in the
+    // meantime, so load the page again once it has
+    source.onerror = function() {
+      disconnected = true;
+      // except when the API refuses the stream, eg when it's serving as many
+      // as it will. try again in a while
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(function() {
+          listen_for_events(true);
+        }, 30000);
+      }
+    };
+    source.onopen = function() {
+      if (disconnected && current_page) {
+        show_page(current_page.page, current_page.params);
+      }
+      disconnected = false;
+    };
+  }
+
+  function more_alerts_click(event) {
+    var $button = $(event.target);
+    $button.prop('disabled', true);
+    get_older_alerts($button.data('next'), function(data) {
+      $('#historical-alerts').append(historical_alert_rows(data));
+      router.updatePageLinks();
+      if (data.next) {
+        $button.data('next', data.next).prop('disabled', false);
+      } else {
+        $button.remove();
+      }
+    });
+  }
+
   function alert_row_click(event) {
     var alert_id = $(event.target).closest('tr').data('id');
     router.navigate('/alert/' + alert_id);
@@ -85,12 +256,21 @@ function init_healthapp() {
 
   $content.on('click', '.alert-row', alert_row_click)
   $content.on('click', '.server-row', server_row_click)
+  $content.on('click', '#more-alerts', more_alerts_click)
+
+  function route(page) {
+    return function(params) {
+      show_page(page, params);
+    };
+  }
 
   router.on({
-    '/': servers_list_page,
-    '/alerts': alerts_list_page,
-    '/alert/:alertid': alert_view_page,
-    '/server/:servername': server_view_page,
+    '/': route(servers_list_page),
+    '/alerts': route(alerts_list_page),
+    '/alert/:alertid': route(alert_view_page),
+    '/server/:servername': route(server_view_page),
 
   }).resolve();
+
+  listen_for_events();
 }
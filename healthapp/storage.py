@@ -0,0 +1,318 @@
+# compact storage of server and alert infos, for fleets big enough that
+# redis' overhead per key is most of its memory.
+#
+# turned on with compact_storage. rather than a key per server and per
+# alert, infos are fields of compact_buckets bucket hashes of each kind,
+# which redis keeps in its compact listpack (ziplist before 7.0) encoding
+# while they have at most hash-max-listpack-entries fields, none longer than
+# hash-max-listpack-value bytes. alerts get short random ids and are packed
+# into a few bytes: times as integers plus the state name, with the server
+# name, duration and info sentence worked out again on read.
+#
+# anything missing from its bucket is looked for under the old key per
+# entity, so the two schemas can be mixed while `healthapp-admin
+# migrate-storage` moves things across. deletes always clear both.
+
+import os
+import time
+import zlib
+import struct
+import string
+from datetime import datetime
+from collections import defaultdict
+
+from constants import key_map
+from shards import server_shard_key, state_server_name
+
+# fixed, as every reader has to agree on them. 1024 buckets stay within
+# redis 7's default of 128 fields per listpack up to ~130k servers or
+# alerts, and redis 6's 512 up to ~500k. past that raise
+# hash-max-listpack-entries. server infos longer than
+# hash-max-listpack-value (default 64 bytes) need that raised too.
+compact_buckets = 1024
+
+# start time, end time (-1 while ongoing) and last post, followed by state
+# name. 64 bit so the format outlives 2038.
+packed_alert = struct.Struct('>qqq')
+
+alert_id_alphabet = string.digits + string.ascii_letters
+alert_id_length = 8
+
+
+def bucket_of(name):
+    return (zlib.crc32(name) & 0xffffffff) % compact_buckets
+
+
+def server_info_bucket(server_name):
+    return key_map['server_info_bucket'].format(bucket=bucket_of(server_name))
+
+
+def alert_info_bucket(alert_id):
+    return key_map['alert_info_bucket'].format(bucket=bucket_of(alert_id))
+
+
+def by_bucket(names, bucket_key):
+    '''list of (bucket key, names in it)'''
+    buckets = defaultdict(list)
+    for name in names:
+        buckets[bucket_key(name)].append(name)
+    return buckets.items()
+
+
+def short_alert_id():
+    # ~47 bits of randomness, in characters which are safe in keys and urls
+    return ''.join(alert_id_alphabet[ord(c) % len(alert_id_alphabet)] for c in os.urandom(alert_id_length))
+
+
+def stale_info(server_name, last_post):
+    return 'Server %s last reported on %s' % (server_name, datetime.fromtimestamp(last_post))
+
+
+def stale_info_last_post(info):
+    '''Last post time back out of a stale_info() sentence, or 0'''
+    try:
+        return int(time.mktime(time.strptime(info.rsplit(' on ', 1)[1], '%Y-%m-%d %H:%M:%S')))
+    except (IndexError, ValueError):
+        return 0
+
+
+def pack_alert(info):
+    return packed_alert.pack(int(float(info['start_time'])), int(float(info['end_time'])),
+                             int(info.get('last_post') or 0)) + info['state_name']
+
+
+def unpack_alert(value):
+    '''An alert's packed info, as the fields the old schema's hash would have'''
+    start_time, end_time, last_post = packed_alert.unpack_from(value)
+    state_name = value[packed_alert.size:]
+    server_name = state_server_name(state_name)
+
+    info = {
+        'state_name': state_name,
+        'server_name': server_name,
+        'start_time': start_time,
+        'end_time': end_time,
+        'last_post': last_post,
+    }
+    if end_time != -1:
+        info['duration'] = end_time - start_time
+    if last_post and state_name.startswith('stale_'):
+        info['info'] = stale_info(server_name, last_post)
+    return info
+
+
+def read_server_infos(pipe, server_names, compact=False):
+    '''
+    Queue reads of these servers' infos on pipe. Returns how many results
+    that adds, and a function which takes (r, those results) and gives the
+    raw infos in order, None for unknown servers. Compact reads which miss
+    cost one more round trip, for the old keys.
+    '''
+    classic_keys = [key_map['server_info'].format(server_name=server_name) for server_name in server_names]
+
+    if not compact:
+        pipe.mget(classic_keys)
+        return 1, lambda r, results: results[0]
+
+    buckets = by_bucket(server_names, server_info_bucket)
+    for key, names in buckets:
+        pipe.hmget(key, names)
+
+    def finish(r, results):
+        infos = {}
+        for (key, names), values in zip(buckets, results):
+            infos.update(zip(names, values))
+
+        missing = [i for i, server_name in enumerate(server_names) if infos[server_name] is None]
+        if missing:
+            for i, info in zip(missing, r.mget([classic_keys[i] for i in missing])):
+                infos[server_names[i]] = info
+
+        return [infos[server_name] for server_name in server_names]
+
+    return len(buckets), finish
+
+
+def read_alert_infos(r, alert_ids, compact=False):
+    '''
+    Raw infos of these alerts, in order: the old schema's hash fields, or
+    the same unpacked from compact storage. Empty for alerts which don't exist.
+    '''
+    pipe = r.pipeline(transaction=False)
+    if compact:
+        buckets = by_bucket(alert_ids, alert_info_bucket)
+        for key, ids in buckets:
+            pipe.hmget(key, ids)
+        packed = {}
+        for (key, ids), values in zip(buckets, pipe.execute()):
+            packed.update(zip(ids, values))
+        alert_ids_left = [alert_id for alert_id in alert_ids if packed[alert_id] is None]
+    else:
+        packed = {}
+        alert_ids_left = alert_ids
+
+    infos = dict((alert_id, unpack_alert(value)) for alert_id, value in packed.iteritems() if value is not None)
+    if alert_ids_left:
+        for alert_id in alert_ids_left:
+            pipe.hgetall(key_map['alert_info'].format(alert_id=alert_id))
+        infos.update(zip(alert_ids_left, pipe.execute()))
+
+    return [infos[alert_id] for alert_id in alert_ids]
+
+
+def write_server_infos(pipe, infos, compact=False):
+    '''Queue writing dict of server name -> info body on pipe'''
+    if not compact:
+        pipe.mset(dict((key_map['server_info'].format(server_name=server_name), body) for server_name, body in infos.iteritems()))
+        return
+
+    for key, names in by_bucket(infos.keys(), server_info_bucket):
+        pipe.hmset(key, dict((server_name, infos[server_name]) for server_name in names))
+    pipe.delete(*[key_map['server_info'].format(server_name=server_name) for server_name in infos])
+
+
+def write_alert(pipe, alert_id, info, compact=False):
+    '''Queue writing a new alert's info on pipe'''
+    if compact:
+        pipe.hset(alert_info_bucket(alert_id), alert_id, pack_alert(info))
+    else:
+        pipe.hmset(key_map['alert_info'].format(alert_id=alert_id), dict((k, v) for k, v in info.iteritems() if k != 'last_post'))
+
+
+def delete_server_infos(pipe, server_names):
+    for key, names in by_bucket(server_names, server_info_bucket):
+        pipe.hdel(key, *names)
+    pipe.delete(*[key_map['server_info'].format(server_name=server_name) for server_name in server_names])
+
+
+def delete_alerts(pipe, alert_ids):
+    for key, ids in by_bucket(alert_ids, alert_info_bucket):
+        pipe.hdel(key, *ids)
+    pipe.delete(*[key_map['alert_info'].format(alert_id=alert_id) for alert_id in alert_ids])
+
+
+# Move a server's info from its own key into its bucket, unless the API
+# already wrote a newer one there.
+#
+# KEYS: server_info, server info bucket
+# ARGV: server_name
+migrate_server_script = '''
+local info = redis.call('get', KEYS[1])
+if not info then
+    return 0
+end
+redis.call('hsetnx', KEYS[2], ARGV[1], info)
+redis.call('del', KEYS[1])
+return 1
+'''
+
+# Move a closed alert into its bucket under a new id, renaming it in the
+# alert histories. Skips it if it's firing or has changed since it was read.
+#
+# KEYS: alert_info, new id's alert info bucket, alerts_historical,
+#       server_alerts, alert_currently_firing (of the server's shard)
+# ARGV: old id, new id, packed info, state name, end time as read
+migrate_alert_script = '''
+if redis.call('hget', KEYS[1], 'end_time') ~= ARGV[5] or redis.call('hget', KEYS[5], ARGV[4]) == ARGV[1] then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[2], ARGV[3])
+for _, key in ipairs({KEYS[3], KEYS[4]}) do
+    local score = redis.call('zscore', key, ARGV[1])
+    if score then
+        redis.call('zadd', key, score, ARGV[2])
+        redis.call('zrem', key, ARGV[1])
+    end
+end
+redis.call('del', KEYS[1])
+return 1
+'''
+
+
+class StorageMigration(object):
+    '''
+    Moves server and alert infos from a key each into compact storage, one
+    SCAN batch per step() so redis is never busy for long. Where it got to
+    is saved in redis after every batch, so an interrupted migration picks
+    up where it left off.
+
+    Alerts which are firing are left for the alerter to close, and can be
+    moved by running the migration again from the start afterwards. Moved
+    alerts get new ids, so old links to them stop working.
+    '''
+
+    phases = ('servers', 'alerts')
+
+    def __init__(self, r, shards=1, batch_size=100):
+        self.r = r
+        self.shards = shards
+        self.batch_size = batch_size
+        self.migrate_server = r.register_script(migrate_server_script)
+        self.migrate_alert = r.register_script(migrate_alert_script)
+
+    def restart(self):
+        self.r.delete(key_map['storage_migration'])
+
+    def cursors(self):
+        '''dict of phase -> SCAN cursor, or 'done'. phases not started are missing.'''
+        return self.r.hgetall(key_map['storage_migration'])
+
+    def step(self):
+        '''
+        Migrate one batch. Returns (phase, moved, skipped), or None once
+        everything has been through.
+        '''
+        cursors = self.cursors()
+        for phase in self.phases:
+            cursor = cursors.get(phase, '0')
+            if cursor == 'done':
+                continue
+
+            if phase == 'servers':
+                cursor, keys = self.r.scan(cursor, key_map['server_info'].format(server_name='*'), self.batch_size)
+                moved, skipped = self.move_servers(keys)
+            else:
+                cursor, keys = self.r.scan(cursor, key_map['alert_info'].format(alert_id='*'), self.batch_size)
+                moved, skipped = self.move_alerts(keys)
+
+            self.r.hset(key_map['storage_migration'], phase, cursor if cursor else 'done')
+            return phase, moved, skipped
+
+    def move_servers(self, keys):
+        prefix_length = len(key_map['server_info'].format(server_name=''))
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            server_name = key[prefix_length:]
+            self.migrate_server(keys=[key, server_info_bucket(server_name)], args=[server_name], client=pipe)
+        moved = sum(pipe.execute())
+        return moved, len(keys) - moved
+
+    def move_alerts(self, keys):
+        prefix_length = len(key_map['alert_info'].format(alert_id=''))
+        alert_ids = [key[prefix_length:] for key in keys]
+
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        infos = pipe.execute()
+
+        pipe = self.r.pipeline(transaction=False)
+        queued = 0
+        for key, alert_id, info in zip(keys, alert_ids, infos):
+            if not info.get('state_name') or float(info.get('end_time', -1)) == -1:
+                continue
+
+            server_name = info.get('server_name') or state_server_name(info['state_name'])
+            info['last_post'] = stale_info_last_post(info.get('info', ''))
+            new_id = short_alert_id()
+            self.migrate_alert(keys=[key, alert_info_bucket(new_id), key_map['alerts_historical'],
+                                     key_map['server_alerts'].format(server_name=server_name),
+                                     server_shard_key('alert_currently_firing', server_name, self.shards)],
+                               args=[alert_id, new_id, pack_alert(info), info['state_name'], info['end_time']],
+                               client=pipe)
+            queued += 1
+
+        moved = sum(pipe.execute()) if queued else 0
+        if moved:
+            self.r.incr(key_map['alerts_version'])
+        return moved, len(keys) - moved
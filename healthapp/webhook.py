@@ -0,0 +1,126 @@
+# Notifier which POSTs alert transitions as signed JSON to a webhook url,
+# eg a chat or paging service.
+
+import time
+import threading
+import requests
+import ujson
+from requests.adapters import HTTPAdapter
+
+from config import process_config
+from integrity import sign
+from notify import Notifier, NotificationQueue
+
+default_webhook_workers = 4
+default_webhook_timeout = 5
+
+
+class RateLimiter(object):
+    '''Token bucket allowing rate calls per second, shared between threads'''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(1.0, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.time()
+                self.tokens = 1.0
+
+            self.tokens -= 1
+
+
+class WebhookSender(object):
+    '''
+    Delivers payloads to one url. The requests session, and so its pool of
+    keep-alive connections, is shared by every worker of a notifier.
+    '''
+
+    def __init__(self, session, url, secret, timeout, limiter=None):
+        self.session = session
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.limiter = limiter
+
+    def send(self, payload):
+        body = ujson.dumps(payload)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-INTEGRITY': sign(self.secret, body)
+        }
+
+        if self.limiter:
+            self.limiter.wait()
+
+        r = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        r.raise_for_status()
+
+    def close(self):
+        pass
+
+
+class WebhookNotifier(Notifier):
+    '''
+    Settings:
+      url: where to POST
+      secret: HMAC key for the X-INTEGRITY header. defaults to api_key
+      timeout: seconds to wait for each delivery
+      rate_limit: max deliveries per second to this url
+      workers: number of concurrent deliveries
+    '''
+
+    def __init__(self, settings):
+        super(WebhookNotifier, self).__init__(settings)
+        self.url = settings['url']
+        secret = settings.get('secret') or process_config().get('api_key')
+        if not secret:
+            # rather than sign with a key anyone could guess
+            raise ValueError('webhook notifier for %s needs a secret, or api_key set' % self.url)
+        self.secret = str(secret)
+        self.timeout = settings.get('timeout', default_webhook_timeout)
+        self.pending = []
+
+        rate_limit = settings.get('rate_limit')
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        workers = settings.get('workers', default_webhook_workers)
+        self.session = requests.Session()
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+        self.queue = NotificationQueue.from_settings(self.make_sender, dict(settings, workers=workers))
+
+    def make_sender(self):
+        return WebhookSender(self.session, self.url, self.secret, self.timeout, self.limiter)
+
+    def send_event(self, event, alert_id, state_name, **extra):
+        payload = {
+            'event': event,
+            'alert_id': alert_id,
+            'state_name': state_name,
+            'time': time.time()
+        }
+        payload.update(extra)
+        self.pending.append(payload)
+
+    def alert_new(self, alert_id, state_name, description):
+        self.send_event('alert_new', alert_id, state_name, description=description)
+
+    def alert_closed(self, state_name, alert_id, duration):
+        self.send_event('alert_closed', alert_id, state_name, duration=duration)
+
+    def alert_ongoing(self, alert_id, state_name):
+        self.send_event('alert_ongoing', alert_id, state_name)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for payload in pending:
+            self.queue.put(payload)
@@ -1,3 +1,6 @@
 #!/bin/bash
 
-gunicorn 'healthapp.server:get_app()'  -b 0 --reload --workers 4
+# threads serve agents' posts and the web UI's event streams alike. each
+# worker holds at most events_max_streams (8) streams, leaving the rest of
+# the 32 threads for agents' posts
+gunicorn 'healthapp.server:get_app()'  -b 0 --reload --workers 4 --worker-class gthread --threads 32
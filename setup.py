@@ -10,6 +10,7 @@ setup(name='healthapp',
               'alert-processor = healthapp.alerter:main',
               'agent = healthapp.agent:main',
               'healthapp-admin = healthapp.cli:main',
+              'healthapp-green-api = healthapp.green:main',
           ]
       },
       )